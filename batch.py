@@ -0,0 +1,181 @@
+"""
+Builds the municipal limits of many counties in one run, on one shared worker pool.
+
+The counties are listed in a TOML manifest (see counties.toml):
+
+    [[county]]
+    name = "limestone"
+    output_name = "limestone_co_municipal_limits"
+    output_folder = "municipal_limits"
+    registry = "sources.toml"               # or base_folder, towns_gdb and athens_gdb for the built in layers
+    boundary = "boundaries/limestone.shp"   # optional, the combined layer is clipped to it
+
+Paths are relative to the manifest.  Every source layer of every county is
+submitted to the one pool.  A layer that several counties use, such as a
+statewide towns geodatabase, is only built once (two layers are the same when
+they have the same layer class and arguments).  A county is combined and
+written as soon as all of its layers are built, while the pool goes on with
+the layers of the other counties.
+
+    python batch.py counties.toml --workers 8 --executor process
+"""
+
+import argparse
+import concurrent.futures
+import logging
+import os
+import sys
+import time
+from collections import OrderedDict
+from pathlib import Path
+from typing import Dict, List, Optional
+
+import gislayer
+import layercache
+import municipal_limits_geoprocess as mlg
+import profiling
+import snapshotcatalog
+import sourceregistry
+
+COUNTY_KEYS = {'name', 'output_name', 'output_folder', 'formats', 'registry', 'base_folder',
+               'towns_gdb', 'athens_gdb', 'boundary', 'boundary_layer'}
+
+
+def layer_key(layer_class, kwargs: dict) -> tuple:
+    """Returns a key that is the same for two layers that would be built the same way."""
+    return (f'{layer_class.__module__}.{layer_class.__qualname__}',
+            tuple(sorted((k, str(v)) for (k, v) in kwargs.items())))
+
+
+class County(object):
+    """A county of the manifest, with its MunicipalLimitsGeoProcess and the keys of its layers."""
+    def __init__(self, entry: dict, root: Path, catalog=None, cache=None, engine=None, formats=None):
+        unknown = set(entry) - COUNTY_KEYS
+        if unknown:
+            raise ValueError(f'unknown keys {sorted(unknown)} in county {entry.get("name")!r}')
+        self.name = entry['name']
+        registry = None
+        if 'registry' in entry:
+            registry = mlg.load_registry(root / entry['registry'])
+        self.boundary = None
+        if 'boundary' in entry:
+            self.boundary = gislayer.read_file(str(root / entry['boundary']), layer=entry.get('boundary_layer'))
+        self.mlgp = mlg.MunicipalLimitsGeoProcess(
+            str(root / entry.get('base_folder', mlg.CITIES_FOLDER)),
+            cache=cache, engine=engine, catalog=catalog, registry=registry,
+            towns_gdb=str(root / entry.get('towns_gdb', mlg.TOWNS_GDB)),
+            athens_gdb=str(root / entry.get('athens_gdb', mlg.ATHENS_GDB)),
+            output_folder=str(root / entry.get('output_folder', mlg.OUTPUT_FOLDER)),
+            output_name=entry.get('output_name', f'{self.name}_municipal_limits'),
+            formats=entry.get('formats', formats or mlg.OUTPUT_FORMATS))
+        self.specs = self.mlgp.layer_specs()
+        self.keys = [layer_key(layer_class, kwargs) for (_, layer_class, kwargs) in self.specs]
+
+    def write(self, layers: Dict[tuple, object]) -> None:
+        """Combines the built layers of this county and writes them."""
+        self.mlgp.set_layers((name, layers[key]) for ((name, _, _), key) in zip(self.specs, self.keys))
+        self.mlgp.combine_layers()
+        if self.boundary is not None:
+            self.mlgp.clip_combined(self.boundary)
+        self.mlgp.write()
+
+
+def load_counties(manifest_path, **kwargs) -> List[County]:
+    manifest_path = Path(manifest_path)
+    document = sourceregistry.load_toml(manifest_path)
+    counties = [County(entry, manifest_path.parent, **kwargs) for entry in document.get('county', [])]
+    names = [county.name for county in counties]
+    duplicates = sorted({name for name in names if names.count(name) > 1})
+    if duplicates:
+        raise ValueError(f'the counties {duplicates} are listed more than once in {manifest_path}')
+    return counties
+
+
+def run_batch(counties: List[County], workers: Optional[int] = None, executor: str = 'process') -> Dict[str, str]:
+    """
+    Builds every layer of every county on one pool and writes each county once its layers are built.
+
+    returns {county name: error message} of the counties that failed, the others are written
+    """
+    # one build for each distinct layer, in the order the counties list them
+    unique = OrderedDict()
+    for county in counties:
+        for ((_, layer_class, kwargs), key) in zip(county.specs, county.keys):
+            unique.setdefault(key, (layer_class, kwargs))
+    users = {key: sum(key in county.keys for county in counties) for key in unique}
+    logging.info(f'{len(counties)} counties use {len(unique)} distinct layers '
+                 f'({sum(len(c.keys) for c in counties) - len(unique)} shared)')
+
+    cache = counties[0].mlgp.cache if counties else None
+    layers = {}
+    failed = OrderedDict()
+    waiting = list(counties)
+    with gislayer.make_pool(workers or os.cpu_count() or 1, executor, initializer=profiling.configure,
+                            initargs=(profiling.CPROFILE_FOLDER, profiling.TRACEMALLOC)) as pool:
+        futures = {pool.submit(mlg._build_layer, layer_class, kwargs, cache): key
+                   for (key, (layer_class, kwargs)) in unique.items()}
+        errors = {}
+        for future in concurrent.futures.as_completed(futures):
+            key = futures[future]
+            try:
+                layers[key] = future.result()
+            except Exception as err:
+                logging.error(f'failed to build {key[0]} {dict(key[1]).get("filename")}: {err!r}')
+                errors[key] = err
+
+            # write every county whose layers are all done, while the pool keeps building
+            for county in list(waiting):
+                if any(k not in layers and k not in errors for k in county.keys):
+                    continue
+                waiting.remove(county)
+                bad = [k for k in county.keys if k in errors]
+                try:
+                    if bad:
+                        raise mlg.LayerBuildError(county.specs[county.keys.index(bad[0])][0], errors[bad[0]])
+                    logging.info(f'writing {county.name}')
+                    county.write(layers)
+                except Exception as err:
+                    logging.error(f'{county.name} failed: {err!r}')
+                    failed[county.name] = repr(err)
+                # a layer no county still needs is let go
+                for k in set(county.keys):
+                    users[k] -= 1
+                    if users[k] == 0:
+                        layers.pop(k, None)
+    return failed
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Builds the municipal limits of every county in a manifest.')
+    parser.add_argument('manifest', help='TOML file with a [[county]] table for each county')
+    parser.add_argument('--workers', type=int, default=None, help='size of the shared pool (default: the number of CPUs)')
+    parser.add_argument('--executor', choices=('thread', 'process'), default='process')
+    parser.add_argument('--engine', choices=gislayer.ENGINES, default=None)
+    parser.add_argument('--format', dest='formats', action='append', choices=list(mlg.writers.FORMATS),
+                        help='output format for counties that do not list their own')
+    parser.add_argument('--catalog', default=mlg.CATALOG_PATH)
+    parser.add_argument('--no-catalog', action='store_true')
+    parser.add_argument('--no-cache', action='store_true')
+    parser.add_argument('--cache-folder', default=mlg.CACHE_FOLDER)
+    args = parser.parse_args(argv)
+
+    logging.basicConfig(format='%(levelname)s : %(message)s', level=logging.INFO)
+    logging.info("Started:  {0}".format(time.asctime()))
+
+    cache = None
+    if not args.no_cache:
+        cache = layercache.LayerCache(args.cache_folder, code_files=mlg.code_files())
+    catalog = None if args.no_catalog else snapshotcatalog.SnapshotCatalog(args.catalog)
+    counties = load_counties(args.manifest, catalog=catalog, cache=cache, engine=args.engine,
+                             formats=args.formats)
+    failed = run_batch(counties, workers=args.workers, executor=args.executor)
+
+    logging.info("Ended:  {0}".format(time.asctime()))
+    if failed:
+        for (name, error) in failed.items():
+            logging.error(f'{name}: {error}')
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
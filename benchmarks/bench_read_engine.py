@@ -0,0 +1,65 @@
+"""
+Compares the read engines in gislayer.ENGINES on the bundled data.
+
+Run from the top folder of the repository:
+    python benchmarks/bench_read_engine.py --repeat 5
+"""
+
+import argparse
+import statistics
+import sys
+import time
+from pathlib import Path
+
+ROOT = Path(__file__).resolve().parent.parent
+sys.path.insert(0, str(ROOT))
+
+import fiona
+
+import gislayer
+
+
+def bundled_datasets():
+    """Returns (label, filename, layer) for the newest snapshot of each bundled source."""
+    cities = ROOT / 'municipal_limits' / 'cities'
+    datasets = []
+    for city in ('decatur', 'huntsville', 'madison'):
+        folder = sorted(p for p in (cities / city).iterdir() if p.is_dir())[-1]
+        shp = next(folder.glob('*.shp'))
+        datasets.append((city, str(shp), None))
+
+    towns_gdb = ROOT / 'municipal_limits' / 'MunicipalLimits.gdb'
+    datasets.append(('towns', str(towns_gdb), 'MunicipalBoundary'))
+
+    athens_gdb = ROOT / 'municipal_limits' / 'AthensMunicipalLimits.gdb'
+    athens_layer = sorted(x for x in fiona.listlayers(str(athens_gdb))
+                          if x.startswith('AthensMunicipalBoundary'))[-1]
+    datasets.append(('athens', str(athens_gdb), athens_layer))
+    return datasets
+
+
+def time_read(filename, layer, engine, repeat):
+    times = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        gdf = gislayer.read_file(filename, layer=layer, engine=engine)
+        times.append(time.perf_counter() - start)
+    return len(gdf), times
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--repeat', type=int, default=5)
+    args = parser.parse_args(argv)
+
+    engines = [e for e in gislayer.ENGINES if gislayer.resolve_engine(e) == e]
+    print(f"{'dataset':<12}{'engine':<10}{'rows':>8}{'median ms':>12}{'min ms':>10}")
+    for (label, filename, layer) in bundled_datasets():
+        for engine in engines:
+            (rows, times) = time_read(filename, layer, engine, args.repeat)
+            print(f'{label:<12}{engine:<10}{rows:>8}'
+                  f'{statistics.median(times) * 1000:>12.1f}{min(times) * 1000:>10.1f}')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,217 @@
+"""
+Runs the geoprocessing on synthetic layers of growing size and records the timings.
+
+For each size this generates the layers (see synthetic.py), runs the whole
+MunicipalLimitsGeoProcess pipeline, then runs the combine_geometry_multipart,
+clip, concat and shapefile writing stages on their own, and looks up random
+points with municipallookup.  The results are
+appended to benchmarks/results/<git commit>.jsonl so runs on different commits
+can be compared:
+
+    python benchmarks/run_benchmarks.py --sizes 100 1000 10000 100000 --vertices 32
+    python benchmarks/run_benchmarks.py --compare benchmarks/results/abc1234.jsonl benchmarks/results/def5678.jsonl
+"""
+
+import argparse
+import datetime
+import json
+import logging
+import subprocess
+import sys
+import tempfile
+import time
+from collections import defaultdict
+from pathlib import Path
+
+ROOT = Path(__file__).resolve().parent.parent
+sys.path.insert(0, str(ROOT))
+sys.path.insert(0, str(Path(__file__).resolve().parent))
+
+import geopandas as gpd
+import numpy as np
+import shapely.geometry
+
+import gislayer
+import municipal_limits_geoprocess
+import municipallookup
+import synthetic
+
+RESULTS_FOLDER = ROOT / 'benchmarks' / 'results'
+
+# random points looked up in the combined layer for each size
+LOOKUP_POINTS = 1000000
+
+
+def git_commit() -> str:
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], cwd=ROOT, check=True,
+                              capture_output=True, text=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return 'unknown'
+
+
+def timed(func):
+    """Returns (the result of func(), seconds it took)."""
+    start = time.perf_counter()
+    result = func()
+    return (result, time.perf_counter() - start)
+
+
+def run_pipeline(data_folder: Path, output_folder: Path, workers, engine):
+    """Runs read, combine and write, returns the MunicipalLimitsGeoProcess."""
+    mlgp = municipal_limits_geoprocess.MunicipalLimitsGeoProcess(
+        str(data_folder / 'cities') + '/', workers=workers, engine=engine,
+        towns_gdb=str(data_folder / 'MunicipalLimits.gdb'),
+        athens_gdb=str(data_folder / 'AthensMunicipalLimits.gdb'),
+        output_folder=str(output_folder))
+    mlgp.read_layers()
+    mlgp.combine_layers()
+    mlgp.write()
+    return mlgp
+
+
+def run_stages(mlgp, output_folder: Path, union_workers):
+    """Runs single stages on the combined layer, returns {stage: seconds}."""
+    combined = mlgp.combined
+    results = {}
+
+    (_, results['concat']) = timed(lambda: combined.concat(mlgp.muni_layers))
+
+    def dissolve():
+        layer = gislayer.GISLayer(gdf=combined.gdf.copy())
+        layer.combine_geometry_multipart(workers=union_workers)
+    (_, results['combine_geometry_multipart']) = timed(dissolve)
+
+    def dissolve_by_name():
+        layer = gislayer.GISLayer(gdf=combined.gdf.copy())
+        layer.combine_geometry_multipart(by='NAME', workers=union_workers)
+    (_, results['combine_geometry_multipart_by_name']) = timed(dissolve_by_name)
+
+    # a county shaped clip area covering the middle of the layer
+    (minx, miny, maxx, maxy) = combined.gdf.total_bounds
+    county = shapely.geometry.Point((minx + maxx) / 2, (miny + maxy) / 2).buffer(
+        min(maxx - minx, maxy - miny) * 0.4, resolution=256)
+    county_gdf = gpd.GeoDataFrame(geometry=[county], crs=combined.gdf.crs)
+    (_, results['clip']) = timed(lambda: combined.clip(county_gdf))
+
+    shp = output_folder / 'stage_write.shp'
+    (_, results['write_shapefile']) = timed(lambda: combined.gdf.to_file(
+        str(shp), driver='ESRI Shapefile',
+        schema={'geometry': 'Polygon', 'properties': municipal_limits_geoprocess.OUTPUT_SCHEMA_PROPS}))
+    return results
+
+
+def run_lookup(mlgp, points: int, workers):
+    """Looks up random points in the combined layer, returns {stage: seconds}."""
+    results = {}
+    (index, results['lookup_index_build']) = timed(
+        lambda: municipallookup.MunicipalityIndex.from_geoprocess(mlgp))
+    # a third of the points fall outside of the layer's bounds, like addresses in unincorporated areas
+    (minx, miny, maxx, maxy) = mlgp.combined.gdf.total_bounds
+    (width, height) = (maxx - minx, maxy - miny)
+    rng = np.random.default_rng(0)
+    x = rng.uniform(minx - width * 0.1, maxx + width * 0.1, points)
+    y = rng.uniform(miny - height * 0.1, maxy + height * 0.1, points)
+    (_, results['lookup']) = timed(lambda: index.lookup(x, y, workers=workers))
+    return results
+
+
+def benchmark(sizes, vertices, workers, union_workers, engine, work_folder: Path,
+              lookup_points: int = LOOKUP_POINTS):
+    commit = git_commit()
+    started = datetime.datetime.now().isoformat(timespec='seconds')
+    records = []
+    for size in sizes:
+        data_folder = work_folder / f'data_{size}_{vertices}'
+        output_folder = work_folder / f'output_{size}_{vertices}'
+        output_folder.mkdir(parents=True, exist_ok=True)
+        if not (data_folder / 'cities').exists():
+            synthetic.generate(data_folder, size, vertices)
+
+        base = {'commit': commit, 'started': started, 'polygons': size, 'vertices_per_polygon': vertices,
+                'workers': workers, 'union_workers': union_workers, 'engine': engine}
+
+        logging.info(f'pipeline with {size} polygons')
+        (mlgp, seconds) = timed(lambda: run_pipeline(data_folder, output_folder, workers, engine))
+        records.append(dict(base, stage='pipeline', layer=None, wall_s=seconds))
+        for record in mlgp.profile_records():
+            records.append(dict(base, **record))
+
+        logging.info(f'single stages with {size} polygons')
+        for (stage, seconds) in run_stages(mlgp, output_folder, union_workers).items():
+            records.append(dict(base, stage=stage, layer='combined', wall_s=seconds))
+
+        if lookup_points:
+            logging.info(f'looking up {lookup_points} points with {size} polygons')
+            lookup = run_lookup(mlgp, lookup_points, workers)
+            records.append(dict(base, stage='lookup_index_build', layer='combined',
+                                wall_s=lookup['lookup_index_build']))
+            records.append(dict(base, stage='lookup', layer='combined', wall_s=lookup['lookup'],
+                                points=lookup_points, points_per_s=lookup_points / lookup['lookup']))
+            logging.info(f"{lookup_points / lookup['lookup']:,.0f} points per second")
+    return records
+
+
+def summarize(records):
+    """Returns {(polygons, layer, stage): total wall seconds}."""
+    totals = defaultdict(float)
+    for r in records:
+        totals[(r['polygons'], r.get('layer'), r['stage'])] += r['wall_s']
+    return totals
+
+
+def compare(base_path, head_path):
+    """Prints the wall time of each stage in two result files and the ratio."""
+    def load(path):
+        with open(path) as f:
+            return summarize(json.loads(line) for line in f if line.strip())
+    base = load(base_path)
+    head = load(head_path)
+    print(f"{'polygons':>9} {'layer':<26}{'stage':<36}{'base s':>10}{'head s':>10}{'ratio':>8}")
+    for key in sorted(set(base) | set(head), key=lambda k: (k[0], str(k[1]), k[2])):
+        (b, h) = (base.get(key), head.get(key))
+        ratio = f'{h / b:8.2f}' if b and h else ' ' * 8
+        print(f"{key[0]:>9} {str(key[1]):<26}{key[2]:<36}"
+              f"{b if b is not None else float('nan'):>10.3f}{h if h is not None else float('nan'):>10.3f}{ratio}")
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Benchmarks the geoprocessing on synthetic layers.')
+    parser.add_argument('--sizes', type=int, nargs='+', default=[100, 1000, 10000],
+                        help='total polygons in each run')
+    parser.add_argument('--vertices', type=int, default=16, help='vertices in each polygon')
+    parser.add_argument('--workers', type=int, default=None, help='workers for read_layers()')
+    parser.add_argument('--union-workers', type=int, default=None, help='workers for the dissolve')
+    parser.add_argument('--engine', choices=gislayer.ENGINES, default=None)
+    parser.add_argument('--lookup-points', type=int, default=LOOKUP_POINTS,
+                        help='random points looked up in the combined layer, 0 skips the lookup')
+    parser.add_argument('--work-folder', default=None,
+                        help='keeps the generated layers here between runs (default: a temporary folder)')
+    parser.add_argument('--results', default=None,
+                        help=f'results file (default: {RESULTS_FOLDER}/<commit>.jsonl)')
+    parser.add_argument('--compare', nargs=2, metavar=('BASE', 'HEAD'), help='compare two results files')
+    args = parser.parse_args(argv)
+
+    if args.compare:
+        compare(*args.compare)
+        return
+
+    logging.basicConfig(format='%(levelname)s : %(message)s', level=logging.INFO)
+    if args.work_folder is None:
+        with tempfile.TemporaryDirectory() as tmp:
+            records = benchmark(args.sizes, args.vertices, args.workers, args.union_workers,
+                                args.engine, Path(tmp), args.lookup_points)
+    else:
+        records = benchmark(args.sizes, args.vertices, args.workers, args.union_workers,
+                            args.engine, Path(args.work_folder), args.lookup_points)
+
+    results = Path(args.results) if args.results else RESULTS_FOLDER / f'{records[0]["commit"]}.jsonl'
+    results.parent.mkdir(parents=True, exist_ok=True)
+    with open(results, 'a') as f:
+        for record in records:
+            f.write(json.dumps(record, default=str) + '\n')
+    logging.info(f'wrote {len(records)} results to {results}')
+
+
+if __name__ == '__main__':
+    main()
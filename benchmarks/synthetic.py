@@ -0,0 +1,209 @@
+"""
+Writes synthetic municipal limit layers for benchmarking.
+
+The layers have the same folder layout and schemas as the bundled data, so
+MunicipalLimitsGeoProcess can read them in place of the real sources:
+
+    <root>/cities/decatur/YYYY MM DD/Decatur_Corporate_Limits.shp
+    <root>/cities/huntsville/YYYY MM DD/Boundary_City_Huntsville_poly.shp
+    <root>/cities/madison/YYYY MM DD/MadCityLimits.shp
+    <root>/MunicipalLimits.gdb              layer MunicipalBoundary
+    <root>/AthensMunicipalLimits.gdb        layer AthensMunicipalBoundary_YYYY_MM_DD
+
+Writing the File GeoDatabases needs GDAL 3.6 or newer.
+
+    python benchmarks/synthetic.py /tmp/synthetic --polygons 10000 --vertices 32
+"""
+
+import argparse
+import datetime
+import logging
+import uuid
+from collections import OrderedDict
+from pathlib import Path
+
+import geopandas as gpd
+import numpy as np
+import shapely
+
+# roughly Limestone County, Alabama
+BOUNDS = (-87.25, 34.60, -86.75, 35.00)
+
+# share of the polygons that goes to each source
+SHARES = OrderedDict([('decatur', 0.15), ('huntsville', 0.2), ('madison', 0.15),
+                      ('towns', 0.3), ('athens', 0.2)])
+
+# the projections of the sources, so the reprojection step has work to do
+SOURCE_CRS = {
+    'decatur': 'ESRI:102630',
+    'huntsville': 'EPSG:2240',
+    'madison': 'ESRI:102630',
+    'towns': 'ESRI:102630',
+    'athens': 'EPSG:3857',
+}
+
+
+def make_polygons(count: int, vertices: int, bounds=BOUNDS, seed: int = 0) -> np.ndarray:
+    """
+    Returns count polygons with vertices vertices each, in EPSG:4326.
+
+    Each polygon is a jittered star shape inside its own cell of a grid over
+    bounds, so the polygons do not overlap.
+    """
+    rng = np.random.default_rng(seed)
+    (minx, miny, maxx, maxy) = bounds
+    side = int(np.ceil(np.sqrt(count)))
+    cell_w = (maxx - minx) / side
+    cell_h = (maxy - miny) / side
+
+    index = np.arange(count)
+    cx = minx + (index % side + 0.5) * cell_w
+    cy = miny + (index // side + 0.5) * cell_h
+
+    angles = np.linspace(0, 2 * np.pi, vertices, endpoint=False)
+    radius = rng.uniform(0.25, 0.45, size=(count, vertices))
+    x = cx[:, None] + np.cos(angles)[None, :] * radius * cell_w
+    y = cy[:, None] + np.sin(angles)[None, :] * radius * cell_h
+    coords = np.stack([x, y], axis=-1)
+    # close the rings
+    coords = np.concatenate([coords, coords[:, :1, :]], axis=1)
+    return shapely.polygons(coords)
+
+
+def random_dates(rng, count: int, end: datetime.date):
+    days = rng.integers(0, 365 * 3, size=count)
+    return [end - datetime.timedelta(days=int(d)) for d in days]
+
+
+def write_shapefile(gdf, path: Path, properties: OrderedDict):
+    path.parent.mkdir(parents=True, exist_ok=True)
+    gdf.to_file(str(path), driver='ESRI Shapefile',
+                schema={'geometry': 'Polygon', 'properties': properties})
+
+
+def write_decatur(root: Path, geoms, rng, snapshot: datetime.date):
+    gdf = gpd.GeoDataFrame({
+        'GlobalID': ['{' + str(uuid.UUID(int=int(rng.integers(2 ** 62)))).upper() + '}' for _ in geoms],
+    }, geometry=list(geoms), crs='EPSG:4326').to_crs(SOURCE_CRS['decatur'])
+    gdf['Shape_STAr'] = gdf.area
+    gdf['Shape_STLe'] = gdf.length
+    write_shapefile(gdf, root / 'cities' / 'decatur' / snapshot.strftime('%Y %m %d') / 'Decatur_Corporate_Limits.shp',
+                    OrderedDict([('GlobalID', 'str:38'), ('Shape_STAr', 'float:19.11'),
+                                 ('Shape_STLe', 'float:19.11')]))
+
+
+def write_huntsville(root: Path, geoms, rng, snapshot: datetime.date):
+    count = len(geoms)
+    gdf = gpd.GeoDataFrame({
+        'CityName': ['Huntsville'] * count,
+        'Eff_Date': random_dates(rng, count, snapshot),
+        'Mod_Date': random_dates(rng, count, snapshot),
+        'Mod_User': ['synthetic'] * count,
+    }, geometry=list(geoms), crs='EPSG:4326').to_crs(SOURCE_CRS['huntsville'])
+    gdf['SHAPE_STAr'] = gdf.area
+    gdf['SHAPE_STLe'] = gdf.length
+    write_shapefile(gdf, root / 'cities' / 'huntsville' / snapshot.strftime('%Y %m %d') / 'Boundary_City_Huntsville_poly.shp',
+                    OrderedDict([('CityName', 'str:20'), ('Eff_Date', 'date'), ('Mod_Date', 'date'),
+                                 ('Mod_User', 'str:50'), ('SHAPE_STAr', 'float:19.11'),
+                                 ('SHAPE_STLe', 'float:19.11')]))
+
+
+def write_madison(root: Path, geoms, rng, snapshot: datetime.date):
+    count = len(geoms)
+    gdf = gpd.GeoDataFrame({
+        'Name': ['Madison'] * count,
+        'Use_Status': ['Active'] * count,
+    }, geometry=list(geoms), crs='EPSG:4326').to_crs(SOURCE_CRS['madison'])
+    gdf['Shape_area'] = gdf.area
+    write_shapefile(gdf, root / 'cities' / 'madison' / snapshot.strftime('%Y %m %d') / 'MadCityLimits.shp',
+                    OrderedDict([('Name', 'str:254'), ('Use_Status', 'str:50'), ('Shape_area', 'float:19.11')]))
+
+
+def municipal_boundary_frame(geoms, rng, snapshot: datetime.date, names, munityp, crs):
+    """Returns a GeoDataFrame with the schema of the MunicipalBoundary feature classes."""
+    count = len(geoms)
+    gdf = gpd.GeoDataFrame({
+        'NAME': names,
+        'MUNITYP': munityp,
+        'MUNIAREA': np.zeros(count),
+        'LOCALFIPS': [f'{i % 100000:05d}' for i in range(count)],
+        'LASTUPDATE': [datetime.datetime.combine(d, datetime.time()) for d in random_dates(rng, count, snapshot)],
+        'LASTEDITOR': ['synthetic'] * count,
+        'GlobalID': ['{' + str(uuid.UUID(int=int(rng.integers(2 ** 62)))).upper() + '}' for _ in range(count)],
+        'ProperName': [f'Town of {n}' for n in names],
+        'GNIS': rng.integers(2400000, 2410000, size=count),
+        'ChangeDesc': [''] * count,
+        'Source': ['Synthetic'] * count,
+        'SrcURL': [''] * count,
+    }, geometry=list(geoms), crs='EPSG:4326').to_crs(crs)
+    gdf['MUNIAREA'] = gdf.area / 43560 / 640
+    return gdf
+
+
+def write_towns(root: Path, geoms, rng, snapshot: datetime.date):
+    count = len(geoms)
+    names = [f'Town {i % 1000}' for i in range(count)]
+    # a tenth are cities, which TownsLimitLayer filters out
+    munityp = np.where(np.arange(count) % 10 == 0, 'City', 'Town')
+    gdf = municipal_boundary_frame(geoms, rng, snapshot, names, munityp, SOURCE_CRS['towns'])
+    gdf.to_file(str(root / 'MunicipalLimits.gdb'), driver='OpenFileGDB', layer='MunicipalBoundary')
+
+
+def write_athens(root: Path, geoms, rng, snapshot: datetime.date):
+    count = len(geoms)
+    gdf = municipal_boundary_frame(geoms, rng, snapshot, ['Athens'] * count, ['City'] * count,
+                                   SOURCE_CRS['athens'])
+    gdf['GNIS'] = 2403797
+    gdf.to_file(str(root / 'AthensMunicipalLimits.gdb'), driver='OpenFileGDB',
+                layer=snapshot.strftime('AthensMunicipalBoundary_%Y_%m_%d'))
+
+
+WRITERS = OrderedDict([('decatur', write_decatur), ('huntsville', write_huntsville),
+                       ('madison', write_madison), ('towns', write_towns), ('athens', write_athens)])
+
+
+def generate(root, polygons: int, vertices: int = 16, snapshots: int = 1, seed: int = 0,
+             end_date: datetime.date = datetime.date(2021, 2, 23)) -> Path:
+    """
+    Writes every source with polygons polygons in total into root.
+
+    snapshots dated folders (or Athens layers) are written for each source,
+    one week apart, ending at end_date.
+
+    returns root as a Path
+    """
+    root = Path(root)
+    root.mkdir(parents=True, exist_ok=True)
+    rng = np.random.default_rng(seed)
+
+    for snapshot_number in range(snapshots):
+        snapshot = end_date - datetime.timedelta(weeks=snapshots - 1 - snapshot_number)
+        geoms = make_polygons(polygons, vertices, seed=seed + snapshot_number)
+        start = 0
+        for (name, share) in SHARES.items():
+            stop = start + max(1, int(round(polygons * share)))
+            if name == 'towns' and snapshot_number != snapshots - 1:
+                # the towns geodatabase is not dated, only the newest is kept
+                start = stop
+                continue
+            logging.info(f'writing {stop - start} {name} polygons for {snapshot}')
+            WRITERS[name](root, geoms[start:stop], rng, snapshot)
+            start = stop
+    return root
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Writes synthetic municipal limit layers.')
+    parser.add_argument('root', help='folder to write into')
+    parser.add_argument('--polygons', type=int, default=1000, help='total number of polygons')
+    parser.add_argument('--vertices', type=int, default=16, help='vertices in each polygon')
+    parser.add_argument('--snapshots', type=int, default=1, help='dated snapshots of each source')
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args(argv)
+
+    logging.basicConfig(format='%(levelname)s : %(message)s', level=logging.INFO)
+    generate(args.root, args.polygons, args.vertices, args.snapshots, args.seed)
+
+
+if __name__ == '__main__':
+    main()
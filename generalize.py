@@ -0,0 +1,86 @@
+"""
+Topology preserving simplification of the combined layer.
+
+Simplifying each polygon on its own moves the two copies of a shared border
+differently, so neighbouring municipalities end up with slivers and overlaps
+between them.  generalize() simplifies the borders once instead:
+
+  1. the rings of every polygon are noded, so every shared border is one line
+  2. the lines are merged into arcs that run from one junction to the next
+  3. each arc is simplified, its ends (the junctions) do not move
+  4. the arcs are noded again and polygonized into faces
+  5. each face goes back to the rows it is inside of, and the faces of a row are unioned
+
+The result has the same rows and attributes as the input, with simplified geometry.
+"""
+
+from __future__ import annotations
+
+import logging
+from collections import OrderedDict
+from typing import Iterable, Optional
+
+import gislayer
+
+# imports from external libraries, that may have to be installed, loaded when first used
+gpd = gislayer.lazy_import('geopandas')
+np = gislayer.lazy_import('numpy')
+shapely = gislayer.lazy_import('shapely')
+
+# The tolerances, in feet, of the simplified layers that are written with --generalize.
+GENERALIZE_TOLERANCES = (10.0, 50.0, 200.0)
+
+
+def shared_arcs(geoms) -> np.ndarray:
+    """Returns the borders of geoms as arcs between junctions, a shared border is one arc."""
+    import shapely.ops
+    geoms = np.asarray(geoms, dtype=object)
+    polygons = shapely.get_parts(geoms[~shapely.is_missing(geoms)])
+    rings = shapely.get_rings(polygons)
+    # unioning lines nodes them at every crossing and removes the duplicate segments of shared borders
+    noded = shapely.union_all(rings)
+    merged = shapely.ops.linemerge(shapely.get_parts(noded).tolist())
+    return shapely.get_parts(merged)
+
+
+def generalize(gdf: gpd.GeoDataFrame, tolerance: float, workers: Optional[int] = None) -> gpd.GeoDataFrame:
+    """
+    Returns a copy of gdf simplified with tolerance, in the units of its CRS, keeping shared borders shared.
+
+    Rows whose polygons all collapse at this tolerance get an empty geometry.
+    workers is the number of threads the rows are unioned on.
+    """
+    geoms = np.asarray(gdf.geometry.values)
+    arcs = shared_arcs(geoms)
+    simplified = shapely.simplify(arcs, tolerance, preserve_topology=True)
+    # simplified arcs can cross, noding again keeps the faces valid
+    faces = shapely.get_parts(shapely.polygonize(shapely.get_parts(shapely.union_all(simplified))))
+    logging.debug(f'{len(arcs)} arcs, {len(faces)} faces at tolerance {tolerance}')
+
+    # the rows each face is in, a point inside the face is tested against the original polygons
+    points = shapely.point_on_surface(faces)
+    tree = shapely.STRtree(geoms)
+    (face_index, row_index) = tree.query(points, predicate='intersects')
+
+    row_faces = [[] for _ in range(len(gdf))]
+    for (face, row) in zip(face_index, row_index):
+        row_faces[row].append(faces[face])
+
+    def union(parts):
+        return shapely.union_all(parts) if parts else shapely.from_wkt('POLYGON EMPTY')
+
+    if workers is None or workers <= 1:
+        unioned = [union(parts) for parts in row_faces]
+    else:
+        with gislayer.make_pool(workers) as pool:
+            unioned = list(pool.map(union, row_faces))
+
+    generalized = gdf.copy()
+    generalized[gdf.geometry.name] = gpd.GeoSeries(unioned, index=gdf.index, crs=gdf.crs)
+    return generalized
+
+
+def generalize_levels(gdf: gpd.GeoDataFrame, tolerances: Iterable[float] = GENERALIZE_TOLERANCES,
+                      workers: Optional[int] = None) -> OrderedDict:
+    """Returns {tolerance: generalize(gdf, tolerance)} for each tolerance."""
+    return OrderedDict((tolerance, generalize(gdf, tolerance, workers)) for tolerance in tolerances)
@@ -2,18 +2,602 @@
 This has GIS ETL Classes that could be used in other projects.
 """
 
-from typing import Iterable, Optional, Type, Union
+from __future__ import annotations
+
+from typing import Iterable, List, Optional, Type, Union
+import concurrent.futures
+import functools
+import importlib.util
+import json
 import logging
+import math
+import sys
+import threading
+import zipfile
+from pathlib import Path
+
+
+# The modules imported by lazy_import(), see load_lazy_modules().
+_lazy_modules = []
+
+
+def lazy_import(name: str):
+    """
+    Returns the module name, which is only loaded when one of its attributes is first used.
 
-# imports from external libraries, that may have to be installed
-import geopandas as gpd
-import pandas as pd
+    geopandas, pandas, fiona and GDAL take seconds to import, this way commands that
+    do not read any geometry (such as plan and list-snapshots) do not pay for them.
+    A module that is not installed raises ImportError right away, like import does.
+    This is for top level modules only, finding a submodule loads its package.
+    """
+    if name in sys.modules:
+        return sys.modules[name]
+    spec = importlib.util.find_spec(name)
+    if spec is None:
+        raise ModuleNotFoundError(f'No module named {name!r}', name=name)
+    loader = importlib.util.LazyLoader(spec.loader)
+    spec.loader = loader
+    module = importlib.util.module_from_spec(spec)
+    sys.modules[name] = module
+    loader.exec_module(module)
+    _lazy_modules.append(module)
+    return module
+
+
+def load_lazy_modules() -> None:
+    """Loads every module from lazy_import() now, before Python 3.12 two threads loading one at once can clash."""
+    for module in _lazy_modules:
+        # any attribute loads the module
+        module.__name__
+
+
+# imports from external libraries, that may have to be installed, loaded when first used
+fiona = lazy_import('fiona')
+gpd = lazy_import('geopandas')
+np = lazy_import('numpy')
+pd = lazy_import('pandas')
+pyproj = lazy_import('pyproj')
+shapely = lazy_import('shapely')
 
 # This is a workaround for a problem in which shapefiles crs are not read
 # in the first go-around.  This is an bug from the installation on this machine.
 # PERSISTENT_CRS_BUG_WORKAROUND = True
 PERSISTENT_CRS_BUG_WORKAROUND = False
 
+# The engine used to read layers.
+#   'fiona' reads through Fiona one record at a time.
+#   'pyogrio' reads whole columns at a time, through Arrow when pyarrow is installed.
+# If pyogrio is not installed, 'pyogrio' falls back to 'fiona'.
+DEFAULT_ENGINE = 'fiona'
+ENGINES = ('fiona', 'pyogrio')
+
+# Number of workers combine_geometry_multipart() uses to union geometries.
+# None or 1 unions the whole layer in one call.
+UNION_WORKERS = None
+# Layers with fewer geometries than this are always unioned in one call.
+PARTITIONED_UNION_MIN_GEOMETRIES = 500
+
+# Rows read at a time by GISLayer, so a layer with millions of features is never in memory whole.
+# None reads the whole layer at once.
+CHUNK_ROWS = None
+
+
+@functools.lru_cache(maxsize=None)
+def module_available(name: str) -> bool:
+    return importlib.util.find_spec(name) is not None
+
+
+def resolve_engine(engine: Optional[str] = None) -> str:
+    """Returns the engine that will actually be used to read a layer."""
+    if engine is None:
+        engine = DEFAULT_ENGINE
+    if engine not in ENGINES:
+        raise ValueError(f"engine must be one of {ENGINES}, not {engine!r}")
+    if engine == 'pyogrio' and not module_available('pyogrio'):
+        logging.warning("pyogrio is not installed, reading with fiona instead")
+        engine = 'fiona'
+    return engine
+
+
+VSIZIP_PREFIX = '/vsizip/'
+
+
+def vsizip_path(zip_path, member: str) -> str:
+    """
+    Returns the GDAL virtual file system path of member inside zip_path.
+
+    This is kept as a string, a Path would merge the // of an absolute zip path.
+    """
+    return f'{VSIZIP_PREFIX}{Path(zip_path).as_posix()}/{member}'
+
+
+def vsi_archive(filename) -> Path:
+    """Returns the file on disk, the archive for a /vsizip/ path, otherwise filename as a Path."""
+    filename = str(filename)
+    if not filename.startswith(VSIZIP_PREFIX):
+        return Path(filename)
+    inner = filename[len(VSIZIP_PREFIX):]
+    index = inner.lower().find('.zip')
+    if index == -1:
+        raise ValueError(f'no .zip archive in {filename}')
+    return Path(inner[:index + len('.zip')])
+
+
+def dataset_folder(filename) -> Path:
+    """Returns the folder on disk that holds a dataset, for a zipped dataset the folder of the archive."""
+    return vsi_archive(filename).parent
+
+
+def find_in_zip(zip_path, suffix: str) -> Optional[str]:
+    """
+    Returns the /vsizip/ path of the first dataset in the archive whose name ends with suffix.
+
+    suffix is '.shp' for a shapefile or '.gdb' for a File GeoDatabase folder.
+    """
+    with zipfile.ZipFile(zip_path) as archive:
+        names = sorted(archive.namelist())
+    suffix = suffix.lower()
+    for name in names:
+        if name.lower().endswith(suffix):
+            return vsizip_path(zip_path, name)
+        # a folder in the archive, such as Limits.gdb/a00000001.gdbtable
+        for part in name.split('/')[:-1]:
+            if part.lower().endswith(suffix):
+                return vsizip_path(zip_path, name[:name.index(part) + len(part)])
+    return None
+
+
+def find_shapefile(folder, prefer_archives: bool = False) -> Optional[Union[Path, str]]:
+    """
+    Returns the shapefile in folder, or the /vsizip/ path of a shapefile in a zip archive in folder.
+
+    The extracted shapefile is used when there are both, unless prefer_archives is True.
+    Returns None if there is no shapefile.
+    """
+    folder = Path(folder)
+    shapefiles = sorted(folder.glob('*.shp'))
+    if shapefiles and not prefer_archives:
+        return shapefiles[0]
+    for zip_path in sorted(folder.glob('*.zip')):
+        try:
+            found = find_in_zip(zip_path, '.shp')
+        except zipfile.BadZipFile:
+            logging.warning(f'{zip_path} is not a zip file')
+            continue
+        if found is not None:
+            return found
+    return shapefiles[0] if shapefiles else None
+
+
+def list_fields(filename, layer: Optional[str] = None, engine: Optional[str] = None) -> List[str]:
+    """Returns the names of the attribute fields in a layer without reading any features."""
+    if resolve_engine(engine) == 'pyogrio':
+        import pyogrio
+        return list(pyogrio.read_info(filename, layer=layer)['fields'])
+
+    with fiona.open(filename, layer=layer) as src:
+        return list(src.schema['properties'])
+
+
+def read_field_values(filename, field: str, layer: Optional[str] = None, where: Optional[str] = None,
+                      engine: Optional[str] = None) -> list:
+    """
+    Returns the values of one field for every row of a layer, without reading any geometry.
+
+    where is an SQL WHERE clause given to the driver, such as "MUNITYP = 'Town'".
+    The other fields are only left out without a where, the driver cannot filter
+    on a field it was told to ignore.  Neither engine loads geopandas or pandas for this.
+    """
+    if resolve_engine(engine) == 'pyogrio':
+        import pyogrio.raw
+        (meta, _, _, field_data) = pyogrio.raw.read(filename, layer=layer, read_geometry=False, where=where,
+                                                    columns=[field] if where is None else None)
+        return list(field_data[list(meta['fields']).index(field)])
+
+    ignore_fields = None
+    if where is None:
+        with fiona.open(filename, layer=layer) as src:
+            ignore_fields = [f for f in src.schema['properties'] if f != field]
+    with fiona.open(filename, layer=layer, ignore_fields=ignore_fields, ignore_geometry=True) as src:
+        features = src.filter(where=where) if where is not None else src
+        return [feature['properties'][field] for feature in features]
+
+
+def iter_file_chunks(filename, chunk_size: int, driver: Optional[str] = None, layer: Optional[str] = None,
+                     engine: Optional[str] = None, columns: Optional[Iterable[str]] = None,
+                     where: Optional[str] = None):
+    """
+    Yields a layer chunk_size rows at a time, as GeoDataFrames, see read_file() for the arguments.
+
+    The layer is read once from start to end with one cursor: with fiona one iterator
+    of the (filtered) features, with pyogrio the Arrow record batches of open_arrow()
+    (without pyarrow, fiona is used).  At least one GeoDataFrame is yielded, an empty
+    layer gives one with no rows.
+    """
+    engine = resolve_engine(engine)
+    fields = list_fields(filename, layer=layer, engine=engine)
+    if columns is not None:
+        columns = [c for c in columns if c in fields]
+
+    if engine == 'pyogrio' and module_available('pyarrow'):
+        chunks = _iter_arrow_chunks(filename, chunk_size, layer=layer, columns=columns, where=where)
+    else:
+        ignore_fields = None if columns is None else [f for f in fields if f not in columns]
+        chunks = _iter_fiona_chunks(filename, chunk_size, driver=driver, layer=layer,
+                                    ignore_fields=ignore_fields, where=where)
+    for gdf in chunks:
+        if columns is not None:
+            gdf = gdf[columns + [gdf.geometry.name]]
+        yield gdf
+
+
+def _iter_fiona_chunks(filename, chunk_size: int, driver: Optional[str] = None, layer: Optional[str] = None,
+                       ignore_fields: Optional[List[str]] = None, where: Optional[str] = None):
+    """iter_file_chunks() with fiona, the features are batched from one iterator."""
+    import itertools
+    with fiona.open(filename, driver=driver, layer=layer, ignore_fields=ignore_fields) as src:
+        features = src.filter(where=where) if where is not None else iter(src)
+        first = True
+        while True:
+            batch = list(itertools.islice(features, chunk_size))
+            if batch or first:
+                yield _fiona_frame(src, batch, ignore_fields)
+            if len(batch) < chunk_size:
+                return
+            first = False
+
+
+def _iter_arrow_chunks(filename, chunk_size: int, layer: Optional[str] = None,
+                       columns: Optional[List[str]] = None, where: Optional[str] = None):
+    """iter_file_chunks() with pyogrio, one GeoDataFrame for each Arrow record batch."""
+    import inspect
+    import pyogrio.raw
+    kwargs = {}
+    if 'use_pyarrow' in inspect.signature(pyogrio.raw.open_arrow).parameters:
+        # pyogrio 0.8+ gives an Arrow stream capsule unless it is asked for a pyarrow reader
+        kwargs['use_pyarrow'] = True
+    with pyogrio.raw.open_arrow(filename, layer=layer, columns=columns, where=where, batch_size=chunk_size,
+                                **kwargs) as (meta, reader):
+        geometry_column = meta['geometry_name'] or 'wkb_geometry'
+
+        def frame(batch):
+            df = batch.to_pandas()
+            geoms = shapely.from_wkb(df.pop(geometry_column).to_numpy())
+            return gpd.GeoDataFrame(df, geometry=geoms, crs=meta['crs'])
+
+        empty = True
+        for batch in reader:
+            if batch.num_rows > 0:
+                empty = False
+                yield frame(batch)
+        if empty:
+            yield frame(reader.schema.empty_table())
+
+
+def _fiona_frame(src, features, ignore_fields: Optional[List[str]] = None) -> gpd.GeoDataFrame:
+    """Returns the features of the open fiona collection src as a GeoDataFrame, like geopandas.read_file()."""
+    properties = src.schema['properties']
+    columns = [f for f in properties if not ignore_fields or f not in ignore_fields] + ['geometry']
+    gdf = gpd.GeoDataFrame.from_features(features, crs=src.crs_wkt, columns=columns)
+    # like geopandas.read_file() with fiona, datetime fields are parsed
+    for (field, kind) in properties.items():
+        if field in gdf and kind == 'datetime':
+            gdf[field] = pd.to_datetime(gdf[field], errors='ignore')
+    return gdf
+
+
+def _read_fiona_where(filename, where: str, driver: Optional[str] = None, layer: Optional[str] = None,
+                      ignore_fields: Optional[List[str]] = None) -> gpd.GeoDataFrame:
+    """
+    Reads the rows of a layer matching the SQL WHERE clause where with fiona (1.9 and newer).
+
+    geopandas 0.12 only hands where to pyogrio, this filters in the driver like
+    read_field_values() does, so the rows that do not match are never decoded.
+    """
+    with fiona.open(filename, driver=driver, layer=layer, ignore_fields=ignore_fields) as src:
+        return _fiona_frame(src, src.filter(where=where), ignore_fields)
+
+
+def read_file(filename, driver: Optional[str] = None, layer: Optional[str] = None,
+              engine: Optional[str] = None, columns: Optional[Iterable[str]] = None,
+              where: Optional[str] = None, **kwargs) -> gpd.GeoDataFrame:
+    """
+    Reads a layer into a GeoDataFrame with the chosen engine.
+
+    columns is a list of the attribute fields to read, fields not in the layer are skipped.
+    where is an SQL WHERE clause given to the driver, such as "MUNITYP = 'Town'",
+    with either engine only the matching rows are read.
+
+    Extra keyword arguments are passed to geopandas.read_file(), but not with where
+    and the fiona engine (see _read_fiona_where()).  To read a layer a part at a time,
+    see iter_file_chunks().
+    """
+    engine = resolve_engine(engine)
+
+    if columns is not None:
+        fields = list_fields(filename, layer=layer, engine=engine)
+        columns = [c for c in columns if c in fields]
+
+    if engine == 'pyogrio':
+        # GDAL works out the driver on its own, pyogrio does not take one.
+        if module_available('pyarrow'):
+            kwargs.setdefault('use_arrow', True)
+        if columns is not None:
+            kwargs['columns'] = columns
+        if where is not None:
+            kwargs['where'] = where
+        return gpd.read_file(filename, layer=layer, engine='pyogrio', **kwargs)
+
+    if columns is not None:
+        # fiona does not decode the ignored fields, but still gives them as empty columns
+        kwargs['ignore_fields'] = [f for f in fields if f not in columns]
+
+    if where is not None:
+        read = functools.partial(_read_fiona_where, filename, where, driver=driver, layer=layer, **kwargs)
+    else:
+        read = functools.partial(gpd.read_file, filename, driver=driver, layer=layer, engine='fiona', **kwargs)
+    if PERSISTENT_CRS_BUG_WORKAROUND is True:
+        tmp = read()
+        del tmp
+    gdf = read()
+
+    if columns is not None:
+        gdf = gdf[columns + [gdf.geometry.name]]
+    return gdf
+
+
+# Caches for the reprojection functions below.  pyproj CRS objects are shared
+# between threads, but a Transformer is not thread-safe, so each thread has its own.
+_crs_cache = {}
+_crs_equal_cache = {}
+_crs_lock = threading.Lock()
+_transformers = threading.local()
+
+
+def _crs_key(crs) -> str:
+    """Returns a hashable key for anything pyproj.CRS.from_user_input() accepts."""
+    if isinstance(crs, pyproj.CRS):
+        return crs.srs
+    if isinstance(crs, dict):
+        return json.dumps(crs, sort_keys=True)
+    return str(crs)
+
+
+def get_crs(crs) -> pyproj.CRS:
+    """Returns a pyproj.CRS for crs, only building it the first time it is asked for."""
+    if isinstance(crs, pyproj.CRS):
+        return crs
+    key = _crs_key(crs)
+    with _crs_lock:
+        if key not in _crs_cache:
+            _crs_cache[key] = pyproj.CRS.from_user_input(crs)
+        return _crs_cache[key]
+
+
+def crs_equal(crs1, crs2) -> bool:
+    """Returns True if crs1 and crs2 are the same CRS.  The answer is cached."""
+    if crs1 is None or crs2 is None:
+        return crs1 is None and crs2 is None
+    key = (_crs_key(crs1), _crs_key(crs2))
+    if key[0] == key[1]:
+        return True
+    with _crs_lock:
+        if key in _crs_equal_cache:
+            return _crs_equal_cache[key]
+    equal = get_crs(crs1) == get_crs(crs2)
+    with _crs_lock:
+        _crs_equal_cache[key] = equal
+    return equal
+
+
+def get_transformer(from_crs, to_crs) -> pyproj.Transformer:
+    """Returns this thread's Transformer from from_crs to to_crs, in x, y (lon, lat) order."""
+    if not hasattr(_transformers, 'cache'):
+        _transformers.cache = {}
+    key = (_crs_key(from_crs), _crs_key(to_crs))
+    transformer = _transformers.cache.get(key)
+    if transformer is None:
+        transformer = pyproj.Transformer.from_crs(get_crs(from_crs), get_crs(to_crs), always_xy=True)
+        _transformers.cache[key] = transformer
+    return transformer
+
+
+def reproject(gdf: gpd.GeoDataFrame, crs) -> gpd.GeoDataFrame:
+    """
+    Returns gdf reprojected to crs, like gdf.to_crs(crs).
+
+    When gdf is already in crs its coordinates are kept, but it is given the cached
+    CRS object of crs.  Two CRS that are equal can hash differently, and geopandas
+    will not concat layers whose CRS objects differ.  The Transformer is cached,
+    and all of the coordinates are transformed in one call with shapely 2.
+    """
+    if gdf.crs is None:
+        raise ValueError("Cannot reproject a layer without a CRS")
+    if crs_equal(gdf.crs, crs):
+        return gdf.set_crs(get_crs(crs), allow_override=True)
+
+    transformer = get_transformer(gdf.crs, crs)
+
+    def transform_coords(coords):
+        return np.column_stack(transformer.transform(coords[:, 0], coords[:, 1]))
+
+    geoms = shapely.transform(np.asarray(gdf.geometry.values), transform_coords)
+    reprojected = gdf.copy()
+    reprojected[gdf.geometry.name] = gpd.GeoSeries(geoms, index=gdf.index, crs=get_crs(crs))
+    return reprojected
+
+
+def frames_equal(gdf1: gpd.GeoDataFrame, gdf2: gpd.GeoDataFrame) -> bool:
+    """Returns True if two GeoDataFrames have the same columns, CRS, values and geometry, row by row."""
+    if len(gdf1) != len(gdf2) or list(gdf1.columns) != list(gdf2.columns) or not crs_equal(gdf1.crs, gdf2.crs):
+        return False
+    geometry_name = gdf1.geometry.name
+    if not gdf1.drop(columns=geometry_name).reset_index(drop=True).equals(
+            gdf2.drop(columns=geometry_name).reset_index(drop=True)):
+        return False
+    return bool(gdf1.geometry.reset_index(drop=True).geom_equals_exact(
+        gdf2.geometry.reset_index(drop=True), tolerance=0).all())
+
+
+def make_pool(workers: int, executor: str = 'thread', initializer=None,
+              initargs: tuple = ()) -> concurrent.futures.Executor:
+    """Returns a thread ('thread') or process ('process') pool with workers workers."""
+    load_lazy_modules()
+    if executor == 'process':
+        return concurrent.futures.ProcessPoolExecutor(max_workers=workers, initializer=initializer,
+                                                      initargs=initargs)
+    if executor == 'thread':
+        return concurrent.futures.ThreadPoolExecutor(max_workers=workers, initializer=initializer,
+                                                     initargs=initargs)
+    raise ValueError(f"executor must be 'thread' or 'process', not {executor!r}")
+
+
+def _union(geoms):
+    import shapely.ops
+    return shapely.ops.unary_union(list(geoms))
+
+
+def _subtract(geom, others):
+    """Returns geom with the union of the geometries in others removed."""
+    if len(others) == 0:
+        return geom
+    import shapely.ops
+    return geom.difference(shapely.ops.unary_union(list(others)))
+
+
+def partition_by_grid(geoms: gpd.GeoSeries, tiles: int) -> List[np.ndarray]:
+    """
+    Splits geoms into about tiles groups of nearby geometries.
+
+    Each geometry goes in the grid cell that the center of its bounding box
+    falls in.  The groups are returned in row major order of the grid, so
+    groups next to each other in the list are usually next to each other
+    on the ground.  geoms must not have empty or missing geometries, their
+    bounds are NaN.
+    """
+    bounds = geoms.bounds
+    cx = ((bounds['minx'] + bounds['maxx']) / 2).to_numpy()
+    cy = ((bounds['miny'] + bounds['maxy']) / 2).to_numpy()
+    n = max(1, int(math.ceil(math.sqrt(tiles))))
+
+    def cell(values):
+        span = values.max() - values.min()
+        if span == 0:
+            return np.zeros(len(values), dtype=int)
+        return np.minimum(((values - values.min()) / span * n).astype(int), n - 1)
+
+    cell_index = cell(cy) * n + cell(cx)
+    order = np.argsort(cell_index, kind='stable')
+    # split the sorted positions where the cell changes
+    splits = np.flatnonzero(np.diff(cell_index[order])) + 1
+    return np.split(order, splits)
+
+
+def partitioned_union(geoms, workers: Optional[int] = None, tiles: Optional[int] = None,
+                      executor: str = 'thread'):
+    """
+    Unions geoms the same way as unary_union, using a pool of workers.
+
+    The geometries are split into tiles of nearby geometries, each tile is
+    unioned in the pool, then neighboring partial results are unioned in
+    pairs until one geometry is left.  GEOS releases the GIL, so a thread
+    pool works.
+    """
+    geoms = gpd.GeoSeries(geoms).reset_index(drop=True)
+    if workers is None:
+        workers = UNION_WORKERS
+    if workers is None or workers <= 1 or len(geoms) < PARTITIONED_UNION_MIN_GEOMETRIES:
+        return geoms.unary_union
+    # they add nothing to the union, and have no bounds to partition them by
+    geoms = geoms[geoms.notna() & ~geoms.is_empty].reset_index(drop=True)
+    if len(geoms) < PARTITIONED_UNION_MIN_GEOMETRIES:
+        return geoms.unary_union
+
+    if tiles is None:
+        tiles = workers * 4
+    groups = partition_by_grid(geoms, tiles)
+    logging.debug(f'unioning {len(geoms)} geometries in {len(groups)} tiles with {workers} workers')
+
+    values = geoms.values
+    with make_pool(workers, executor) as pool:
+        parts = list(pool.map(_union, [values[g] for g in groups]))
+        # hierarchical merge, neighbors first
+        while len(parts) > 1:
+            pairs = [parts[i:i + 2] for i in range(0, len(parts), 2)]
+            parts = list(pool.map(_union, pairs))
+    return parts[0]
+
+
+def polygonal_parts(geoms: np.ndarray) -> np.ndarray:
+    """
+    Returns geoms as MultiPolygons, with everything but their polygons dropped, None where nothing is left.
+
+    Such as the lines and points an intersection gives where two polygons only touch.
+    """
+    (parts, index) = shapely.get_parts(geoms, return_index=True)
+    # two levels, for a collection that holds a multipolygon
+    (parts, part_index) = shapely.get_parts(parts, return_index=True)
+    index = index[part_index]
+    keep = (shapely.get_type_id(parts) == shapely.GeometryType.POLYGON) & ~shapely.is_empty(parts)
+    result = np.full(len(geoms), None, dtype=object)
+    if keep.any():
+        shapely.multipolygons(parts[keep], indices=index[keep], out=result)
+    return result
+
+
+def _polygon_parts(gdf: gpd.GeoDataFrame) -> gpd.GeoSeries:
+    """Returns the single part polygons of a layer, without empty geometries."""
+    geoms = gdf.geometry[gdf.geometry.notna() & ~gdf.geometry.is_empty]
+    return geoms.explode(index_parts=False).reset_index(drop=True)
+
+
+def diff_layers(old_gdf: gpd.GeoDataFrame, new_gdf: gpd.GeoDataFrame, min_area: float = 0.0,
+                workers: Optional[int] = None) -> gpd.GeoDataFrame:
+    """
+    Returns the areas added to and removed from a layer between two versions of it.
+
+    The polygon parts that are the same in both versions (by their normalized WKB)
+    are passed through without an overlay.  Each other part only has the parts of
+    the other version that intersect it, found with a spatial index, subtracted.
+    Pieces smaller than min_area, in the units of the CRS, are left out.
+
+    returns a GeoDataFrame in the CRS of new_gdf with a 'change' column, 'added' or
+    'removed', and an 'area' column, with one row for each polygon
+    """
+    old_gdf = reproject(old_gdf, new_gdf.crs)
+    old_parts = _polygon_parts(old_gdf)
+    new_parts = _polygon_parts(new_gdf)
+    old_keys = shapely.to_wkb(shapely.normalize(np.asarray(old_parts.values)))
+    new_keys = shapely.to_wkb(shapely.normalize(np.asarray(new_parts.values)))
+    unchanged = set(old_keys) & set(new_keys)
+    logging.debug(f'{len(unchanged)} polygons are unchanged')
+
+    changes = []
+    geoms = []
+    for (change, parts, keys, other_parts) in (('removed', old_parts, old_keys, new_parts),
+                                               ('added', new_parts, new_keys, old_parts)):
+        changed = [part for (part, key) in zip(parts.values, keys) if key not in unchanged]
+        if not changed:
+            continue
+        others = other_parts.values
+        sindex = other_parts.sindex
+        jobs = [(part, others[sindex.query(part, predicate='intersects')]) for part in changed]
+        if workers is None or workers <= 1:
+            differences = [_subtract(part, candidates) for (part, candidates) in jobs]
+        else:
+            with make_pool(workers) as pool:
+                differences = list(pool.map(_subtract, *zip(*jobs)))
+        for difference in differences:
+            for piece in getattr(difference, 'geoms', [difference]):
+                if piece.geom_type == 'Polygon' and not piece.is_empty and piece.area > min_area:
+                    changes.append(change)
+                    geoms.append(piece)
+
+    diff = gpd.GeoDataFrame({'change': changes}, geometry=geoms, crs=new_gdf.crs)
+    diff['area'] = diff.area
+    return diff
+
+
 class EmptyGISLayer(object):
     """
     This class is a framework for functionality that is defined in
@@ -30,6 +614,14 @@ class EmptyGISLayer(object):
 
         if not hasattr(self, 'required_fields'):
             self.required_fields = tuple()
+
+        # attribute fields to read, None reads all of them
+        if not hasattr(self, 'read_columns'):
+            self.read_columns = None
+
+        # SQL WHERE clause handed to the driver when the layer is read
+        if not hasattr(self, 'read_where'):
+            self.read_where = None
             
        
     def add_fields(self):
@@ -56,9 +648,24 @@ class EmptyGISLayer(object):
 
 class GISLayer(EmptyGISLayer):
     """This add basically"""
-    def __init__(self, filename=None, driver: Optional[str] = None, layer: Optional[str] = None, gdf=None):
+    def __init__(self, filename=None, driver: Optional[str] = None, layer: Optional[str] = None, gdf=None,
+                 engine: Optional[str] = None, columns: Optional[Iterable[str]] = None,
+                 where: Optional[str] = None, chunk_size: Optional[int] = None):
+        """
+        chunk_size (by default CHUNK_ROWS) is the number of rows read at a time.  When it is set,
+        the file is not read here and self.gdf is None, iter_chunks() reads it a chunk at a time.
+        """
         EmptyGISLayer.__init__(self)
         self.filename = filename
+        self.engine = engine
+        self.chunk_size = CHUNK_ROWS if chunk_size is None else chunk_size
+        # arguments override what the derived class declared
+        if columns is not None:
+            self.read_columns = columns
+        if where is not None:
+            self.read_where = where
+        # True when the driver has already filtered the rows with self.read_where
+        self.where_applied = False
         
         # check if parameters are interables and not a string
         if not hasattr(self.add_fields_list,'__iter__') and not isinstance(self.add_fields_list, str):
@@ -75,14 +682,34 @@ class GISLayer(EmptyGISLayer):
         # self.gdf = gpd.GeoDataFrame.from_file(filename, driver, layer)
         elif self.filename == None:
             self.gdf = gpd.GeoDataFrame()
+        elif self.chunk_size is not None:
+            self.read_kwargs = dict(driver=driver, layer=layer, engine=resolve_engine(engine))
+            self.gdf = None
         else:
-            if PERSISTENT_CRS_BUG_WORKAROUND is True:
-                tmp = gpd.read_file(self.filename, driver=driver, layer=layer)
-                del tmp
-            self.gdf = gpd.read_file(self.filename, driver=driver, layer=layer)
+            engine = resolve_engine(engine)
+            self.gdf = read_file(self.filename, driver=driver, layer=layer, engine=engine,
+                                 columns=self.columns_to_read(), where=self.read_where)
+            self.where_applied = self.read_where is not None
             logging.info("reading {0}".format(self.filename))
         
-        self.check_required_fields()
+        if self.gdf is not None:
+            self.check_required_fields()
+
+    def columns_to_read(self) -> Optional[List[str]]:
+        """Returns the fields to read, None for all of them.  The required fields are always read."""
+        if self.read_columns is None:
+            return None
+        return list(self.read_columns) + [f for f in self.required_fields if f not in self.read_columns]
+
+    def iter_chunks(self):
+        """Yields the file self.chunk_size rows at a time, checking the required fields of each chunk."""
+        logging.info(f"reading {self.filename} {self.chunk_size} rows at a time")
+        self.where_applied = self.read_where is not None
+        for gdf in iter_file_chunks(self.filename, self.chunk_size, columns=self.columns_to_read(),
+                                    where=self.read_where, **self.read_kwargs):
+            self.gdf = gdf
+            self.check_required_fields()
+            yield gdf
         
     def check_required_fields(self) -> None:
         """
@@ -149,34 +776,85 @@ class GISLayer(EmptyGISLayer):
         joined = pd.concat(layers_gdf)
         return GISLayer(gdf=joined)
 
-    def combine_geometry_multipart(self):
+    def combine_geometry_multipart(self, by: Optional[Union[str, List[str]]] = None,
+                                   workers: Optional[int] = None):
         """ combines all the geometry in a layer into one row with a Multipolygon.
         
         This is also called singlepart geometry to multipart geometry.
-        
+
+        by is a field name (or list of field names), when given there is one row
+        for each distinct value instead of one row for the layer.
+        workers is the number of workers for partitioned_union(), by default UNION_WORKERS.
         """
-        # this is a type shapely.geometry.multipolygon.MultiPolygon
-        union_geom = self.gdf.unary_union  
+        if len(self.gdf) == 0:
+            # nothing to combine, such as a chunk with no rows left after filtering
+            return
+        geometry_name = self.gdf.geometry.name
+        if by is None:
+            groups = [self.gdf]
+        else:
+            # rows with an empty value of by are a group of their own, not dropped
+            groups = [group for (_, group) in self.gdf.groupby(by, sort=False, dropna=False)]
+
+        rows = []
+        union_geoms = []
+        for group in groups:
+            # this is a type shapely.geometry.multipolygon.MultiPolygon
+            union_geoms.append(partitioned_union(group.geometry, workers=workers))
         
-        # copies first record's properties, not ideal
-        properties = self.gdf.iloc[0].to_dict()
-        del properties['geometry']
+            # copies first record's properties, not ideal
+            properties = group.iloc[0].to_dict()
+            del properties[geometry_name]
+            rows.append(properties)
         
         # using pygeoif is to make this into features is a bit hackish
         # shapely does not support features
         # feature = pygeoif.Feature(pygeoif.MultiPolygon(uni), props)
         
         # create a new GeoDataFrame with the union geometry and properties
-        self.gdf = gpd.GeoDataFrame(data=[properties], geometry=[union_geom], crs=self.gdf.crs)
+        self.gdf = gpd.GeoDataFrame(data=rows, geometry=union_geoms, crs=self.gdf.crs)
     
     def clip(self, clip_layer):
+        """
+        Clips this layer to the area covered by clip_layer (a GISLayer or GeoDataFrame).
+
+        The spatial index drops the features that do not touch clip_layer.
+        Features fully inside clip_layer are passed through unchanged, so the
+        intersection is only computed for features that cross its boundary.
+
+        returns a new GISLayer object, with the attributes intact
+        """
+        if isinstance(clip_layer, GISLayer):
+            clip_layer = clip_layer.gdf
+
         # reproject if projection is different from county_boundary
-        if clip_layer.crs != self.gdf.crs:
-            clip_layer = clip_layer.to_crs(crs=self.gdf.crs)
-        
+        clip_layer = reproject(clip_layer, self.gdf.crs)
         
-        return self.gdf['geometry'].intersection(clip_layer.unary_union)
+        clip_geom = clip_layer.unary_union
+
+        # positions of the features whose geometry intersects clip_geom
+        candidates = np.sort(self.gdf.sindex.query(clip_geom, predicate='intersects'))
+        clipped = self.gdf.iloc[candidates].copy()
+        
+        geoms = np.asarray(clipped.geometry.values)
+        shapely.prepare(clip_geom)
+        crossing = ~shapely.contains_properly(clip_geom, geoms)
+        logging.debug(f'clip: {len(self.gdf)} features, {len(candidates)} intersect, {crossing.sum()} cross the boundary')
+        
+        if crossing.any():
+            new_geoms = geoms.copy()
+            # only the polygons of the intersection, not the lines and points where a feature runs along the boundary
+            new_geoms[crossing] = polygonal_parts(shapely.intersection(geoms[crossing], clip_geom))
+            clipped[clipped.geometry.name] = gpd.GeoSeries(new_geoms, index=clipped.index, crs=self.gdf.crs)
+            # features that only touch the boundary have nothing left
+            clipped = clipped[clipped.geometry.notna() & ~clipped.geometry.is_empty]
+
+        return GISLayer(gdf=clipped)
     
+    def to_crs(self, crs) -> None:
+        """Reprojects the layer to crs in place, see reproject()."""
+        self.gdf = reproject(self.gdf, crs)
+
     def delete_fields (self):
         logging.debug('delete_fields() called')
         EmptyGISLayer.delete_fields(self)
@@ -208,63 +886,103 @@ class ServiceAreaLayer(object):
     # this could also be accomplished in this manner
     # geopandas.tools.overlay(county_boundary_102630, municipal_boundaries, 'difference')
     # followed by a singlepart -> multipart conversion
-    def county_service_area_mask(self, county_boundary, other_service_areas):
+    def county_service_area_mask(self, county_boundary, other_service_areas,
+                                 workers: Optional[int] = None, executor: str = 'thread'):
         """
         Creates a mask that shows only the portion in the county.
-        
+
+        county_boundary can have any number of rows and multipart geometries.
+        Each part of each row only has the service areas that intersect it 
+        subtracted, which are found with a spatial index.  When workers is more
+        than 1, the parts are done on a pool.
         """
         
         # this does a spatial difference algorithm
         
-        # BIG ASSUMPTION the county boundary is one polygon,
-        # geopandas (or me) does not seem to be able to get this to work
-        # otherwise
-        if len(county_boundary.index) != 1:
-            raise ValueError("county_boundary can only have one row, is has {} rows".format(len(county_boundary.index)))
-        
         # reproject if projection is different from county_boundary
-        if other_service_areas.crs != county_boundary.crs:
-            other_service_areas = other_service_areas.to_crs(crs=county_boundary.crs)
+        other_service_areas = reproject(other_service_areas, county_boundary.crs)
         
-        
-        other_service_areas_flat = gpd.GeoSeries(other_service_areas.geometry.unary_union, crs=county_boundary.crs)
+        # index is (row position, part number)
+        parts = county_boundary.geometry.reset_index(drop=True).explode(index_parts=True)
+        others = other_service_areas.geometry.values
+        sindex = other_service_areas.sindex
+        jobs = [(part, others[sindex.query(part, predicate='intersects')]) for part in parts.values]
+
+        if workers is None or workers <= 1:
+            masked_parts = [_subtract(part, candidates) for (part, candidates) in jobs]
+        else:
+            with make_pool(workers, executor) as pool:
+                masked_parts = list(pool.map(_subtract, *zip(*jobs)))
+
+        # put the parts of each row back together
+        row_parts = [[] for _ in range(len(county_boundary))]
+        for (row, geom) in zip(parts.index.get_level_values(0), masked_parts):
+            row_parts[row].append(geom)
         
         service_area = county_boundary.copy()
         
         # replace geometry, leave attributes intact
-        service_area.geometry = county_boundary.difference(other_service_areas_flat)
+        service_area.geometry = gpd.GeoSeries([_union(p) for p in row_parts],
+                                              index=county_boundary.index, crs=county_boundary.crs)
         
         return service_area
     
-    def service_area_from_spreadsheet(self, county_boundary, 
-                                      other_service_areas, spreadsheet_filename, sheet_name, key='GNIS', delete_fields='county_boundary'):
+    def service_area_from_spreadsheet(self, county_boundary, other_service_areas, spreadsheet_filename, sheet_name,
+                                      key='GNIS', delete_fields='county_boundary', cache_folder=None):
         """
         Creates a service area based on a spreadsheet and geometry.
+
+        The service areas with 'Yes' in the DifferentJurisdictionfromCounty field of
+        the sheet come first, then county_boundary, both joined to the sheet on key.
+        The parsed sheet is cached in a folder in cache_folder, see layercache.read_sheets().
+        """
+        jobs = [(county_boundary, other_service_areas, sheet_name)]
+        return self.service_areas_from_spreadsheet(jobs, spreadsheet_filename, key=key, delete_fields=delete_fields,
+                                                   cache_folder=cache_folder)[0]
+
+    def service_areas_from_spreadsheet(self, jobs, spreadsheet_filename, key='GNIS',
+                                       delete_fields='county_boundary', cache_folder=None) -> list:
+        """
+        service_area_from_spreadsheet() for many counties or sheets in one call.
+
+        jobs is a list of (county_boundary, other_service_areas, sheet_name).  The workbook
+        is parsed at most once for all of the sheets, and each sheet is indexed on key once.
+
+        returns the service area of each job, in the same order
         """
+        # layercache imports this module, so it is imported here
+        import layercache
+
+        jobs = list(jobs)
+        sheets = layercache.read_sheets(spreadsheet_filename, dict.fromkeys(job[2] for job in jobs), cache_folder)
+        # a key that is in the sheet more than once joins each of its rows, like pd.merge()
+        indexed = {name: sheet.set_index(key) for (name, sheet) in sheets.items()}
+        return [self._join_sheet(county_boundary, other_service_areas, indexed[sheet_name], key, delete_fields)
+                for (county_boundary, other_service_areas, sheet_name) in jobs]
+
+    @staticmethod
+    def _join_sheet(county_boundary, other_service_areas, sheet, key, delete_fields):
+        """The join of service_area_from_spreadsheet(), sheet is indexed on key."""
         # this could probably be made more generic
-        
+        geometry_name = county_boundary.geometry.name
+
         # deletes fields
         if 'county_boundary' in delete_fields:
-            remove_fields = list(county_boundary.keys())
-            remove_fields.remove(key)
-            remove_fields.remove('geometry')
-            county_boundary.drop(remove_fields)
+            county_boundary = county_boundary[[key, geometry_name]]
 
         # reproject if projection is different from county_boundary
-        if other_service_areas.crs != county_boundary.crs:
-            other_service_areas = other_service_areas.to_crs(crs=county_boundary.crs)
+        other_service_areas = reproject(other_service_areas, county_boundary.crs)
+        if other_service_areas.geometry.name != geometry_name:
+            other_service_areas = other_service_areas.rename_geometry(geometry_name)
+
+        # left joins on the index of the sheet, with the column names pd.merge() gave
+        other_service_areas_joined = other_service_areas.join(sheet, on=key, lsuffix='_x', rsuffix='_y')
 
-        spreadsheet = pd.read_excel(spreadsheet_filename, sheet_name)
-            
-        other_service_areas_joined = pd.merge(other_service_areas, spreadsheet, how='left', on=key)
-        
         # filter out ones that do not have 'Yes' in DifferentJurisdictionfromCounty field
-        filtered_service_areas = other_service_areas_joined[ other_service_areas_joined['DifferentJurisdictionfromCounty'] == 'Yes' ]
+        filtered_service_areas = other_service_areas_joined[
+            other_service_areas_joined['DifferentJurisdictionfromCounty'] == 'Yes']
 
-        
-        county_boundary_joined = pd.merge(county_boundary, spreadsheet, how='left', on=key)
-        
-        # append geodataframes
-        ret = filtered_service_areas.append(county_boundary_joined)
-        return ret
+        county_boundary_joined = county_boundary.join(sheet, on=key, lsuffix='_x', rsuffix='_y')
 
+        joined = pd.concat([filtered_service_areas, county_boundary_joined], ignore_index=True)
+        return gpd.GeoDataFrame(joined, geometry=geometry_name, crs=county_boundary.crs)
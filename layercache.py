@@ -0,0 +1,328 @@
+"""
+An on-disk cache of processed layers.
+
+A layer is stored as GeoParquet after it has been geoprocessed.  The key covers
+the source files (size, modification time and content hash), the layer class,
+the target CRS and the code that made it, so a cached layer is only reused
+when rerunning would give the same result.
+
+The sheets of Excel workbooks are cached as Parquet the same way, see read_sheets().
+"""
+
+from __future__ import annotations
+
+import hashlib
+import json
+import logging
+import os
+import tempfile
+from pathlib import Path
+from typing import Iterable, List, Optional
+
+import gislayer
+
+# imports from external libraries, that may have to be installed, loaded when first used
+gpd = gislayer.lazy_import('geopandas')
+pd = gislayer.lazy_import('pandas')
+
+# Bump this when the format of the cached files changes.
+CACHE_FORMAT_VERSION = 3
+
+# 512 MiB
+DEFAULT_MAX_BYTES = 512 * 1024 * 1024
+
+CACHE_SUFFIX = '.parquet'
+# the key of the attributes of a cached layer, as JSON, in the metadata of its GeoParquet file
+ATTRIBUTES_METADATA_KEY = b'layercache.attributes'
+
+
+def source_files(filename) -> List[Path]:
+    """
+    Returns all of the files that make up a dataset.
+
+    For a shapefile these are the .shp and its sidecar files (.dbf, .prj, ...).
+    For a File GeoDatabase these are the files in the .gdb folder, except locks.
+    For a dataset read from a zip archive (a /vsizip/ path) this is the archive.
+    """
+    if str(filename).startswith(gislayer.VSIZIP_PREFIX):
+        return [gislayer.vsi_archive(filename)]
+    path = Path(filename)
+    if path.is_dir():
+        return sorted(p for p in path.iterdir() if p.is_file() and not p.name.endswith('.lock'))
+    return sorted(p for p in path.parent.iterdir()
+                  if p.is_file() and p.name.startswith(path.stem + '.'))
+
+
+def file_digest(path, chunk_size: int = 1024 * 1024) -> str:
+    """Returns the sha256 hex digest of the contents of a file."""
+    h = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(chunk_size), b''):
+            h.update(chunk)
+    return h.hexdigest()
+
+
+def fingerprint(paths: Iterable[Path]) -> str:
+    """Returns a fingerprint of the name, size, mtime and contents of each file."""
+    h = hashlib.sha256()
+    for path in paths:
+        stat = os.stat(path)
+        h.update(f'{Path(path).name}\0{stat.st_size}\0{stat.st_mtime_ns}\0{file_digest(path)}\0'.encode())
+    return h.hexdigest()
+
+
+# Bump this when the format of the cached sheets changes.
+SHEET_CACHE_VERSION = 1
+
+
+def sheet_cache_folder(workbook, cache_folder=None) -> Path:
+    """
+    Returns the folder the sheets of a workbook are cached in, a folder of its own in
+    cache_folder, by default next to the workbook.
+
+    cache_folder can be shared, such as with a LayerCache, each workbook has its own folder in it.
+    """
+    workbook = Path(workbook)
+    parent = Path(cache_folder) if cache_folder is not None else workbook.parent
+    return parent / f'.{workbook.name}.cache'
+
+
+def read_sheets(workbook, sheet_names: Iterable, cache_folder=None) -> dict:
+    """
+    Returns {sheet name: DataFrame} of sheets of an Excel workbook, only parsing the workbook when it changed.
+
+    The parsed sheets are kept as Parquet in a folder in cache_folder, see sheet_cache_folder().
+    They are used while the workbook has the same size and mtime, or failing that the same
+    sha256, so a workbook that was saved without changes is not parsed again.  The sheets
+    that are not cached are all parsed in one read_excel() call.
+    """
+    workbook = Path(workbook)
+    folder = sheet_cache_folder(workbook, cache_folder)
+    manifest_path = folder / 'manifest.json'
+    sheet_names = list(sheet_names)
+    stat = workbook.stat()
+
+    try:
+        manifest = json.loads(manifest_path.read_text())
+    except (FileNotFoundError, ValueError):
+        manifest = {}
+    old_manifest = manifest
+    digest = None
+    if manifest.get('version') != SHEET_CACHE_VERSION or manifest.get('workbook') != str(workbook.resolve()):
+        manifest = {}
+    elif (manifest['size'], manifest['mtime_ns']) != (stat.st_size, stat.st_mtime_ns):
+        digest = file_digest(workbook)
+        if digest != manifest['sha256']:
+            logging.info(f'{workbook} changed, parsing it again')
+            manifest = {}
+    if not manifest:
+        # the sheets of another version of the workbook, only the files the manifest lists
+        for filename in old_manifest.get('sheets', {}).values():
+            try:
+                (folder / filename).unlink()
+            except FileNotFoundError:
+                pass
+        manifest = {'version': SHEET_CACHE_VERSION, 'workbook': str(workbook.resolve()), 'sheets': {}}
+    manifest.update(size=stat.st_size, mtime_ns=stat.st_mtime_ns,
+                    sha256=digest or manifest.get('sha256') or file_digest(workbook))
+
+    sheets = {}
+    for name in sheet_names:
+        filename = manifest['sheets'].get(str(name))
+        if filename is not None:
+            try:
+                sheets[name] = pd.read_parquet(folder / filename)
+            except (OSError, ValueError) as err:
+                logging.warning(f'could not read the cached sheet {name!r} of {workbook}: {err}')
+
+    missing = [name for name in sheet_names if name not in sheets]
+    if missing:
+        logging.info(f'parsing {len(missing)} sheets of {workbook}')
+        parsed = pd.read_excel(workbook, sheet_name=missing)
+        folder.mkdir(parents=True, exist_ok=True)
+        for name in missing:
+            sheets[name] = parsed[name]
+            filename = hashlib.sha256(str(name).encode()).hexdigest()[:16] + CACHE_SUFFIX
+            try:
+                parsed[name].to_parquet(folder / filename)
+            except (ImportError, TypeError, ValueError) as err:
+                # such as a column of both numbers and text, which Parquet cannot store
+                logging.warning(f'not caching the sheet {name!r} of {workbook}: {err}')
+                continue
+            manifest['sheets'][str(name)] = filename
+
+    if folder.is_dir():
+        tmp_path = manifest_path.with_name(f'{manifest_path.name}.{os.getpid()}.tmp')
+        tmp_path.write_text(json.dumps(manifest, indent=2))
+        os.replace(tmp_path, manifest_path)
+    return sheets
+
+
+def source_key(layer_class, kwargs: dict, crs, code_version: Optional[str] = None) -> str:
+    """
+    Returns a key for building layer_class(**kwargs) into crs.
+
+    The key changes when the source files, the arguments, the class, the CRS or
+    code_version change.
+    """
+    filename = kwargs.get('filename')
+    parts = {
+        'format': CACHE_FORMAT_VERSION,
+        'code': code_version,
+        'class': f'{layer_class.__module__}.{layer_class.__qualname__}',
+        'kwargs': sorted((k, str(v)) for (k, v) in kwargs.items()),
+        'crs': str(crs),
+        'source': fingerprint(source_files(filename)) if filename is not None else None,
+    }
+    return hashlib.sha256(json.dumps(parts, sort_keys=True).encode()).hexdigest()
+
+
+def _encode_attribute(value):
+    """Returns a layer attribute as JSON, see LayerCache.put()."""
+    if isinstance(value, pd.Timestamp):
+        return {'timestamp': value.isoformat()}
+    return value
+
+
+def _decode_attribute(value):
+    if isinstance(value, dict) and list(value) == ['timestamp']:
+        return pd.Timestamp(value['timestamp'])
+    return value
+
+
+class LayerCache(object):
+    """
+    Caches processed GeoDataFrames in a folder.
+
+    When the folder grows past max_bytes, the least recently used entries are
+    deleted.  With rebuild=True nothing is read from the cache, but the newly
+    processed layers are still stored in it.
+    """
+    def __init__(self, folder, max_bytes: int = DEFAULT_MAX_BYTES,
+                 code_files: Iterable = (), rebuild: bool = False):
+        self.folder = Path(folder)
+        self.max_bytes = max_bytes
+        self.rebuild = rebuild
+        # a change to any of these files invalidates the whole cache
+        self.code_version = fingerprint(sorted(Path(f) for f in code_files))
+
+    def key(self, layer_class, kwargs: dict, crs) -> str:
+        """Returns the cache key for building layer_class(**kwargs) into crs."""
+        return source_key(layer_class, kwargs, crs, self.code_version)
+
+    def path(self, key: str) -> Path:
+        return self.folder / (key + CACHE_SUFFIX)
+
+    def get(self, key: str) -> Optional[gpd.GeoDataFrame]:
+        """
+        Returns the cached GeoDataFrame, or None if it is not cached.
+
+        An entry that cannot be read, such as one cut short by a killed run, is
+        deleted and counts as not cached.
+        """
+        if self.rebuild:
+            return None
+        path = self.path(key)
+        try:
+            gdf = gpd.read_parquet(path)
+        except FileNotFoundError:
+            return None
+        except ImportError as err:
+            logging.warning(f'layer cache disabled, GeoParquet is not available: {err}')
+            return None
+        except (OSError, ValueError) as err:
+            # pyarrow's ArrowInvalid is a ValueError
+            logging.warning(f'deleting the unreadable cached layer {path}: {err}')
+            self.delete(key)
+            return None
+        # mark as recently used for eviction
+        try:
+            os.utime(path)
+        except FileNotFoundError:
+            pass
+        logging.info(f'read layer from cache {path}')
+        return gdf
+
+    def get_attributes(self, key: str) -> dict:
+        """Returns the attributes stored with the cached GeoDataFrame by put(), {} if there are none."""
+        import pyarrow.parquet
+        try:
+            metadata = pyarrow.parquet.read_schema(self.path(key)).metadata or {}
+        except (OSError, ValueError):
+            return {}
+        if ATTRIBUTES_METADATA_KEY not in metadata:
+            return {}
+        return {name: _decode_attribute(value)
+                for (name, value) in json.loads(metadata[ATTRIBUTES_METADATA_KEY]).items()}
+
+    def put(self, key: str, gdf: gpd.GeoDataFrame, attributes: Optional[dict] = None) -> None:
+        """
+        Stores gdf, and the attributes of its layer, in the cache, then evicts old entries if over the size limit.
+
+        The attributes are stored as JSON in the metadata of the GeoParquet file.  The cache
+        is only a speed up, so a layer that cannot be stored is logged and left out.
+        """
+        self.folder.mkdir(parents=True, exist_ok=True)
+        path = self.path(key)
+        # write to a temporary name first so a reader never sees half a file,
+        # the name is unique to this write, another thread may store the same key
+        (fd, tmp_name) = tempfile.mkstemp(prefix=f'{key}.', suffix='.tmp', dir=self.folder)
+        os.close(fd)
+        tmp_path = Path(tmp_name)
+        try:
+            import pyarrow.parquet
+            from geopandas.io.arrow import _geopandas_to_arrow
+            # the table geopandas.to_parquet() writes, with the attributes added to its metadata
+            table = _geopandas_to_arrow(gdf)
+            encoded = json.dumps({name: _encode_attribute(value) for (name, value) in (attributes or {}).items()})
+            metadata = dict(table.schema.metadata or {})
+            metadata[ATTRIBUTES_METADATA_KEY] = encoded.encode()
+            table = table.replace_schema_metadata(metadata)
+            pyarrow.parquet.write_table(table, tmp_path)
+            os.replace(tmp_path, path)
+        except ImportError as err:
+            logging.warning(f'layer cache disabled, GeoParquet is not available: {err}')
+            return
+        except Exception as err:
+            logging.warning(f'could not store the layer in the cache {path}: {err!r}')
+            return
+        finally:
+            try:
+                tmp_path.unlink()
+            except FileNotFoundError:
+                pass
+        logging.debug(f'wrote layer to cache {path}')
+        self.evict()
+
+    def delete(self, key: str) -> None:
+        try:
+            self.path(key).unlink()
+        except FileNotFoundError:
+            pass
+
+    def evict(self) -> None:
+        """Deletes the least recently used entries until the cache fits in max_bytes."""
+        entries = []
+        for path in self.folder.glob('*' + CACHE_SUFFIX):
+            try:
+                stat = path.stat()
+            except FileNotFoundError:
+                # another worker evicted it
+                continue
+            entries.append((stat.st_mtime, stat.st_size, path))
+
+        total = sum(size for (_, size, _) in entries)
+        entries.sort()
+        for (_, size, path) in entries:
+            if total <= self.max_bytes:
+                break
+            try:
+                path.unlink()
+                logging.info(f'evicted {path} from the layer cache')
+            except FileNotFoundError:
+                pass
+            total -= size
+
+    def clear(self) -> None:
+        for path in self.folder.glob('*' + CACHE_SUFFIX):
+            path.unlink()
@@ -4,23 +4,38 @@
 
 # Using Python 3.5+.
 
+from __future__ import annotations
+
 # Standard Modules
+import argparse
 import datetime
+import json
 import logging
+import os
+import re
 # import pprint
 from pathlib import Path
-from typing import Optional
+from typing import List, Optional
 import time
-from collections import OrderedDict
-
-# These modules are external and will need to be installed.
-import dateutil.parser
-import pandas as pd
-import geopandas as gpd
-import fiona
+from collections import OrderedDict, deque
 
 # modules for this program
+import generalize
 import gislayer
+import layercache
+import profiling
+import snapshotcatalog
+import sourceregistry
+import topologyqa
+import vectortiles
+import watchdaemon
+import writers
+
+# These modules are external and will need to be installed.
+# They are loaded when first used, so plan and list-snapshots start quickly.
+pd = gislayer.lazy_import('pandas')
+gpd = gislayer.lazy_import('geopandas')
+fiona = gislayer.lazy_import('fiona')
 
 # for DEBUG
 # import faulthandler; faulthandler.enable()
@@ -28,6 +43,39 @@ import gislayer
 # When True, this does a test run without actually writing any data. 
 NO_WRITE = False
 
+# Number of workers used to build the layers in read_layers().
+# None or 1 builds the layers one after another in this process.
+READ_WORKERS = None
+# 'thread' or 'process'.  Threads work well because GDAL releases the GIL.
+READ_EXECUTOR = 'thread'
+
+# The subcommands, see parse_args().
+COMMANDS = ('run', 'plan', 'list-snapshots')
+
+# The folder of the dated city snapshots, the File GeoDatabases that are read,
+# and the folder the combined layer is written to.
+CITIES_FOLDER = './municipal_limits/cities/'
+TOWNS_GDB = './municipal_limits/MunicipalLimits.gdb'
+ATHENS_GDB = './municipal_limits/AthensMunicipalLimits.gdb'
+OUTPUT_FOLDER = './municipal_limits/'
+# The formats the combined layer is written in, see writers.FORMATS
+OUTPUT_FORMATS = ('shapefile',)
+OUTPUT_NAME = 'limestone_co_municipal_limits'
+
+# The catalog of snapshot folders and geodatabase layers, see snapshotcatalog.py
+CATALOG_PATH = './municipal_limits/.catalog.sqlite'
+
+# Processed layers are cached here between runs, see layercache.py
+CACHE_FOLDER = './municipal_limits/.cache/'
+
+# The last combined layer and the manifest of its sources are kept here by --incremental.
+INCREMENTAL_FOLDER = './municipal_limits/.incremental/'
+# Bump this when the manifest or the stored combined layer changes.
+MANIFEST_VERSION = 1
+
+# The timing report of each run (and the cProfile dumps with --profile) go here.
+PROFILE_FOLDER = './municipal_limits/profile/'
+
 # alabama_state_plane_feet_west_crs = {'init':'esri:102630'}
 # The above syntax is no longer valid as of PROJ version 6+:
 # https://pyproj4.github.io/pyproj/stable/gotchas.html#axis-order-changes-in-proj-6
@@ -38,59 +86,176 @@ ALABAMA_SP_FT_WEST_CRS = 'ESRI:102630'
 # see:  https://www.federalregister.gov/d/2020-21902
 # As of perhaps 2019, the Alabama Department of Revenue Property Tax Map specifications required the U.S. Survey Foot.
 
+# The date at the end of a dated geodatabase layer name, which can have a letter suffix,
+# such as AthensMunicipalBoundary_2020_10_31B.
+LAYER_DATE_RE = re.compile(r'(\d{4})_(\d{2})_(\d{2})[A-Za-z]*$')
+
+# geopandas does okay with building a schema, but the LASTUPDATE
+# field must be date it is not yet smart enough to do that.
+OUTPUT_SCHEMA_PROPS = OrderedDict([("NAME", "str:50"),
+                                   ("ProperName", "str:50"), 
+                                   ("MUNITYP", "str:10"), 
+                                   ("GNIS", "int:10"), 
+                                   ("LOCALFIPS", "str:5"), 
+                                   ("GlobalID", "str:38"), 
+                                   ("LASTEDITOR", "str:50"), 
+                                   ("LASTUPDATE", "date"), 
+                                   # ("LASTUPDATE", "str:8"),  # OLD way of storing a date
+                                   ("ChangeDesc", "str:254"),                                   
+                                   ("MUNIAREA", "float:24.3"),
+                                   ("Source", "str:100"), 
+                                   ("SrcURL", "str:254")])
+
+# The layer of annexations (added) and deannexations (removed) between the two newest snapshots of a city.
+# AREA is in square miles like MUNIAREA.
+CHANGE_SCHEMA_PROPS = OrderedDict([("NAME", "str:50"),
+                                   ("GNIS", "int:10"),
+                                   ("CHANGE", "str:10"),
+                                   ("FROMDATE", "date"),
+                                   ("TODATE", "date"),
+                                   ("AREA", "float:24.3"),
+                                   ("ChangeDesc", "str:254")])
+# Added or removed pieces smaller than this, in square feet, are left out of the changes.
+CHANGE_MIN_AREA = 1.0
+
+# Fields of the output that are read from a source layer if it has them.
+# MUNIAREA is always recalculated.
+SOURCE_FIELDS = [field for field in OUTPUT_SCHEMA_PROPS if field != 'MUNIAREA']
+
 # Technically, this should be MunicipalLimitLayer
 class CityLimitLayer (gislayer.GISLayer):
     """This class gives basic functionality for all derived city limit layers."""
+    # Where LASTUPDATE comes from, so plan can find the dataset date without reading the layer:
+    # 'field' the lastupdate_field of each row, 'first' the lastupdate_field of the first row (of a dissolved layer),
+    # 'max' the newest lastupdate_field, 'folder_date' the snapshot folder.
+    lastupdate_from = 'field'
+    lastupdate_field = 'LASTUPDATE'
+    # attributes set while the layer is processed, they are cached with it, see from_cache()
+    processed_attributes = ('folder_date', 'where_applied')
+
     def __init__(self, filename=None,  driver: Optional[str] = None,
-                 layer: Optional[str] = None, parse_folder_date_flag: bool = True):
+                 layer: Optional[str] = None, parse_folder_date_flag: bool = True, gdf=None,
+                 engine: Optional[str] = None):
         
         # indicates there is date information in the folder that needs to be parsed
         self.parse_folder_date_flag = parse_folder_date_flag
+        # timings of each stage, see profiling.py
+        self.profile = profiling.StageRecorder(type(self).__name__, source=filename)
+        # the processed GeoDataFrame and attributes of a layer from the cache, see from_cache()
+        cached = self.__dict__.pop('_cached', None)
         # call the super layer
-        gislayer.GISLayer.__init__(self, filename=filename, driver=driver, layer=layer)
+        with self.profile.stage('read', self):
+            gislayer.GISLayer.__init__(self, filename=filename if cached is None else None,
+                                       driver=driver, layer=layer, gdf=gdf, engine=engine)
+        if cached is not None:
+            (self.gdf, attributes) = cached
+            self.filename = filename
+            self.__dict__.update(attributes)
+            return
         
-        if self.filename != None:
-            self.geoprocess()
+        # a layer made from a GeoDataFrame (such as one from the cache) is already processed
+        if self.filename != None and gdf is None:
+            if self.gdf is None:
+                # read a chunk at a time, see gislayer.CHUNK_ROWS
+                self.geoprocess_chunks()
+            else:
+                self.geoprocess()
         
     def set_projection(self, crs=ALABAMA_SP_FT_WEST_CRS):
         # NOTE this may change in a future version of geopandas (above 0.5.0)
         if not isinstance(crs, (dict, str)):
             raise TypeError(f"crs must be a proj4 dictionary or proj4 string, not {type(crs)}: {crs}")
         
-        self.gdf.crs = crs
+        if not gislayer.crs_equal(self.gdf.crs, crs):
+            self.gdf.crs = gislayer.get_crs(crs)
     
     def geoprocess(self):
         """
         These are the process that run to geoprocess the layer.  
         This says what functions should be called in what order. 
         """
+        stage = self.profile.stage
+
         if self.parse_folder_date_flag == True:
-            self.parse_folder_date()
+            with stage('parse_folder_date', self):
+                self.parse_folder_date()
         
-        self.select_by_attributes()
+        with stage('select_by_attributes', self):
+            self.select_by_attributes()
 
         # geometry operations
-        self.geometry_operations()
-        self.reproject()
+        with stage('geometry_operations', self):
+            self.geometry_operations()
+        with stage('reproject', self):
+            self.reproject()
 
         # deal with fields
-        self.copy_fields()
+        with stage('copy_fields', self):
+            self.copy_fields()
         
-        for (field, value) in self.add_fields_list:
-            self.gdf[field] = value
+        with stage('add_fields', self):
+            for (field, value) in self.add_fields_list:
+                self.gdf[field] = value
             
-        self.add_fields()
-        self.copy_fields()
+            self.add_fields()
+        with stage('copy_fields', self):
+            self.copy_fields()
         # took a different approach, by just only writing the desired fields to the file.
 #        self.delete_fields()
         
-        for field in self.delete_fields_list:
-            if field not in self.gdf.columns:
-                raise KeyError( 'column "{0}" does not exist in filename: {1}'.format(field, self.filename) )
-            del self.gdf[field]
+        with stage('delete_fields', self):
+            for field in self.delete_fields_list:
+                if self.read_columns is not None and field not in self.read_columns:
+                    # never read, see self.read_columns
+                    continue
+                if field not in self.gdf.columns:
+                    raise KeyError( 'column "{0}" does not exist in filename: {1}'.format(field, self.filename) )
+                del self.gdf[field]
 
-        self.calculate_area()
+        with stage('calculate_area', self):
+            self.calculate_area()
         
+    def geoprocess_chunks(self):
+        """
+        Like geoprocess(), for a layer read self.chunk_size rows at a time.
+
+        Each chunk goes through geoprocess() on its own, so only one chunk of the
+        source is in memory at a time.  The processed chunks are then reduced
+        together, see reduce_chunks().
+        """
+        chunks = []
+        reader = self.iter_chunks()
+        while True:
+            with self.profile.stage('read', self):
+                chunk = next(reader, None)
+            if chunk is None:
+                break
+            self.geoprocess()
+            chunks.append(self.gdf)
+        with self.profile.stage('concat_chunks', self):
+            crs = chunks[0].crs
+            self.gdf = gpd.GeoDataFrame(pd.concat(chunks, ignore_index=True), crs=crs)
+        del chunks
+        with self.profile.stage('reduce_chunks', self):
+            self.reduce_chunks()
+
+    def reduce_chunks(self):
+        """
+        Finishes a layer made of processed chunks.
+
+        geometry_operations() runs again, so a dissolve unions the partial unions
+        of the chunks into the union of the layer (it does nothing to layers that
+        are not dissolved).  Then the area is calculated again and finalize_chunks()
+        fixes what was worked out from one chunk instead of the whole layer.
+        """
+        self.geometry_operations()
+        self.calculate_area()
+        self.finalize_chunks()
+
+    def finalize_chunks(self):
+        """Sets the fields that depend on every row of the layer, after reduce_chunks() put the chunks together."""
+        pass
+
     def reproject(self):
         pass
         
@@ -108,10 +273,13 @@ class CityLimitLayer (gislayer.GISLayer):
         # folder_date_str = os.path.dirname(self.filename).split('/').pop()
  
         # hopefully this is more cross platform.
-        folder_date_str = Path(self.filename).parts[-2]
+        # for a shapefile in a zip archive, this is the folder of the archive
+        folder_date_str = gislayer.dataset_folder(self.filename).name
         
-        # this is a dateime.date object
-        folder_date = datetime.date(*dateutil.parser.parse(folder_date_str).utctimetuple()[0:3])
+        # this is a dateime.date object, "YYYY MM DD" is parsed without dateutil
+        folder_date = snapshotcatalog.parse_date(folder_date_str)
+        if folder_date is None:
+            raise ValueError(f'folder "{folder_date_str}" of {self.filename} is not a date')
         # OLD version converted to a string :-(
         # self.folder_date = str(folder_date)
         # stores data in column a pandas Timestamp.
@@ -122,27 +290,61 @@ class CityLimitLayer (gislayer.GISLayer):
         # area is in the native units, which in this case is square US Survey Feet.
         self.gdf['MUNIAREA'] = self.gdf.area / 43560 / 640
 
+    @classmethod
+    def from_cache(cls, kwargs: dict, gdf, attributes: dict):
+        """
+        Returns the layer cls(**kwargs) would make, from its processed gdf and attributes.
+
+        The constructor of cls runs, so the layer is set up the same way as when it
+        is processed, but the file is not read and geoprocess() does not run.
+        """
+        layer = cls.__new__(cls)
+        layer._cached = (gdf, attributes)
+        layer.__init__(**kwargs)
+        return layer
+
+    def cached_attributes(self) -> dict:
+        """Returns the processed_attributes that this layer has, to cache with its GeoDataFrame."""
+        return {name: getattr(self, name) for name in self.processed_attributes if hasattr(self, name)}
+
+    @classmethod
+    def lastupdate_rule(cls, kwargs: dict) -> tuple:
+        """
+        Returns (lastupdate_from, lastupdate_field, SQL WHERE clause of the rows read, dissolve fields)
+        of a layer built from kwargs.  With 'first', there is a row for each value of the dissolve
+        fields, or one row when there are none.
+        """
+        return (cls.lastupdate_from, cls.lastupdate_field, getattr(cls, 'read_where', None), [])
+
 
 class AthensLimitLayer(CityLimitLayer):
-    def __init__(self, filename, driver=None, layer=None):
+    # dissolved, so the LASTUPDATE of the first row is kept
+    lastupdate_from = 'first'
+
+    def __init__(self, filename, driver=None, layer=None, engine=None):
         self.required_fields = ('GNIS', 'NAME', 'LOCALFIPS', 'MUNITYP', 
                           'ProperName', 'Source', 'SrcURL', 'LASTUPDATE')
         
         self.delete_fields_list = ['Shape_Area', 'Shape_Length']
+        self.read_columns = SOURCE_FIELDS
         
         # super(CityLimitLayer, self).__init__(filename, required_fields)
-        CityLimitLayer.__init__(self, filename=filename, driver=driver, layer=layer, parse_folder_date_flag=False)
+        CityLimitLayer.__init__(self, filename=filename, driver=driver, layer=layer, parse_folder_date_flag=False,
+                                engine=engine)
     
         
     def geometry_operations(self):
         self.combine_geometry_multipart()
 
     def reproject(self):
-        self.gdf.to_crs(crs=ALABAMA_SP_FT_WEST_CRS, inplace=True)
+        self.to_crs(ALABAMA_SP_FT_WEST_CRS)
 
 
 class HuntsvilleLimitLayer(CityLimitLayer):
-    def __init__(self, filename):
+    lastupdate_from = 'max'
+    lastupdate_field = 'Eff_Date'
+
+    def __init__(self, filename, engine=None):
         self.required_fields_list = ('CityName', 'Eff_Date', 'Mod_Date')
         self.add_fields_list = ( 
                 ('GNIS' , 2404746),
@@ -158,19 +360,26 @@ class HuntsvilleLimitLayer(CityLimitLayer):
 
         self.delete_fields_list = ['CityName', 'Mod_Date', 'Eff_Date', 'Mod_User',
                                    'SHAPE_STAr', 'SHAPE_STLe']
+        self.read_columns = SOURCE_FIELDS + ['CityName', 'Eff_Date']
 
-        CityLimitLayer.__init__(self, filename, parse_folder_date_flag = False)
+        CityLimitLayer.__init__(self, filename, parse_folder_date_flag = False, engine=engine)
 
     def copy_fields(self):
         self.gdf['NAME'] = self.gdf['CityName']
         self.gdf['LASTUPDATE'] = pd.Timestamp(max(self.gdf['Eff_Date']))
 
+    def finalize_chunks(self):
+        # each chunk has the newest Eff_Date of its own rows
+        self.gdf['LASTUPDATE'] = max(self.gdf['LASTUPDATE'])
+
     def reproject(self):
-        self.gdf.to_crs(crs=ALABAMA_SP_FT_WEST_CRS, inplace=True)
+        self.to_crs(ALABAMA_SP_FT_WEST_CRS)
 
 
 class MadisonLimitLayer(CityLimitLayer):
-    def __init__(self, filename):
+    lastupdate_from = 'folder_date'
+
+    def __init__(self, filename, engine=None):
         self.required_fields = ('Name',)
         self.add_fields_list = (
                 ('GNIS', 2404989),
@@ -181,18 +390,21 @@ class MadisonLimitLayer(CityLimitLayer):
                 # NAME?
             )
         self.delete_fields_list = ['Name', 'Use_Status', 'Shape_area']
-        CityLimitLayer.__init__(self, filename, parse_folder_date_flag = True)
+        self.read_columns = SOURCE_FIELDS + ['Name']
+        CityLimitLayer.__init__(self, filename, parse_folder_date_flag = True, engine=engine)
 
     def copy_fields(self):
         self.gdf['NAME'] = self.gdf['Name']
         self.gdf['LASTUPDATE'] = self.folder_date
 
     def reproject(self):
-        self.gdf.to_crs(crs=ALABAMA_SP_FT_WEST_CRS, inplace=True)
+        self.to_crs(ALABAMA_SP_FT_WEST_CRS)
 
 
 class DecaturLimitLayer(CityLimitLayer):
-    def __init__(self, filename):
+    lastupdate_from = 'folder_date'
+
+    def __init__(self, filename, engine=None):
         self.add_fields_list = (
                 ('GNIS', 2404206),
                 ('LOCALFIPS', '20104'),
@@ -202,8 +414,9 @@ class DecaturLimitLayer(CityLimitLayer):
                 ('Source', 'City of Decatur, Information Technology Dept.'),
             )
         self.delete_fields_list = ['Shape_STAr', 'Shape_STLe']
+        self.read_columns = SOURCE_FIELDS
         
-        CityLimitLayer.__init__(self, filename, parse_folder_date_flag = True)
+        CityLimitLayer.__init__(self, filename, parse_folder_date_flag = True, engine=engine)
         
 
     def copy_fields(self):
@@ -214,63 +427,475 @@ class DecaturLimitLayer(CityLimitLayer):
         self.combine_geometry_multipart()
 
     def reproject(self):
-        self.gdf.to_crs(crs=ALABAMA_SP_FT_WEST_CRS, inplace=True)
+        self.to_crs(ALABAMA_SP_FT_WEST_CRS)
 
 class TownsLimitLayer(CityLimitLayer):
     """
     This is a class for all of the Towns and Ardmore City.  These change less so are stored here.
     """
-    def __init__(self, filename, driver, layer):
+    # the same filter as select_by_attributes(), handed to the driver when it can filter
+    read_where = "MUNITYP = 'Town' OR NAME = 'Ardmore'"
+
+    def __init__(self, filename, driver, layer, engine=None):
         # fill required_fields out
         self.required_fields = ('MUNITYP', 'NAME')
         self.delete_fields_list = ['Shape_Area', 'Shape_Length']
-        CityLimitLayer.__init__(self, filename, driver=driver, layer=layer, parse_folder_date_flag=False)
+        self.read_columns = SOURCE_FIELDS
+        CityLimitLayer.__init__(self, filename, driver=driver, layer=layer, parse_folder_date_flag=False,
+                                engine=engine)
 
     def select_by_attributes(self):
+        if self.where_applied:
+            # the driver already filtered it with self.read_where
+            return
         # Filters by selecting by attribute where 'MUNITYP' is 'Town' or 'NAME' is 'Ardmore'.
         # In effect, this gets rid of all of the City layers except for Ardmore City in the layer.
         filter_gdf = self.gdf[(self.gdf['MUNITYP'] == 'Town') | (self.gdf['NAME'] == 'Ardmore')]
         self.gdf = filter_gdf
 
     def reproject(self):
-        self.gdf.to_crs(crs=ALABAMA_SP_FT_WEST_CRS, inplace=True)
+        self.to_crs(ALABAMA_SP_FT_WEST_CRS)
+
+
+
+class RegistryLimitLayer(CityLimitLayer):
+    """
+    A layer described by an entry of the source registry, see sourceregistry.py.
+
+    This does what the layer classes above do by hand, with the compiled operations of the entry.
+    """
+    def __init__(self, source: sourceregistry.CompiledSource, filename, driver=None, layer=None, engine=None):
+        self.source = source
+        self.required_fields = source.required_fields
+        self.read_columns = source.read_columns
+        self.read_where = source.where
+        CityLimitLayer.__init__(self, filename, driver=driver, layer=layer,
+                                parse_folder_date_flag=source.lastupdate == 'folder_date', engine=engine)
+
+    def geoprocess(self):
+        stage = self.profile.stage
+
+        if self.parse_folder_date_flag == True:
+            with stage('parse_folder_date', self):
+                self.parse_folder_date()
+        with stage('select_by_attributes', self):
+            self.select_by_attributes()
+        # before dissolving, which only keeps the attributes of the first row
+        lastupdate = self.source.lastupdate_value(self.gdf, getattr(self, 'folder_date', None))
+        with stage('geometry_operations', self):
+            self.geometry_operations()
+        with stage('reproject', self):
+            self.reproject()
+        with stage('columns', self):
+            # set area for MUNIAREA (Square Miles), see CityLimitLayer.calculate_area()
+            self.gdf = self.source.apply_columns(self.gdf, lastupdate,
+                                                 computed={'MUNIAREA': lambda gdf: gdf.area / 43560 / 640})
+
+    def select_by_attributes(self):
+        if self.source.filters and not self.where_applied:
+            self.gdf = self.gdf[self.source.mask(self.gdf)]
+
+    def geometry_operations(self):
+        if self.source.dissolve is True:
+            self.combine_geometry_multipart()
+        elif self.source.dissolve:
+            # reduce_chunks() dissolves again after apply_columns() renamed the fields
+            by = [field if field in self.gdf else self.source.rename.get(field, field)
+                  for field in self.source.dissolve]
+            self.combine_geometry_multipart(by=by)
+
+    def finalize_chunks(self):
+        if self.source.lastupdate == 'max':
+            # each chunk has the newest value of its own rows
+            self.gdf['LASTUPDATE'] = max(self.gdf['LASTUPDATE'])
+
+    def reproject(self):
+        self.to_crs(ALABAMA_SP_FT_WEST_CRS)
+
+    @classmethod
+    def lastupdate_rule(cls, kwargs: dict) -> tuple:
+        source = kwargs['source']
+        if source.lastupdate == 'field':
+            # the source field that is renamed to LASTUPDATE, if there is one
+            field = next((f for (f, target) in source.rename.items() if target == 'LASTUPDATE'), 'LASTUPDATE')
+            if source.dissolve:
+                # the dissolve keeps the first row of each group
+                return ('first', field, source.where, [] if source.dissolve is True else list(source.dissolve))
+            return ('field', field, source.where, [])
+        return (source.lastupdate, source.lastupdate_field, source.where, [])
+
+
+def load_registry(path) -> sourceregistry.SourceRegistry:
+    """Loads a source registry for the output schema of this program."""
+    return sourceregistry.SourceRegistry(path, OUTPUT_SCHEMA_PROPS, computed_fields=('MUNIAREA',))
 
         
+def dataset_date(most_recent_datetime) -> str:
+    """Returns the date of the dataset from the newest LASTUPDATE, as YYYY-MM-DD."""
+    # get rid of the time portion of this.
+    most_recent_date = datetime.datetime.fromisoformat(str(most_recent_datetime)).date()
+    # for shapefile format
+    return most_recent_date.isoformat()
+
+
+def snapshot_date(kwargs) -> Optional[datetime.date]:
+    """
+    Returns the date of the snapshot a layer is built from, from its folder or its _YYYY_MM_DD layer name
+    (see LAYER_DATE_RE), None when it has no date.
+    """
+    if kwargs.get('layer') is not None:
+        match = LAYER_DATE_RE.search(kwargs['layer'])
+        if match is None:
+            return None
+        try:
+            return datetime.date(*(int(part) for part in match.groups()))
+        except ValueError:
+            return None
+    return snapshotcatalog.parse_date(gislayer.dataset_folder(kwargs['filename']).name)
+
+
+def planned_lastupdate(layer_class, kwargs: dict, engine: Optional[str] = None) -> Optional[datetime.date]:
+    """
+    Returns the newest LASTUPDATE the layer built from kwargs would have, None if it has none.
+
+    Only the one attribute (and the dissolve fields) is read, never the geometry, see
+    CityLimitLayer.lastupdate_rule().
+    """
+    (lastupdate_from, field, where, by) = layer_class.lastupdate_rule(kwargs)
+    if lastupdate_from == 'folder_date':
+        # see CityLimitLayer.parse_folder_date()
+        return snapshotcatalog.parse_date(gislayer.dataset_folder(kwargs['filename']).name)
+
+    def read(name):
+        return gislayer.read_field_values(str(kwargs['filename']), name, layer=kwargs.get('layer'),
+                                          where=where, engine=engine)
+
+    values = read(field)
+    if lastupdate_from == 'first':
+        # like gislayer.GISLayer.combine_geometry_multipart(), the first row of each group is kept
+        keys = list(zip(*(read(name) for name in by))) if by else [()] * len(values)
+        firsts = {}
+        for (key, value) in zip(keys, values):
+            firsts.setdefault(key, value)
+        values = list(firsts.values())
+    dates = [datetime.date.fromisoformat(str(value)[:10]) for value in values if value is not None]
+    return max(dates) if dates else None
+
+
+def change_description(diff: gpd.GeoDataFrame, from_date, to_date) -> str:
+    """Returns the ChangeDesc for the changes found by gislayer.diff_layers()."""
+    if len(diff) == 0:
+        return f'No boundary change from {from_date} to {to_date}'
+    # square miles
+    added = diff.loc[diff['change'] == 'added', 'area'].sum() / 43560 / 640
+    removed = diff.loc[diff['change'] == 'removed', 'area'].sum() / 43560 / 640
+    return f'Annexed {added:.3f} sq mi, removed {removed:.3f} sq mi from {from_date} to {to_date}'
+
+
+def _build_layer(layer_class, kwargs, cache: Optional[layercache.LayerCache] = None):
+    """
+    Builds one layer.  This is at module level so a process pool can pickle it.
+
+    When a cache is given, a processed layer is read from it if the sources have not
+    changed, otherwise the layer is processed and stored in the cache.
+    """
+    if cache is None:
+        return layer_class(**kwargs)
+
+    recorder = profiling.StageRecorder(layer_class.__name__, source=kwargs.get('filename'))
+    with recorder.stage('cache_get'):
+        key = cache.key(layer_class, kwargs, ALABAMA_SP_FT_WEST_CRS)
+        gdf = cache.get(key)
+    if gdf is not None:
+        # the same class as an uncached run, with the attributes set while it was processed
+        layer = layer_class.from_cache(kwargs, gdf, cache.get_attributes(key))
+        recorder.records.extend(layer.profile.records)
+        layer.profile = recorder
+        return layer
+
+    layer = layer_class(**kwargs)
+    recorder.records.extend(layer.profile.records)
+    layer.profile = recorder
+    with recorder.stage('cache_put', layer):
+        cache.put(key, layer.gdf, layer.cached_attributes())
+    return layer
+
+
+def load_manifest(path, code_version: Optional[str]) -> Optional[dict]:
+    """Returns the manifest written by save_manifest(), or None if there is none or it is out of date."""
+    try:
+        with open(path) as f:
+            manifest = json.load(f, object_pairs_hook=OrderedDict)
+    except FileNotFoundError:
+        return None
+    except ValueError as err:
+        logging.warning(f'ignoring the unreadable manifest {path}: {err}')
+        return None
+    if manifest.get('version') != MANIFEST_VERSION or manifest.get('code') != code_version:
+        return None
+    return manifest
+
+
+def save_manifest(path, code_version: Optional[str], layers: OrderedDict, outputs: dict) -> None:
+    """Writes the manifest of an incremental run, see MunicipalLimitsGeoProcess.incremental_write()."""
+    path = Path(path)
+    path.parent.mkdir(parents=True, exist_ok=True)
+    tmp_path = path.with_name(f'{path.name}.{os.getpid()}.tmp')
+    with open(tmp_path, 'w') as f:
+        json.dump({'version': MANIFEST_VERSION, 'code': code_version, 'layers': layers, 'outputs': outputs},
+                  f, indent=2)
+    os.replace(tmp_path, path)
+
+
+class LayerBuildError(RuntimeError):
+    """Raised when one of the layers fails to build in read_layers()."""
+    def __init__(self, layer_name, cause):
+        RuntimeError.__init__(self, f'failed to build the {layer_name} layer: {cause!r}')
+        self.layer_name = layer_name
+        self.cause = cause
+
+
 class MunicipalLimitsGeoProcess(object):
-    def __init__(self, base_folder):
+    def __init__(self, base_folder, workers: Optional[int] = READ_WORKERS,
+                 executor: str = READ_EXECUTOR, cache: Optional[layercache.LayerCache] = None,
+                 engine: Optional[str] = None, towns_gdb=TOWNS_GDB, athens_gdb=ATHENS_GDB,
+                 output_folder=OUTPUT_FOLDER, formats=OUTPUT_FORMATS,
+                 catalog: Optional[snapshotcatalog.SnapshotCatalog] = None,
+                 prefer_archives: bool = False,
+                 registry: Optional[sourceregistry.SourceRegistry] = None,
+                 output_name: str = OUTPUT_NAME):
         self.base_folder = base_folder
+        self.towns_gdb = towns_gdb
+        self.athens_gdb = athens_gdb
+        self.output_folder = output_folder
+        self.output_name = output_name
+        self.formats = tuple(formats)
+        # when set, the snapshot folders and gdb layers are looked up in the catalog instead of scanned
+        self.catalog = catalog
+        # read a zipped shapefile in place even when there is an extracted copy next to it
+        self.prefer_archives = prefer_archives
+        # when set, the layers come from the registry instead of the layer classes above
+        self.registry = registry
+        # the engine used to read every layer, see gislayer.DEFAULT_ENGINE
+        self.engine = engine
+        # processed layers are reused from the cache when it is set
+        self.cache = cache
+        # when workers is more than 1 the layers are built concurrently
+        self.workers = workers
+        if executor not in ('thread', 'process'):
+            raise ValueError(f"executor must be 'thread' or 'process', not {executor!r}")
+        self.executor = executor
+        # timings of reading, combining and writing, see profiling.py
+        self.profile = profiling.StageRecorder(type(self).__name__)
+        self.muni_layers = []
+        # set by detect_changes(), ChangeDesc by GNIS code
+        self.changes = None
+        self.change_descriptions = {}
+
+    def layer_specs(self) -> List[tuple]:
+        """
+        Returns a list of (name, layer class, keyword arguments) for every layer.
+        
+        The order of this list is the order the layers are combined in.
+        """
+        if self.registry is not None:
+            return [(source.name, RegistryLimitLayer, self.registry_kwargs(source))
+                    for source in self.registry]
+        return [
+            ('athens', AthensLimitLayer,
+             dict(filename=self.athens_gdb, driver='OpenFileGDB',
+                  layer=self.find_most_recent_gdb(self.athens_gdb, layer_prefix='AthensMunicipalBoundary'),
+                  engine=self.engine)),
+            ('decatur', DecaturLimitLayer, dict(filename=self.find_most_recent_shp('decatur/'), engine=self.engine)),
+            # ('madison', MadisonLimitLayer, dict(filename=self.base_folder + 'madison/2016 09 02/MadCityLimits_9-2-16.shp')),
+            ('madison', MadisonLimitLayer, dict(filename=self.find_most_recent_shp('madison/'), engine=self.engine)),
+            ('huntsville', HuntsvilleLimitLayer, dict(filename=self.find_most_recent_shp('huntsville/'), engine=self.engine)),
+            ('towns', TownsLimitLayer,
+             dict(filename=self.towns_gdb, 
+                  driver='OpenFileGDB', layer="MunicipalBoundary", engine=self.engine)),
+        ]
+
+    def registry_kwargs(self, source: sourceregistry.CompiledSource, snapshot: int = 0) -> dict:
+        """
+        Returns the keyword arguments of RegistryLimitLayer for a registry source.
+
+        snapshot 0 is the newest snapshot (folder or dated layer), 1 the one before it.
+        Raises LookupError if the source does not have that many snapshots.
+        """
+        kwargs = dict(source=source, driver=source.driver, engine=self.engine)
+        if source.snapshots is not None:
+            shps = self.find_snapshot_shps(source.snapshots, snapshot + 1)
+            if len(shps) <= snapshot:
+                raise LookupError(f'{source.name}: there are not {snapshot + 1} snapshots in {source.snapshots}')
+            kwargs['filename'] = shps[snapshot]
+        else:
+            kwargs['filename'] = str(source.path)
+        if source.layer_prefix is not None:
+            layers = self.find_recent_gdb_layers(kwargs['filename'], source.layer_prefix, snapshot + 1)
+            if len(layers) <= snapshot:
+                raise LookupError(f'{source.name}: there are not {snapshot + 1} {source.layer_prefix} layers')
+            kwargs['layer'] = layers[snapshot]
+        else:
+            if snapshot > 0 and source.snapshots is None:
+                raise LookupError(f'{source.name} has no dated snapshots')
+            kwargs['layer'] = source.layer
+        return kwargs
+
+    def validate_registry(self) -> List[str]:
+        """
+        Returns the problems found with the registry's sources, an empty list when there are none.
+
+        Only the schema of each layer is read, not its rows or geometry.
+        """
+        problems = []
+        for source in self.registry:
+            try:
+                kwargs = self.registry_kwargs(source)
+                fields = gislayer.list_fields(str(kwargs['filename']), layer=kwargs['layer'], engine=self.engine)
+            except Exception as err:
+                problems.append(f'{source.name}: {err}')
+                continue
+            problems.extend(source.check_fields(fields))
+        return problems
+
+    def plan(self) -> OrderedDict:
+        """
+        Returns what a run would do: the source and newest LASTUPDATE of each layer,
+        the dataset date and the output paths.
+
+        Only the attribute LASTUPDATE comes from is read, never the geometry,
+        so geopandas and pandas are not loaded.
+        """
+        layers = OrderedDict()
+        for (name, layer_class, kwargs) in self.layer_specs():
+            lastupdate = planned_lastupdate(layer_class, kwargs, self.engine)
+            layers[name] = OrderedDict([('source', str(kwargs['filename'])),
+                                        ('layer', kwargs.get('layer')),
+                                        ('lastupdate', lastupdate.isoformat() if lastupdate else None)])
+        dates = [layer['lastupdate'] for layer in layers.values() if layer['lastupdate'] is not None]
+        if not dates:
+            raise ValueError('none of the layers has a LASTUPDATE')
+        self.dataset_date = dataset_date(max(dates))
+        return OrderedDict([('dataset_date', self.dataset_date),
+                            ('layers', layers),
+                            ('outputs', OrderedDict((k, str(p)) for (k, p) in self.output_paths().items()))])
+
+    def list_snapshots(self, count: Optional[int] = None) -> OrderedDict:
+        """
+        Returns {source: [snapshot, ...]} newest first, for every source with dated snapshots.
+
+        A snapshot is a shapefile of a dated folder or a dated geodatabase layer.
+        count is how many to list for each source, None lists all of them.
+        """
+        snapshots = OrderedDict()
+        if self.registry is not None:
+            for source in self.registry:
+                if source.snapshots is not None:
+                    snapshots[source.name] = [str(p) for p in self.find_snapshot_shps(source.snapshots, count)]
+                elif source.layer_prefix is not None:
+                    snapshots[source.name] = self.find_recent_gdb_layers(str(source.path), source.layer_prefix, count)
+            return snapshots
+        snapshots['athens'] = self.find_recent_gdb_layers(self.athens_gdb, 'AthensMunicipalBoundary', count)
+        for folder in sorted(p for p in Path(self.base_folder).iterdir() if p.is_dir()):
+            snapshots[folder.name] = [str(p) for p in self.find_snapshot_shps(folder, count)]
+        return snapshots
 
     def read_layers(self):
-        self.decatur = DecaturLimitLayer(self.find_most_recent_shp('decatur/'))
-        self.huntsville = HuntsvilleLimitLayer(self.find_most_recent_shp('huntsville/'))
-
-        # self.madison = MadisonLimitLayer(self.base_folder + 'madison/2016 09 02/MadCityLimits_9-2-16.shp')
-        self.madison = MadisonLimitLayer(self.find_most_recent_shp('madison/'))
-        self.towns = TownsLimitLayer(filename='./municipal_limits/MunicipalLimits.gdb', 
-                                driver='OpenFileGDB', layer="MunicipalBoundary")
-
-        self.athens = AthensLimitLayer(r'./municipal_limits/AthensMunicipalLimits.gdb',
-                        driver='OpenFileGDB',
-                        layer = self.find_most_recent_gdb(r'./municipal_limits/AthensMunicipalLimits.gdb', 
-                                                          layer_prefix='AthensMunicipalBoundary')
-                        )
-        self.muni_layers = [self.athens, self.decatur, self.madison, self.huntsville, self.towns]
+        with self.profile.stage('read_layers'):
+            self._read_layers()
+
+    def _read_layers(self):
+        self.set_layers(self.iter_layers())
+
+    def set_layers(self, named_layers):
+        """Sets the layers to combine from (name, layer) pairs, such as ones built elsewhere."""
+        self.muni_layers = []
+        for (name, layer) in named_layers:
+            setattr(self, name, layer)
+            self.muni_layers.append(layer)
+
+    def clip_combined(self, boundary):
+        """Clips the combined layer to boundary (a GeoDataFrame), after combine_layers()."""
+        with self.profile.stage('clip', self.combined):
+            self.combined = self.combined.clip(boundary)
+            # the features cut by the boundary are smaller now, MUNIAREA is set again
+            # in square miles, measured in the feet of ALABAMA_SP_FT_WEST_CRS like CityLimitLayer.calculate_area()
+            gdf = self.combined.gdf
+            gdf['MUNIAREA'] = gislayer.reproject(gdf, ALABAMA_SP_FT_WEST_CRS).area / 43560 / 640
+        self.dataset_date = dataset_date(max(self.combined.gdf['LASTUPDATE']))
+
+    def iter_layers(self, specs: Optional[List[tuple]] = None, max_pending: Optional[int] = None):
+        """
+        Builds the layers, yielding (name, layer) as each one is ready.
+
+        The layers are yielded in the order of layer_specs() (or specs when
+        it is given), so anything made from them stays deterministic.
+        With workers, max_pending bounds the layers built ahead, see build_layers_concurrently().
+        """
+        if specs is None:
+            specs = self.layer_specs()
+
+        if self.workers is None or self.workers <= 1:
+            for (name, layer_class, kwargs) in specs:
+                try:
+                    layer = _build_layer(layer_class, kwargs, self.cache)
+                except Exception as err:
+                    raise LayerBuildError(name, err) from err
+                yield (name, layer)
+        else:
+            yield from self.build_layers_concurrently(specs, max_pending)
+
+    def build_layers_concurrently(self, specs, max_pending: Optional[int] = None):
+        """
+        Builds every layer in specs on a pool of self.workers workers.
+
+        Yields (name, layer) in the same order as specs, no matter which
+        one finishes first, so combine_layers() stays deterministic.
+        max_pending is the most layers submitted and not yet yielded, the next
+        layer is submitted as one is yielded.  This bounds the built layers held
+        at once, None submits every layer at once.
+        """
+        logging.info(f'building {len(specs)} layers with {self.workers} {self.executor} workers')
+        remaining = iter(specs)
+        # (name, future) of the layers submitted and not yielded, in the order of specs
+        pending = deque()
+        # a process pool does not see the options of this process
+        with gislayer.make_pool(self.workers, self.executor, initializer=profiling.configure,
+                                initargs=(profiling.CPROFILE_FOLDER, profiling.TRACEMALLOC)) as pool:
+            def submit_next():
+                spec = next(remaining, None)
+                if spec is not None:
+                    (name, layer_class, kwargs) = spec
+                    pending.append((name, pool.submit(_build_layer, layer_class, kwargs, self.cache)))
+
+            for _ in range(len(specs) if max_pending is None else max(1, max_pending)):
+                submit_next()
+            while pending:
+                (name, future) = pending.popleft()
+                try:
+                    layer = future.result()
+                except Exception as err:
+                    # the layers that have not started are not needed anymore
+                    for (_, f) in pending:
+                        f.cancel()
+                    raise LayerBuildError(name, err) from err
+                submit_next()
+                yield (name, layer)
     
     def combine_layers(self):
         self.combined = CityLimitLayer()
 
-        # self.combined = self.combined.append(self.muni_layers)
-        self.combined = self.combined.concat(self.muni_layers)
-        self.combined.set_projection(crs=ALABAMA_SP_FT_WEST_CRS)
+        with self.profile.stage('concat', self.combined):
+            # self.combined = self.combined.append(self.muni_layers)
+            self.combined = self.combined.concat(self.muni_layers)
+            self.combined.set_projection(crs=ALABAMA_SP_FT_WEST_CRS)
+            self.apply_change_descriptions(self.combined.gdf)
 
         # print(self.combined.gdf['NAME'], flush=True)          # DEBUG
         # print(self.combined.gdf['LASTUPDATE'], flush=True)    # DEBUG
 
         most_recent_datetime = max(self.combined.gdf['LASTUPDATE'])
-        # get rid of the time portion of this.
-        most_recent_date = datetime.datetime.fromisoformat(str(most_recent_datetime)).date()
-        # for shapefile format
-        self.dataset_date = most_recent_date.isoformat()
+        self.dataset_date = dataset_date(most_recent_datetime)
         # for GDB format
 #        dataset_date = most_recent_datetime.strftime('%Y_%m_%d')
  #       print('most_recent_date: {}'.format(most_recent_date))
@@ -288,38 +913,36 @@ class MunicipalLimitsGeoProcess(object):
         # VERBOSE
         # pprint.pprint(combined.gdf)
 
+    def output_paths(self, suffix: str = '') -> dict:
+        """Returns {format name: output path} for each of self.formats, suffix goes after self.output_name."""
+        paths = {}
+        for name in self.formats:
+            extension = writers.FORMATS[name][0]
+            if name == 'filegdb':
+                # Fiona seems to crash python with dashes (-) in a GDB name
+                filename = f"{self.output_name}{suffix}_{self.dataset_date.replace('-', '_')}{extension}"
+            else:
+                filename = f'{self.dataset_date}--{self.output_name}{suffix}{extension}'
+            paths[name] = Path(self.output_folder) / filename
+        return paths
+
     def write(self):
-        shp_filename_output = f'./municipal_limits/{self.dataset_date}--limestone_co_municipal_limits.shp'
-        logging.info(f'Writing to the file {shp_filename_output}')
+        paths = self.output_paths()
+        for path in paths.values():
+            logging.info(f'Writing to the file {path}')
 
         # should this generate GlobalIDs if the row does not have one, using Python uuid?
         # Could feed a GeoJSON representation of the road into uuid.
 
-        # geopandas does okay with building a schema, but the LASTUPDATE
-        # field must be date it is not yet smart enough to do that.
-        schema_props = OrderedDict([("NAME", "str:50"),
-                                    ("ProperName", "str:50"), 
-                                    ("MUNITYP", "str:10"), 
-                                    ("GNIS", "int:10"), 
-                                    ("LOCALFIPS", "str:5"), 
-                                    ("GlobalID", "str:38"), 
-                                    ("LASTEDITOR", "str:50"), 
-                                    ("LASTUPDATE", "date"), 
-                                    # ("LASTUPDATE", "str:8"),  # OLD way of storing a date
-                                    ("ChangeDesc", "str:254"),                                   
-                                    ("MUNIAREA", "float:24.3"),
-                                    ("Source", "str:100"), 
-                                    ("SrcURL", "str:254")])
+        schema_props = OUTPUT_SCHEMA_PROPS
         
         # CHECK IF NAMES MATCH SCHEMA IN DATA
 
-        # write a shapefile
+        # write all of the formats at the same time
         if NO_WRITE is not True:
-            self.combined.gdf.to_file(filename=shp_filename_output, 
-                                      driver='ESRI Shapefile',
-                                      schema={"geometry" : "Polygon",
-                                              "properties": schema_props}
-                                    )
+            with self.profile.stage('write', self.combined):
+                writers.write_formats(self.combined.gdf, paths, schema_props,
+                                      layer=f"MunicipalBoundary_{self.dataset_date.replace('-', '_')}")
 
         # the FileGDB driver crashed this
 #        import ipdb; ipdb.set_trace()
@@ -346,38 +969,543 @@ class MunicipalLimitsGeoProcess(object):
 
         
 
+    def change_specs(self) -> List[tuple]:
+        """
+        Returns (name, layer class, kwargs of the previous snapshot, kwargs of the latest snapshot)
+        for every layer that has at least two dated snapshots.
+        """
+        if self.registry is not None:
+            specs = []
+            for source in self.registry:
+                if source.snapshots is None and source.layer_prefix is None:
+                    continue
+                try:
+                    specs.append((source.name, RegistryLimitLayer,
+                                  self.registry_kwargs(source, 1), self.registry_kwargs(source, 0)))
+                except LookupError:
+                    pass
+            return specs
+
+        specs = []
+        athens_layers = self.find_recent_gdb_layers(self.athens_gdb, 'AthensMunicipalBoundary', 2)
+        if len(athens_layers) == 2:
+            specs.append(('athens', AthensLimitLayer,
+                          *[dict(filename=self.athens_gdb, driver='OpenFileGDB', layer=layer, engine=self.engine)
+                            for layer in reversed(athens_layers)]))
+        for (name, layer_class) in (('decatur', DecaturLimitLayer), ('madison', MadisonLimitLayer),
+                                    ('huntsville', HuntsvilleLimitLayer)):
+            shps = self.find_recent_shps(name + '/', 2)
+            if len(shps) == 2:
+                specs.append((name, layer_class,
+                              *[dict(filename=shp, engine=self.engine) for shp in reversed(shps)]))
+        return specs
+
+    def detect_changes(self):
+        """
+        Finds the areas added to and removed from each city between its two newest snapshots.
+
+        Sets self.changes to a layer with CHANGE_SCHEMA_PROPS, and self.change_descriptions
+        to the ChangeDesc of each city by GNIS code.  The snapshots are built with the
+        layer cache, so the latest one is only processed once.
+        """
+        with self.profile.stage('detect_changes'):
+            self._detect_changes()
+
+    def _detect_changes(self):
+        frames = []
+        self.change_descriptions = {}
+        for (name, layer_class, old_kwargs, new_kwargs) in self.change_specs():
+            old = _build_layer(layer_class, old_kwargs, self.cache)
+            new = _build_layer(layer_class, new_kwargs, self.cache)
+            diff = gislayer.diff_layers(old.gdf, new.gdf, min_area=CHANGE_MIN_AREA, workers=gislayer.UNION_WORKERS)
+            (from_date, to_date) = (snapshot_date(old_kwargs), snapshot_date(new_kwargs))
+            gnis = int(new.gdf['GNIS'].iloc[0])
+            description = change_description(diff, from_date, to_date)
+            logging.info(f'{name}: {description}')
+            self.change_descriptions[gnis] = description
+
+            diff['NAME'] = new.gdf['NAME'].iloc[0]
+            diff['GNIS'] = gnis
+            diff['CHANGE'] = diff['change']
+            diff['FROMDATE'] = pd.Timestamp(from_date)
+            diff['TODATE'] = pd.Timestamp(to_date)
+            diff['AREA'] = diff['area'] / 43560 / 640
+            diff['ChangeDesc'] = description
+            frames.append(diff)
+
+        if frames:
+            changes = gpd.GeoDataFrame(pd.concat(frames, ignore_index=True), crs=ALABAMA_SP_FT_WEST_CRS)
+        else:
+            changes = gpd.GeoDataFrame({'change': [], 'area': []}, geometry=[], crs=ALABAMA_SP_FT_WEST_CRS)
+        self.changes = writers.conform(changes, CHANGE_SCHEMA_PROPS)
+
+    def apply_change_descriptions(self, gdf: gpd.GeoDataFrame) -> None:
+        """Fills the ChangeDesc of the rows of each city that detect_changes() compared."""
+        for (gnis, description) in self.change_descriptions.items():
+            gdf.loc[gdf['GNIS'] == gnis, 'ChangeDesc'] = description
+
+    def write_changes(self):
+        """Writes self.changes next to the combined layer, after it is written."""
+        paths = self.output_paths(suffix='_changes')
+        if NO_WRITE is not True:
+            with self.profile.stage('write_changes'):
+                writers.write_formats(self.changes, paths, CHANGE_SCHEMA_PROPS,
+                                      layer=f"MunicipalChanges_{self.dataset_date.replace('-', '_')}")
+        return paths
+
+    def check_topology(self, gap_max_area: float = topologyqa.GAP_MAX_AREA, make_valid: bool = False):
+        """
+        Checks the combined layer for overlaps, invalid geometries and gaps, after combine_layers().
+
+        Sets self.qa_issues to the issues as a layer and self.qa_metrics to the summary.
+        With make_valid=True the invalid geometries of the combined layer are repaired.
+        """
+        with self.profile.stage('check_topology', self.combined):
+            (self.qa_issues, self.qa_metrics, gdf) = topologyqa.run_qa(
+                self.combined.gdf, gap_max_area=gap_max_area, make_valid=make_valid,
+                workers=gislayer.UNION_WORKERS)
+        if make_valid:
+            self.combined.gdf = gdf
+
+    def write_topology_report(self):
+        """Writes self.qa_issues as a _qa layer and self.qa_metrics as JSON next to the combined layer."""
+        paths = self.output_paths(suffix='_qa')
+        if NO_WRITE is not True:
+            writers.write_formats(self.qa_issues, paths, topologyqa.QA_SCHEMA_PROPS,
+                                  layer=f"MunicipalQA_{self.dataset_date.replace('-', '_')}")
+            with open(Path(self.output_folder) / f'{self.dataset_date}--{self.output_name}_qa.json', 'w') as f:
+                json.dump(self.qa_metrics, f, indent=2)
+        return paths
+
+    def write_generalized(self, tolerances=generalize.GENERALIZE_TOLERANCES):
+        """
+        Writes a simplified copy of the combined layer for each tolerance, in feet, after combine_layers().
+
+        Shared borders between municipalities are simplified once, so they stay shared.
+        """
+        paths = {}
+        for tolerance in tolerances:
+            with self.profile.stage(f'generalize_{tolerance:g}ft', self.combined):
+                generalized = generalize.generalize(self.combined.gdf, tolerance, workers=gislayer.UNION_WORKERS)
+            paths[tolerance] = self.output_paths(suffix=f'_{tolerance:g}ft')
+            if NO_WRITE is not True:
+                with self.profile.stage(f'write_{tolerance:g}ft'):
+                    writers.write_formats(generalized, paths[tolerance], OUTPUT_SCHEMA_PROPS,
+                                          layer=f"MunicipalBoundary_{tolerance:g}ft_{self.dataset_date.replace('-', '_')}")
+        return paths
+
+    def build_tiles(self, path, min_zoom: int = vectortiles.MIN_ZOOM, max_zoom: int = vectortiles.MAX_ZOOM,
+                    workers: Optional[int] = None) -> int:
+        """Builds the vector tile pyramid of the combined layer, an .mbtiles file or a folder of .pbf tiles."""
+        with self.profile.stage('build_tiles', self.combined):
+            return vectortiles.build_tiles(self.combined.gdf, path, min_zoom, max_zoom, workers)
+
+    def stream_write(self):
+        """
+        Builds the layers and appends each one to the output as soon as it is ready.
+
+        This does the same as read_layers(), combine_layers() and write(), but
+        the combined layer is never held in memory, only one layer at a time
+        (or with workers, the layer being written and one being built by each worker).
+        The output is written under a temporary name, then renamed to the
+        dataset date name when every layer is written.
+        """
+        with self.profile.stage('stream_write'):
+            self._stream_write()
+
+    def _stream_write(self):
+        if NO_WRITE is True:
+            raise RuntimeError('stream_write() always writes, turn NO_WRITE off')
+        Path(self.output_folder).mkdir(parents=True, exist_ok=True)
+        streams = [writers.StreamWriter(name, self.output_folder, OUTPUT_SCHEMA_PROPS, ALABAMA_SP_FT_WEST_CRS)
+                   for name in self.formats]
+        most_recent_datetime = None
+        self.muni_layers = []
+        try:
+            # each worker builds one layer ahead of the one being written, no more
+            for (name, layer) in self.iter_layers(max_pending=self.workers):
+                # the layers must all be in the same projection to be in one file
+                layer.set_projection(crs=ALABAMA_SP_FT_WEST_CRS)
+                self.apply_change_descriptions(layer.gdf)
+                if len(layer.gdf) > 0:
+                    layer_most_recent = max(layer.gdf['LASTUPDATE'])
+                    if most_recent_datetime is None or layer_most_recent > most_recent_datetime:
+                        most_recent_datetime = layer_most_recent
+                for stream in streams:
+                    stream.write(layer.gdf)
+                logging.info(f'streamed the {name} layer, {len(layer.gdf)} rows')
+                # only the timings are kept
+                layer.gdf = None
+                self.muni_layers.append(layer)
+            if most_recent_datetime is None:
+                raise RuntimeError('there are no rows to write, so no dataset date to name the output')
+        except BaseException:
+            for stream in streams:
+                stream.abort()
+            raise
+
+        self.dataset_date = dataset_date(most_recent_datetime)
+        paths = self.output_paths()
+        for (name, stream) in zip(self.formats, streams):
+            stream.finish(paths[name])
+
+    def incremental_write(self, state_folder=INCREMENTAL_FOLDER, code_version: Optional[str] = None,
+                          rebuild: bool = False) -> bool:
+        """
+        Rebuilds only the layers whose sources changed since the last run, then writes.
+
+        The combined layer of the last run is kept in state_folder as GeoParquet,
+        with a manifest of the source key, the GNIS codes, the rows and the newest
+        LASTUPDATE of each layer.  The rows of a changed layer are replaced in
+        place, the others (and their MUNIAREA) are kept as they are.  The first run,
+        or a run after code_version changed or with rebuild=True, rebuilds everything.
+
+        returns False when the output was already up to date and nothing was written
+        """
+        with self.profile.stage('incremental_write'):
+            return self._incremental_write(Path(state_folder), code_version, rebuild)
+
+    def _incremental_write(self, state_folder: Path, code_version: Optional[str], rebuild: bool) -> bool:
+        manifest_path = state_folder / 'manifest.json'
+        state_path = state_folder / 'combined.parquet'
+        specs = self.layer_specs()
+        keys = OrderedDict((name, layercache.source_key(layer_class, kwargs, ALABAMA_SP_FT_WEST_CRS, code_version))
+                           for (name, layer_class, kwargs) in specs)
+
+        manifest = None if rebuild else load_manifest(manifest_path, code_version)
+        previous = None
+        if manifest is not None and list(manifest['layers']) == list(keys) and state_path.exists():
+            previous = gpd.read_parquet(state_path)
+        else:
+            manifest = None
+
+        changed = [name for name in keys if manifest is None or manifest['layers'][name]['source'] != keys[name]]
+        outputs_exist = (manifest is not None and sorted(manifest['outputs']) == sorted(self.formats)
+                         and all(Path(path).exists() for path in manifest['outputs'].values()))
+        if not changed and outputs_exist:
+            logging.info('no source has changed, the output is up to date')
+            return False
+        logging.info(f'rebuilding the layers {changed}')
+
+        rebuilt = dict(self.iter_layers([spec for spec in specs if spec[0] in changed]))
+        self.muni_layers = list(rebuilt.values())
+
+        pieces = []
+        layers_manifest = OrderedDict()
+        same = manifest is not None
+        start = 0
+        for name in keys:
+            if manifest is not None:
+                # the rows of each layer are stored one layer after the other, in the order of layer_specs()
+                rows = manifest['layers'][name]['rows']
+                old = previous.iloc[start:start + rows]
+                start += rows
+            if name in rebuilt:
+                layer = rebuilt[name]
+                layer.set_projection(crs=ALABAMA_SP_FT_WEST_CRS)
+                self.apply_change_descriptions(layer.gdf)
+                gdf = writers.conform(layer.gdf, OUTPUT_SCHEMA_PROPS)
+                if manifest is not None:
+                    if gislayer.frames_equal(gdf, old):
+                        logging.info(f'the {name} source changed, but its rows did not')
+                    else:
+                        same = False
+                        gnis = set(gdf['GNIS'].dropna()) | set(old['GNIS'].dropna())
+                        logging.info(f'replacing the {name} rows, GNIS {sorted(int(g) for g in gnis)}')
+                layers_manifest[name] = {
+                    'source': keys[name],
+                    'gnis': sorted(int(g) for g in gdf['GNIS'].dropna().unique()),
+                    'rows': len(gdf),
+                    'lastupdate': str(max(gdf['LASTUPDATE'])) if len(gdf) else None,
+                }
+            else:
+                gdf = old
+                layers_manifest[name] = manifest['layers'][name]
+            pieces.append(gdf)
+
+        if same and outputs_exist:
+            logging.info('the rebuilt layers are the same as before, the output is up to date')
+            save_manifest(manifest_path, code_version, layers_manifest, manifest['outputs'])
+            return False
+
+        self.combined = gislayer.GISLayer(gdf=gpd.GeoDataFrame(pd.concat(pieces, ignore_index=True),
+                                                               crs=ALABAMA_SP_FT_WEST_CRS))
+        # the newest date of each layer is in the manifest, so the unchanged rows are not scanned
+        self.dataset_date = dataset_date(max(entry['lastupdate'] for entry in layers_manifest.values()
+                                             if entry['lastupdate'] is not None))
+        self.write()
+
+        state_folder.mkdir(parents=True, exist_ok=True)
+        tmp_path = state_path.with_name(f'{state_path.stem}.{os.getpid()}.tmp')
+        self.combined.gdf.to_parquet(tmp_path)
+        os.replace(tmp_path, state_path)
+        save_manifest(manifest_path, code_version, layers_manifest,
+                      {name: str(path) for (name, path) in self.output_paths().items()})
+        return True
+
+    def profile_records(self) -> List[dict]:
+        """Returns the stage timings of every layer and of the whole run."""
+        records = []
+        for layer in self.muni_layers:
+            records.extend(getattr(layer, 'profile', profiling.StageRecorder('')).records)
+        records.extend(self.profile.records)
+        return records
+
+    def write_profile_report(self, folder=PROFILE_FOLDER):
+        """Writes the stage timings as JSON and CSV, named with the time of the run."""
+        path_stem = Path(folder) / f"{time.strftime('%Y-%m-%dT%H%M%S')}--profile"
+        return profiling.write_report(self.profile_records(), path_stem)
+
+    def find_recent_gdb_layers(self, gdb_path, layer_prefix, count):
+        """Returns the count newest layers whose names start with layer_prefix, newest first."""
+        if self.catalog is not None:
+            return self.catalog.recent_gdb_layers(gdb_path, layer_prefix, count)
+        return sorted((x for x in fiona.listlayers(gdb_path) if x.startswith(layer_prefix)), reverse=True)[:count]
+
     # finds the most recent data set    
     def find_most_recent_gdb(self, gdb_path, layer_prefix=None):
+            if self.catalog is not None:
+                return self.catalog.latest_gdb_layer(gdb_path, layer_prefix)
             layer_list = [x for x in fiona.listlayers(gdb_path) if x.startswith(layer_prefix)]
             layer_list.sort(reverse=True)
             return layer_list[0]
 
 
     def find_most_recent_shp(self, rel_folder):
-            shp_folder = Path(self.base_folder + rel_folder)
+            found = self.find_recent_shps(rel_folder, 1)
+            return found[0] if found else None
+
+    def find_recent_shps(self, rel_folder, count):
+            """Returns the shapefiles of the count newest snapshot folders that have one, newest first."""
+            return self.find_snapshot_shps(Path(self.base_folder) / rel_folder, count)
+
+    def find_snapshot_shps(self, shp_folder, count):
+            """Like find_recent_shps(), for the dated folders in shp_folder."""
+            shp_folder = Path(shp_folder)
+            if self.catalog is not None:
+                return self.catalog.recent_shps(shp_folder, count, prefer_archives=self.prefer_archives)
             # filter out not directories
             folders = [x for x in shp_folder.iterdir() if x.is_dir()]
             folders.sort(reverse=True)
+            found = []
             for folder in folders:
-                # check for a shapefile within the folder
-                result = folder.glob('*.shp')
-                for shp_filename_path in result:
-                    return shp_filename_path
-            return None
+                # check for a shapefile (or a zipped one) within the folder
+                shp_filename_path = gislayer.find_shapefile(folder, self.prefer_archives)
+                if shp_filename_path is not None:
+                    found.append(shp_filename_path)
+                    if len(found) == count:
+                        break
+            return found
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description='Combines the municipal limits layers into one layer.')
+    parser.add_argument('command', nargs='?', choices=COMMANDS, default='run',
+                        help='run builds and writes the combined layer (the default), plan prints the sources, '
+                             'dataset date and output paths a run would have, list-snapshots prints the '
+                             'snapshots of each source.  plan and list-snapshots do not read any geometry')
+    parser.add_argument('--count', type=int, default=None,
+                        help='how many snapshots of each source list-snapshots prints (default: all)')
+    parser.add_argument('--base-folder', default=CITIES_FOLDER,
+                        help='the folder of the dated city snapshot folders')
+    parser.add_argument('--towns-gdb', default=TOWNS_GDB)
+    parser.add_argument('--athens-gdb', default=ATHENS_GDB)
+    parser.add_argument('--output-folder', default=OUTPUT_FOLDER)
+    parser.add_argument('--output-name', default=OUTPUT_NAME,
+                        help='the output files are named <date>--<output name>')
+    parser.add_argument('--workers', type=int, default=READ_WORKERS,
+                        help='number of workers used to build the layers (default: one at a time)')
+    parser.add_argument('--executor', choices=('thread', 'process'), default=READ_EXECUTOR)
+    parser.add_argument('--engine', choices=gislayer.ENGINES, default=None,
+                        help=f'the engine used to read the layers (default: {gislayer.DEFAULT_ENGINE})')
+    parser.add_argument('--chunk-rows', type=int, default=gislayer.CHUNK_ROWS,
+                        help='read and process the layers this many rows at a time, for layers too large '
+                             'for memory (default: a whole layer at a time)')
+    parser.add_argument('--union-workers', type=int, default=gislayer.UNION_WORKERS,
+                        help='number of threads used to dissolve a layer (default: one call)')
+    parser.add_argument('--format', dest='formats', action='append', choices=list(writers.FORMATS),
+                        help=f'output format, can be given more than once (default: {OUTPUT_FORMATS[0]})')
+    parser.add_argument('--stream', action='store_true',
+                        help='write each layer as soon as it is ready instead of combining them in memory '
+                             '(shapefile and flatgeobuf)')
+    parser.add_argument('--incremental', action='store_true',
+                        help='only rebuild the layers whose sources changed since the last run, '
+                             'and do not write when nothing changed')
+    parser.add_argument('--incremental-folder', default=INCREMENTAL_FOLDER,
+                        help='where --incremental keeps the last combined layer and its manifest')
+    parser.add_argument('--changes', action='store_true',
+                        help='compare the two newest snapshots of each city, fill ChangeDesc and '
+                             'write the annexations to a _changes layer')
+    parser.add_argument('--qa', action='store_true',
+                        help='check the combined layer for overlaps, invalid geometries and gaps, '
+                             'and write them to a _qa layer with a _qa.json summary')
+    parser.add_argument('--qa-make-valid', action='store_true',
+                        help='with --qa, repair the invalid geometries before writing')
+    parser.add_argument('--qa-gap-area', type=float, default=topologyqa.GAP_MAX_AREA,
+                        help='holes smaller than this, in square feet, are reported as gaps')
+    parser.add_argument('--generalize', dest='tolerances', type=float, action='append',
+                        help='also write a simplified copy of the output with this tolerance in feet, '
+                             'can be given more than once')
+    parser.add_argument('--tiles', default=None,
+                        help='build a vector tile pyramid into this .mbtiles file or folder of .pbf tiles')
+    parser.add_argument('--tile-zooms', type=int, nargs=2, default=(vectortiles.MIN_ZOOM, vectortiles.MAX_ZOOM),
+                        metavar=('MIN', 'MAX'))
+    parser.add_argument('--tile-workers', type=int, default=None,
+                        help='processes that encode the tiles (default: one per core)')
+    parser.add_argument('--registry', default=None,
+                        help='read the sources described in this TOML registry (such as sources.toml) '
+                             'instead of the built in layer classes')
+    parser.add_argument('--validate-registry', action='store_true',
+                        help='check the registry against the schema of each source, without reading any rows')
+    parser.add_argument('--catalog', default=CATALOG_PATH,
+                        help='SQLite catalog of the snapshot folders and geodatabase layers')
+    parser.add_argument('--no-catalog', action='store_true', help='scan the folders every run')
+    parser.add_argument('--prefer-archives', action='store_true',
+                        help='read zipped shapefiles in place even when an extracted copy is next to them')
+    parser.add_argument('--no-cache', action='store_true',
+                        help='do not read or write the processed layer cache')
+    parser.add_argument('--rebuild', action='store_true',
+                        help='reprocess every layer and replace its cached copy')
+    parser.add_argument('--cache-folder', default=CACHE_FOLDER)
+    parser.add_argument('--profile-folder', default=PROFILE_FOLDER,
+                        help='where the timing report of each run is written')
+    parser.add_argument('--profile', action='store_true',
+                        help='also write a cProfile dump of every stage to the profile folder '
+                             '(best with one worker, Python 3.12+ only allows one profiler at a time)')
+    parser.add_argument('--tracemalloc', action='store_true',
+                        help='measure the peak Python memory of every stage (slow)')
+    parser.add_argument('--watch', action='store_true',
+                        help='stay running, and run again when the snapshot folders or geodatabases change')
+    parser.add_argument('--watch-debounce', type=float, default=watchdaemon.DEBOUNCE_SECONDS,
+                        help='seconds without changes before a run starts')
+    parser.add_argument('--watch-port', type=int, default=watchdaemon.WATCH_PORT,
+                        help='port of the status and trigger server on localhost, 0 for none')
+    parser.add_argument('--watch-poll', action='store_true',
+                        help='watch by polling instead of inotify')
+    parser.add_argument('--cache-max-mb', type=int, default=layercache.DEFAULT_MAX_BYTES // (1024 * 1024),
+                        help='the least recently used layers are evicted past this size')
+    return parser.parse_args(argv)
+
+
+def check_args(args) -> None:
+    """Exits when args has options that cannot be used together."""
+    if args.incremental and args.stream:
+        raise SystemExit('--incremental and --stream cannot be used together')
+    if args.stream and (args.qa or args.tolerances or args.tiles):
+        raise SystemExit('--qa, --generalize and --tiles need the combined layer, they cannot be used with --stream')
+    if args.qa_make_valid and args.incremental:
+        raise SystemExit('--qa-make-valid repairs before writing, it cannot be used with --incremental')
+    if args.watch and (args.validate_registry or args.command != 'run'):
+        raise SystemExit('--watch only works with run, and not with --validate-registry')
+
+
+def code_files() -> List[Path]:
+    """Returns the source files whose changes invalidate the cached layers."""
+    return sorted(Path(f) for f in [__file__, gislayer.__file__, layercache.__file__, snapshotcatalog.__file__,
+                                    sourceregistry.__file__])
+
+
+def make_geoprocess(args) -> MunicipalLimitsGeoProcess:
+    """Returns a MunicipalLimitsGeoProcess set up from the command line options."""
+    cache = None
+    # only run reads and writes the cached layers
+    if not args.no_cache and args.command == 'run':
+        cache = layercache.LayerCache(args.cache_folder, 
+                                      max_bytes=args.cache_max_mb * 1024 * 1024,
+                                      code_files=code_files(),
+                                      rebuild=args.rebuild)
+    
+    #### THIS IS THE NEW LOCATION TO STORE ALL OF THE CITY LIMIT DATA FOR ETL PROCESSING ####
+    # see CITIES_FOLDER
+    folder = args.base_folder
+    catalog = None if args.no_catalog else snapshotcatalog.SnapshotCatalog(args.catalog)
+    mlgp = MunicipalLimitsGeoProcess(folder, workers=args.workers, executor=args.executor, cache=cache,
+                                     engine=args.engine, formats=args.formats or OUTPUT_FORMATS,
+                                     catalog=catalog, prefer_archives=args.prefer_archives,
+                                     registry=load_registry(args.registry) if args.registry else None,
+                                     towns_gdb=args.towns_gdb, athens_gdb=args.athens_gdb,
+                                     output_folder=args.output_folder, output_name=args.output_name)
+    return mlgp
+
+
+def run(args) -> MunicipalLimitsGeoProcess:
+    """Does one run with the command line options, returns the MunicipalLimitsGeoProcess."""
+    mlgp = make_geoprocess(args)
+    if args.changes:
+        mlgp.detect_changes()
+    written = True
+    if args.stream:
+        mlgp.stream_write()
+    elif args.incremental:
+        # --rebuild also starts the incremental state over
+        written = mlgp.incremental_write(args.incremental_folder, rebuild=args.rebuild,
+                                         code_version=layercache.fingerprint(code_files()))
+        if args.qa and written:
+            mlgp.check_topology(args.qa_gap_area)
+    else:
+        mlgp.read_layers()
+        mlgp.combine_layers()
+        if args.qa:
+            mlgp.check_topology(args.qa_gap_area, make_valid=args.qa_make_valid)
+        mlgp.write()
+    if args.qa and written:
+        mlgp.write_topology_report()
+    if args.tolerances and written:
+        mlgp.write_generalized(args.tolerances)
+    if args.tiles and written:
+        mlgp.build_tiles(args.tiles, *args.tile_zooms, workers=args.tile_workers)
+    if args.changes and written:
+        mlgp.write_changes()
+    mlgp.write_profile_report(args.profile_folder)
+    return mlgp
+
+
+def watch_paths(args) -> List[Path]:
+    """Returns the folders and files whose changes start a run with --watch."""
+    if args.registry:
+        paths = [Path(args.registry)]
+        for source in load_registry(args.registry):
+            paths.append(source.snapshots if source.snapshots is not None else gislayer.vsi_archive(source.path))
+    else:
+        paths = [Path(args.base_folder), gislayer.vsi_archive(args.towns_gdb), gislayer.vsi_archive(args.athens_gdb)]
+    return [p for p in paths if p.exists()]
 
 
 if __name__ == '__main__':
+    args = parse_args()
     # DEBUG is a bit chatty
     # logging.basicConfig(format='%(levelname)s : %(message)s', level=logging.DEBUG)
     logging.basicConfig(format='%(levelname)s : %(message)s', level=logging.INFO)
     logging.info( "Started:  {0}".format(time.asctime()) )
-    
-    #### THIS IS THE NEW LOCATION TO STORE ALL OF THE CITY LIMIT DATA FOR ETL PROCESSING ####
-    folder = './municipal_limits/cities/'
-    mlgp = MunicipalLimitsGeoProcess(folder)
-    mlgp.read_layers()
-    mlgp.combine_layers()
-    mlgp.write()
+
+    gislayer.UNION_WORKERS = args.union_workers
+    gislayer.CHUNK_ROWS = args.chunk_rows
+    profiling.configure(cprofile_folder=args.profile_folder if args.profile else None,
+                        trace_memory=args.tracemalloc)
+    check_args(args)
+
+    if args.validate_registry:
+        mlgp = make_geoprocess(args)
+        if mlgp.registry is None:
+            raise SystemExit('--validate-registry needs --registry')
+        problems = mlgp.validate_registry()
+        for problem in problems:
+            logging.error(problem)
+        raise SystemExit(1 if problems else 0)
+    if args.command == 'plan':
+        print(json.dumps(make_geoprocess(args).plan(), indent=2))
+    elif args.command == 'list-snapshots':
+        print(json.dumps(make_geoprocess(args).list_snapshots(args.count), indent=2))
+    elif args.watch:
+        # the imports stay loaded between runs, --rebuild only applies to the first one
+        def watched_run():
+            run(args)
+            args.rebuild = False
+        daemon = watchdaemon.WatchDaemon(watched_run, watch_paths(args), debounce=args.watch_debounce,
+                                         port=args.watch_port or None, poll=args.watch_poll)
+        daemon.serve_forever()
+    else:
+        run(args)
     
     logging.info( "Ended:  {0}".format(time.asctime()) )
 
@@ -0,0 +1,190 @@
+"""
+Looks up the municipality that points are in, using the combined municipal limits layer.
+
+The polygons of the combined layer (the output of MunicipalLimitsGeoProcess)
+are put in a shapely STRtree and prepared.  Coordinates are given as NumPy
+arrays, any number at a time, and the GNIS code and NAME of each point are
+returned as arrays:
+
+    index = municipallookup.MunicipalityIndex.load_or_build('municipal_limits/2021-02-23--limestone_co_municipal_limits.shp',
+                                                            'municipal_limits/.lookup.pickle')
+    result = index.lookup(lon, lat, crs='EPSG:4326')
+    result.gnis, result.name, result.on_boundary
+
+A point on the boundary of a municipality is in it.  A point on the boundary
+between two municipalities goes to the one that comes first in the layer,
+unless it is inside the other.  Points outside of every municipality
+(unincorporated areas) get UNINCORPORATED_GNIS and UNINCORPORATED_NAME.
+"""
+
+from __future__ import annotations
+
+import logging
+import os
+import pickle
+from pathlib import Path
+from typing import NamedTuple, Optional
+
+import gislayer
+import layercache
+
+# imports from external libraries, that may have to be installed, loaded when first used
+gpd = gislayer.lazy_import('geopandas')
+np = gislayer.lazy_import('numpy')
+shapely = gislayer.lazy_import('shapely')
+
+# Bump this when the saved index changes.
+INDEX_FORMAT_VERSION = 1
+
+# Points looked up in one vectorized call.  Larger batches are faster, but use more memory.
+LOOKUP_BATCH_SIZE = 500000
+
+# What a point outside of every municipality gets.
+UNINCORPORATED_GNIS = 0
+UNINCORPORATED_NAME = None
+
+
+class LookupResult(NamedTuple):
+    gnis: np.ndarray          # int64, UNINCORPORATED_GNIS where there is no municipality
+    name: np.ndarray          # object, UNINCORPORATED_NAME where there is no municipality
+    on_boundary: np.ndarray   # bool, True when the point is on the boundary of its municipality
+
+
+class MunicipalityIndex(object):
+    """
+    An STRtree of the polygons of a municipal limits layer with their GNIS codes and names.
+
+    Multipolygons are split into their parts, so the tree has tight bounding boxes.
+    """
+    def __init__(self, gdf: gpd.GeoDataFrame, source_fingerprint: Optional[str] = None):
+        gdf = gdf[gdf.geometry.notna() & ~gdf.geometry.is_empty]
+        parts = gdf[['GNIS', 'NAME', gdf.geometry.name]].explode(index_parts=False)
+        self.crs = gdf.crs
+        self.geometries = np.asarray(parts.geometry.values, dtype=object)
+        self.gnis = parts['GNIS'].fillna(UNINCORPORATED_GNIS).to_numpy(dtype='int64')
+        self.name = parts['NAME'].to_numpy(dtype=object)
+        self.source_fingerprint = source_fingerprint
+        self._build()
+
+    def _build(self):
+        # prepared polygons make the point in polygon tests much faster
+        shapely.prepare(self.geometries)
+        self.tree = shapely.STRtree(self.geometries)
+
+    @classmethod
+    def from_file(cls, filename, layer: Optional[str] = None, engine: Optional[str] = None):
+        """Builds the index of a combined layer written by MunicipalLimitsGeoProcess."""
+        gdf = gislayer.read_file(str(filename), layer=layer, engine=engine, columns=['GNIS', 'NAME'])
+        return cls(gdf, source_fingerprint=layercache.fingerprint(layercache.source_files(filename)))
+
+    @classmethod
+    def from_geoprocess(cls, mlgp):
+        """Builds the index of the combined layer of a MunicipalLimitsGeoProcess, after combine_layers()."""
+        return cls(mlgp.combined.gdf)
+
+    def save(self, path) -> None:
+        """Saves the index, the tree is built again when it is loaded."""
+        path = Path(path)
+        path.parent.mkdir(parents=True, exist_ok=True)
+        state = {
+            'version': INDEX_FORMAT_VERSION,
+            'crs': None if self.crs is None else gislayer.get_crs(self.crs).to_wkt(),
+            'wkb': shapely.to_wkb(self.geometries),
+            'gnis': self.gnis,
+            'name': self.name,
+            'source_fingerprint': self.source_fingerprint,
+        }
+        # write to a temporary name first so a reader never sees half a file
+        tmp_path = path.with_name(f'{path.name}.{os.getpid()}.tmp')
+        with open(tmp_path, 'wb') as f:
+            pickle.dump(state, f, protocol=pickle.HIGHEST_PROTOCOL)
+        os.replace(tmp_path, path)
+
+    @classmethod
+    def load(cls, path) -> 'MunicipalityIndex':
+        with open(path, 'rb') as f:
+            state = pickle.load(f)
+        if state.get('version') != INDEX_FORMAT_VERSION:
+            raise ValueError(f'{path} is version {state.get("version")} of the index, '
+                             f'not {INDEX_FORMAT_VERSION}')
+        index = cls.__new__(cls)
+        index.crs = state['crs']
+        index.geometries = shapely.from_wkb(state['wkb'])
+        index.gnis = state['gnis']
+        index.name = state['name']
+        index.source_fingerprint = state['source_fingerprint']
+        index._build()
+        return index
+
+    @classmethod
+    def load_or_build(cls, filename, index_path, layer: Optional[str] = None) -> 'MunicipalityIndex':
+        """Loads the saved index of filename, building (and saving) it again when filename changed."""
+        fingerprint = layercache.fingerprint(layercache.source_files(filename))
+        try:
+            index = cls.load(index_path)
+            if index.source_fingerprint == fingerprint:
+                return index
+            logging.info(f'{filename} changed, building the lookup index again')
+        except FileNotFoundError:
+            pass
+        except (ValueError, pickle.UnpicklingError) as err:
+            logging.warning(f'building the lookup index again, {err}')
+        index = cls.from_file(filename, layer=layer)
+        index.save(index_path)
+        return index
+
+    def lookup(self, x, y, crs=None, batch_size: int = LOOKUP_BATCH_SIZE,
+               workers: Optional[int] = None) -> LookupResult:
+        """
+        Returns the municipality of each point (x[i], y[i]).
+
+        crs is the CRS of the coordinates, when it is not the CRS of the layer
+        the points are reprojected.  The points are looked up batch_size at a
+        time, on a pool of workers threads when workers is more than 1 (shapely
+        releases the GIL).
+        """
+        x = np.asarray(x, dtype='float64')
+        y = np.asarray(y, dtype='float64')
+        if x.shape != y.shape or x.ndim != 1:
+            raise ValueError(f'x and y must be 1 dimensional arrays of the same length, not {x.shape} and {y.shape}')
+        if crs is not None and self.crs is not None and not gislayer.crs_equal(crs, self.crs):
+            (x, y) = gislayer.get_transformer(crs, self.crs).transform(x, y)
+
+        found = np.full(len(x), -1, dtype='int64')
+        on_boundary = np.zeros(len(x), dtype=bool)
+        starts = range(0, len(x), batch_size)
+        if workers is None or workers <= 1 or len(starts) <= 1:
+            for start in starts:
+                self._lookup_batch(x, y, start, start + batch_size, found, on_boundary)
+        else:
+            with gislayer.make_pool(workers) as pool:
+                # each batch fills its own slice of found and on_boundary
+                futures = [pool.submit(self._lookup_batch, x, y, start, start + batch_size, found, on_boundary)
+                           for start in starts]
+                for future in futures:
+                    future.result()
+
+        inside = found >= 0
+        gnis = np.full(len(x), UNINCORPORATED_GNIS, dtype='int64')
+        gnis[inside] = self.gnis[found[inside]]
+        name = np.full(len(x), UNINCORPORATED_NAME, dtype=object)
+        name[inside] = self.name[found[inside]]
+        return LookupResult(gnis, name, on_boundary)
+
+    def _lookup_batch(self, x, y, start: int, stop: int, found: np.ndarray, on_boundary: np.ndarray) -> None:
+        """Sets found to the polygon index (-1 for none) and on_boundary for the points from start to stop."""
+        points = shapely.points(x[start:stop], y[start:stop])
+        # candidates by bounding box, then the exact test against the prepared polygons
+        (point_index, polygon_index) = self.tree.query(points)
+        hit = shapely.intersects(self.geometries[polygon_index], points[point_index])
+        (point_index, polygon_index) = (point_index[hit], polygon_index[hit])
+        if len(point_index) == 0:
+            return
+        touches = shapely.touches(self.geometries[polygon_index], points[point_index])
+
+        # for each point, a polygon it is inside of before one it is on the boundary of, then layer order
+        order = np.lexsort((polygon_index, touches, point_index))
+        (point_index, polygon_index, touches) = (point_index[order], polygon_index[order], touches[order])
+        first = np.unique(point_index, return_index=True)[1]
+        found[start + point_index[first]] = polygon_index[first]
+        on_boundary[start + point_index[first]] = touches[first]
@@ -0,0 +1,153 @@
+"""
+Timing and memory measurements for each stage of the geoprocessing.
+
+Every stage that runs inside StageRecorder.stage() gets a record with the wall
+time, the CPU time of the thread, the peak RSS of the process, the rows and
+vertices of the layer afterwards and, when turned on, the tracemalloc peak and
+a cProfile dump.
+"""
+
+import cProfile
+import csv
+import json
+import logging
+import re
+import time
+import tracemalloc
+from contextlib import contextmanager
+from pathlib import Path
+from typing import Iterable, List, Optional
+
+try:
+    import resource
+except ImportError:
+    # Windows
+    resource = None
+
+import gislayer
+
+# imports from external libraries, that may have to be installed, loaded when first used
+np = gislayer.lazy_import('numpy')
+shapely = gislayer.lazy_import('shapely')
+
+# When set to a folder, a cProfile dump is written there for every stage.
+CPROFILE_FOLDER = None
+# When True, tracemalloc measures the peak Python memory of every stage.
+# This slows everything down, and stages running at the same time in
+# threads are counted together.
+TRACEMALLOC = False
+
+REPORT_FIELDS = ['layer', 'source', 'stage', 'wall_s', 'cpu_s', 'peak_rss_mb',
+                 'tracemalloc_peak_mb', 'rows', 'vertices']
+
+
+def configure(cprofile_folder=None, trace_memory: bool = False) -> None:
+    """Sets the module options.  Also used as the initializer of process pools."""
+    global CPROFILE_FOLDER, TRACEMALLOC
+    CPROFILE_FOLDER = cprofile_folder
+    TRACEMALLOC = trace_memory
+    if TRACEMALLOC and not tracemalloc.is_tracing():
+        tracemalloc.start()
+
+
+def peak_rss_mb() -> Optional[float]:
+    """Returns the peak resident set size of this process in MiB, None if not known."""
+    if resource is None:
+        return None
+    maxrss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # kilobytes on Linux, bytes on macOS
+    if maxrss > 1 << 32:
+        return maxrss / (1024 * 1024)
+    return maxrss / 1024
+
+
+def vertex_count(gdf) -> Optional[int]:
+    """Returns the total number of coordinates in the geometry of gdf."""
+    if gdf is None or len(gdf) == 0:
+        return None
+    try:
+        return int(shapely.get_num_coordinates(np.asarray(gdf.geometry.values)).sum())
+    except AttributeError:
+        # no geometry column
+        return None
+
+
+class StageRecorder(object):
+    """Records measurements of the stages of one layer (or of the whole run)."""
+    def __init__(self, layer_name: str, source=None):
+        self.layer_name = layer_name
+        self.source = None if source is None else str(source)
+        self.records = []
+
+    @contextmanager
+    def stage(self, stage: str, layer=None):
+        """
+        Measures the code run inside the with block.
+
+        layer is an object with a gdf attribute, its rows and vertices are
+        counted at the end of the stage.
+        """
+        profiler = None
+        if CPROFILE_FOLDER is not None:
+            profiler = cProfile.Profile()
+        if TRACEMALLOC and tracemalloc.is_tracing():
+            tracemalloc.reset_peak()
+            traced_start = tracemalloc.get_traced_memory()[0]
+
+        wall_start = time.perf_counter()
+        cpu_start = time.thread_time()
+        if profiler is not None:
+            profiler.enable()
+        try:
+            yield
+        finally:
+            if profiler is not None:
+                profiler.disable()
+            cpu = time.thread_time() - cpu_start
+            wall = time.perf_counter() - wall_start
+
+            record = {
+                'layer': self.layer_name,
+                'source': self.source,
+                'stage': stage,
+                'wall_s': wall,
+                'cpu_s': cpu,
+                'peak_rss_mb': peak_rss_mb(),
+                'tracemalloc_peak_mb': None,
+                'rows': None,
+                'vertices': None,
+            }
+            if TRACEMALLOC and tracemalloc.is_tracing():
+                record['tracemalloc_peak_mb'] = (tracemalloc.get_traced_memory()[1] - traced_start) / (1024 * 1024)
+            gdf = getattr(layer, 'gdf', None)
+            if gdf is not None:
+                record['rows'] = len(gdf)
+                record['vertices'] = vertex_count(gdf)
+            self.records.append(record)
+            logging.debug(f'{self.layer_name} {stage}: {wall:.3f}s wall, {cpu:.3f}s cpu')
+
+            if profiler is not None:
+                Path(CPROFILE_FOLDER).mkdir(parents=True, exist_ok=True)
+                name = re.sub(r'[^\w.-]', '_', f'{self.layer_name}.{stage}')
+                profiler.dump_stats(str(Path(CPROFILE_FOLDER) / f'{name}.{len(self.records)}.prof'))
+
+
+def write_report(records: Iterable[dict], path_stem) -> List[Path]:
+    """
+    Writes the records as path_stem.json and path_stem.csv.
+
+    returns the paths that were written
+    """
+    records = list(records)
+    json_path = Path(f'{path_stem}.json')
+    csv_path = Path(f'{path_stem}.csv')
+    json_path.parent.mkdir(parents=True, exist_ok=True)
+
+    with open(json_path, 'w') as f:
+        json.dump(records, f, indent=2)
+    with open(csv_path, 'w', newline='') as f:
+        writer = csv.DictWriter(f, fieldnames=REPORT_FIELDS, extrasaction='ignore')
+        writer.writeheader()
+        writer.writerows(records)
+    logging.info(f'wrote profile report {json_path} and {csv_path}')
+    return [json_path, csv_path]
@@ -0,0 +1,198 @@
+"""
+A SQLite catalog of the dated snapshot folders of each city and the layers of each File GeoDatabase.
+
+Scanning the folders (and listing the layers of a geodatabase) is only redone
+when the modification time of the folder changed, so asking for the latest
+snapshot of a city is usually one stat and one indexed query.
+"""
+
+import datetime
+import logging
+import os
+import sqlite3
+from contextlib import closing
+from pathlib import Path
+from typing import List, Optional, Tuple, Union
+
+import dateutil.parser
+
+import gislayer
+
+# Bump this when SCHEMA changes, an older catalog is dropped and rebuilt.
+SCHEMA_VERSION = 2
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS folders (
+    path TEXT PRIMARY KEY,
+    mtime_ns INTEGER NOT NULL
+);
+CREATE TABLE IF NOT EXISTS snapshots (
+    city_folder TEXT NOT NULL,
+    folder TEXT NOT NULL,
+    snapshot_date TEXT,
+    shp_path TEXT,
+    shp_size INTEGER,
+    shp_mtime_ns INTEGER,
+    zip_path TEXT,
+    PRIMARY KEY (city_folder, folder)
+);
+CREATE INDEX IF NOT EXISTS snapshots_latest ON snapshots (city_folder, folder DESC);
+CREATE TABLE IF NOT EXISTS gdb_layers (
+    gdb_path TEXT NOT NULL,
+    layer TEXT NOT NULL,
+    PRIMARY KEY (gdb_path, layer)
+);
+"""
+
+
+def parse_date(folder_name: str) -> Optional[datetime.date]:
+    """Returns the date of a "YYYY MM DD" folder name, None if it is not a date."""
+    try:
+        return datetime.datetime.strptime(folder_name, '%Y %m %d').date()
+    except ValueError:
+        pass
+    # other date formats
+    try:
+        return dateutil.parser.parse(folder_name).date()
+    except (ValueError, OverflowError):
+        return None
+
+
+class SnapshotCatalog(object):
+    def __init__(self, db_path):
+        self.db_path = str(db_path)
+        Path(self.db_path).parent.mkdir(parents=True, exist_ok=True)
+        with closing(self.connect()) as conn, conn:
+            if conn.execute('PRAGMA user_version').fetchone()[0] != SCHEMA_VERSION:
+                # the catalog only holds what a rescan finds again
+                conn.executescript('DROP TABLE IF EXISTS folders; DROP TABLE IF EXISTS snapshots; '
+                                   'DROP TABLE IF EXISTS gdb_layers;')
+                conn.execute(f'PRAGMA user_version = {SCHEMA_VERSION}')
+            conn.executescript(SCHEMA)
+
+    def connect(self) -> sqlite3.Connection:
+        # a connection for each call, so the catalog can be used from any thread
+        return sqlite3.connect(self.db_path, timeout=30)
+
+    def _folder_changed(self, conn, path: str) -> Tuple[bool, int]:
+        """Returns (True if the mtime of path is not the one stored, the current mtime)."""
+        # for a /vsizip/ path this is the archive
+        mtime_ns = os.stat(gislayer.vsi_archive(path)).st_mtime_ns
+        row = conn.execute('SELECT mtime_ns FROM folders WHERE path = ?', (path,)).fetchone()
+        return (row is None or row[0] != mtime_ns, mtime_ns)
+
+    def refresh_city(self, city_folder) -> None:
+        """
+        Brings the snapshots of city_folder up to date.
+
+        The folders are only scanned again when the city folder changed (a
+        snapshot folder was added or removed).  Snapshot folders without a
+        shapefile (extracted or zipped) yet, such as ones still being copied,
+        are checked every time.
+        """
+        city_folder = str(Path(city_folder))
+        with closing(self.connect()) as conn, conn:
+            (changed, mtime_ns) = self._folder_changed(conn, city_folder)
+            if changed:
+                logging.debug(f'scanning snapshot folders in {city_folder}')
+                folders = [entry for entry in os.scandir(city_folder) if entry.is_dir()]
+                conn.execute('DELETE FROM snapshots WHERE city_folder = ?', (city_folder,))
+                for entry in folders:
+                    self._record_snapshot(conn, city_folder, entry.name)
+                conn.execute('INSERT OR REPLACE INTO folders (path, mtime_ns) VALUES (?, ?)',
+                             (city_folder, mtime_ns))
+            else:
+                pending = conn.execute('SELECT folder FROM snapshots WHERE city_folder = ? '
+                                       'AND shp_path IS NULL AND zip_path IS NULL',
+                                       (city_folder,)).fetchall()
+                for (folder,) in pending:
+                    self._record_snapshot(conn, city_folder, folder)
+
+    def _record_snapshot(self, conn, city_folder: str, folder: str) -> None:
+        folder_path = Path(city_folder) / folder
+        (shp, zipped) = (None, None)
+        if folder_path.is_dir():
+            shp = gislayer.find_shapefile(folder_path)
+            zipped = gislayer.find_shapefile(folder_path, prefer_archives=True)
+            if isinstance(shp, str):
+                # there is only the zipped one
+                shp = None
+            if isinstance(zipped, Path):
+                zipped = None
+        snapshot_date = parse_date(folder)
+        (size, mtime_ns) = (None, None)
+        if shp is not None:
+            stat = shp.stat()
+            (size, mtime_ns) = (stat.st_size, stat.st_mtime_ns)
+        conn.execute('INSERT OR REPLACE INTO snapshots VALUES (?, ?, ?, ?, ?, ?, ?)',
+                     (city_folder, folder, snapshot_date.isoformat() if snapshot_date else None,
+                      None if shp is None else str(shp), size, mtime_ns, zipped))
+
+    def snapshots(self, city_folder) -> List[Tuple[str, Optional[str], Optional[str]]]:
+        """Returns (folder, snapshot date, shapefile path) of each snapshot, newest first."""
+        self.refresh_city(city_folder)
+        with closing(self.connect()) as conn:
+            return conn.execute('SELECT folder, snapshot_date, shp_path FROM snapshots '
+                                'WHERE city_folder = ? ORDER BY folder DESC',
+                                (str(Path(city_folder)),)).fetchall()
+
+    def latest_shp(self, city_folder, prefer_archives: bool = False) -> Optional[Union[Path, str]]:
+        """
+        Returns the shapefile in the newest snapshot folder that has one, like find_most_recent_shp().
+
+        A zipped shapefile is returned as a /vsizip/ path string.
+        """
+        found = self.recent_shps(city_folder, 1, prefer_archives)
+        return found[0] if found else None
+
+    def recent_shps(self, city_folder, count: Optional[int], prefer_archives: bool = False) -> List[Union[Path, str]]:
+        """Returns the shapefiles of the newest count snapshot folders that have one, newest first.  (None for all)"""
+        self.refresh_city(city_folder)
+        with closing(self.connect()) as conn:
+            rows = conn.execute('SELECT shp_path, zip_path FROM snapshots WHERE city_folder = ? '
+                                'AND (shp_path IS NOT NULL OR zip_path IS NOT NULL) '
+                                'ORDER BY folder DESC LIMIT ?',
+                                (str(Path(city_folder)), -1 if count is None else count)).fetchall()
+        found = []
+        for (shp_path, zip_path) in rows:
+            if zip_path is not None and (prefer_archives or shp_path is None):
+                found.append(zip_path)
+            else:
+                found.append(Path(shp_path))
+        return found
+
+    def snapshot_date(self, shp_path) -> Optional[datetime.date]:
+        """Returns the stored date of the snapshot folder a shapefile (or its zip archive) is in."""
+        folder = gislayer.dataset_folder(shp_path)
+        with closing(self.connect()) as conn:
+            row = conn.execute('SELECT snapshot_date FROM snapshots WHERE city_folder = ? AND folder = ?',
+                               (str(folder.parent), folder.name)).fetchone()
+        if row is None or row[0] is None:
+            return None
+        return datetime.date.fromisoformat(row[0])
+
+    def gdb_layers(self, gdb_path) -> List[str]:
+        """Returns the layer names of a File GeoDatabase, only listing them again when it changed."""
+        if not str(gdb_path).startswith(gislayer.VSIZIP_PREFIX):
+            gdb_path = str(Path(gdb_path))
+        with closing(self.connect()) as conn, conn:
+            (changed, mtime_ns) = self._folder_changed(conn, gdb_path)
+            if changed:
+                import fiona
+                logging.debug(f'listing the layers of {gdb_path}')
+                layers = fiona.listlayers(gdb_path)
+                conn.execute('DELETE FROM gdb_layers WHERE gdb_path = ?', (gdb_path,))
+                conn.executemany('INSERT INTO gdb_layers VALUES (?, ?)', [(gdb_path, l) for l in layers])
+                conn.execute('INSERT OR REPLACE INTO folders (path, mtime_ns) VALUES (?, ?)',
+                             (gdb_path, mtime_ns))
+                return list(layers)
+            return [row[0] for row in conn.execute('SELECT layer FROM gdb_layers WHERE gdb_path = ?', (gdb_path,))]
+
+    def latest_gdb_layer(self, gdb_path, layer_prefix: str) -> Optional[str]:
+        """Returns the last layer name, in sorted order, that starts with layer_prefix."""
+        layers = self.recent_gdb_layers(gdb_path, layer_prefix, 1)
+        return layers[0] if layers else None
+
+    def recent_gdb_layers(self, gdb_path, layer_prefix: str, count: int) -> List[str]:
+        """Returns the last count layer names, in reverse sorted order, that start with layer_prefix."""
+        return sorted((l for l in self.gdb_layers(gdb_path) if l.startswith(layer_prefix)), reverse=True)[:count]
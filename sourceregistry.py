@@ -0,0 +1,209 @@
+"""
+A declarative registry of the sources of the combined layer.
+
+Each source is a [[source]] table in a TOML file (see sources.toml):
+
+    [[source]]
+    name = "huntsville"
+    snapshots = "municipal_limits/cities/huntsville"   # dated "YYYY MM DD" folders, the newest is read
+    lastupdate = "max:Eff_Date"                         # or "folder_date", by default the LASTUPDATE field
+    rename = { CityName = "NAME" }
+    constants = { GNIS = 2404746, MUNITYP = "City" }
+
+    [[source]]
+    name = "towns"
+    path = "municipal_limits/MunicipalLimits.gdb"       # a file or geodatabase that is read as is
+    driver = "OpenFileGDB"
+    layer = "MunicipalBoundary"                         # or layer_prefix, the last layer by name is read
+    filter = [{ MUNITYP = "Town" }, { NAME = "Ardmore" }]   # rows matching any of the tables
+    dissolve = true                                     # or a field name (or list) to dissolve by
+
+Paths are relative to the registry file.  The sources are combined in the
+order they are listed.
+
+A source is compiled once into a column projection, a rename and an assign
+(see CompiledSource.apply_columns()), and its filter into both an SQL WHERE
+clause for the driver and a vectorized mask.
+"""
+
+from __future__ import annotations
+
+import json
+from collections import OrderedDict
+from pathlib import Path
+from typing import Callable, Dict, List, Optional
+
+import gislayer
+
+# imports from external libraries, that may have to be installed, loaded when first used
+gpd = gislayer.lazy_import('geopandas')
+np = gislayer.lazy_import('numpy')
+pd = gislayer.lazy_import('pandas')
+
+SOURCE_KEYS = {'name', 'path', 'snapshots', 'driver', 'layer', 'layer_prefix', 'required',
+               'rename', 'constants', 'lastupdate', 'filter', 'dissolve'}
+
+
+class RegistryError(ValueError):
+    """Raised when a registry entry is not valid."""
+
+
+def sql_literal(value) -> str:
+    if isinstance(value, bool):
+        return '1' if value else '0'
+    if isinstance(value, (int, float)):
+        return repr(value)
+    return "'" + str(value).replace("'", "''") + "'"
+
+
+class CompiledSource(object):
+    """One registry entry, checked and compiled into the operations that make it into the output schema."""
+    def __init__(self, entry: dict, root: Path, schema_props: OrderedDict, computed_fields=()):
+        unknown = set(entry) - SOURCE_KEYS
+        if unknown:
+            raise RegistryError(f'unknown keys {sorted(unknown)} in source {entry.get("name")!r}')
+        if 'name' not in entry:
+            raise RegistryError(f'a source has no name: {entry}')
+        self.name = entry['name']
+        if ('path' in entry) == ('snapshots' in entry):
+            raise RegistryError(f'source {self.name!r} needs one of path or snapshots')
+        if 'layer' in entry and 'layer_prefix' in entry:
+            raise RegistryError(f'source {self.name!r} can have layer or layer_prefix, not both')
+        self.entry = entry
+        self.path = root / entry['path'] if 'path' in entry else None
+        self.snapshots = root / entry['snapshots'] if 'snapshots' in entry else None
+        self.driver = entry.get('driver')
+        self.layer = entry.get('layer')
+        self.layer_prefix = entry.get('layer_prefix')
+        self.rename = dict(entry.get('rename', {}))
+        self.constants = dict(entry.get('constants', {}))
+        self.filters = [dict(f) for f in entry.get('filter', [])]
+
+        output_fields = [field for field in schema_props]
+        self.output_fields = output_fields
+        # output fields that are always calculated, such as the area
+        self.computed_fields = set(computed_fields)
+        for target in list(self.rename.values()) + list(self.constants):
+            if target not in output_fields:
+                raise RegistryError(f'source {self.name!r} sets {target!r}, which is not in the output schema')
+
+        lastupdate = entry.get('lastupdate', 'field')
+        if lastupdate in ('field', 'folder_date'):
+            (self.lastupdate, self.lastupdate_field) = (lastupdate, None)
+        elif lastupdate.startswith('max:'):
+            (self.lastupdate, self.lastupdate_field) = ('max', lastupdate[len('max:'):])
+        else:
+            raise RegistryError(f'lastupdate of source {self.name!r} must be "field", "folder_date" '
+                                f'or "max:<field>", not {lastupdate!r}')
+
+        dissolve = entry.get('dissolve', False)
+        if dissolve is True or dissolve is False:
+            self.dissolve = dissolve
+        else:
+            self.dissolve = [dissolve] if isinstance(dissolve, str) else list(dissolve)
+
+        # the fields the steps below read from the source
+        filter_fields = [field for f in self.filters for field in f]
+        self.required_fields = tuple(OrderedDict.fromkeys(
+            list(entry.get('required', [])) + list(self.rename) + filter_fields
+            + ([self.lastupdate_field] if self.lastupdate_field else [])))
+        # the source fields that go to the output as they are, and the ones the steps need
+        self.read_columns = list(OrderedDict.fromkeys(
+            [f for f in output_fields if f not in self.targets()] + list(self.required_fields)
+            + (self.dissolve if isinstance(self.dissolve, list) else [])))
+        self.where = None
+        if self.filters:
+            self.where = ' OR '.join('(' + ' AND '.join(f'{field} = {sql_literal(value)}'
+                                                         for (field, value) in f.items()) + ')'
+                                     for f in self.filters)
+
+    def targets(self) -> set:
+        """Returns the output fields that are made by this source rather than read as they are."""
+        targets = set(self.rename.values()) | set(self.constants) | self.computed_fields
+        if self.lastupdate != 'field':
+            targets.add('LASTUPDATE')
+        return targets
+
+    def __repr__(self):
+        # used in the layer cache key, so it only depends on the entry
+        return f'CompiledSource({json.dumps(self.entry, sort_keys=True, default=str)})'
+
+    def mask(self, gdf: pd.DataFrame) -> np.ndarray:
+        """Returns True for the rows that match any of the filters."""
+        mask = np.zeros(len(gdf), dtype=bool)
+        for f in self.filters:
+            match = np.ones(len(gdf), dtype=bool)
+            for (field, value) in f.items():
+                match &= (gdf[field] == value).to_numpy()
+            mask |= match
+        return mask
+
+    def lastupdate_value(self, gdf: pd.DataFrame, folder_date=None):
+        """Returns the LASTUPDATE to assign to every row, None when the field is read from the source."""
+        if self.lastupdate == 'folder_date':
+            return folder_date
+        if self.lastupdate == 'max':
+            if len(gdf) == 0:
+                # a chunk with no rows left after filtering
+                return None
+            return pd.Timestamp(max(gdf[self.lastupdate_field]))
+        return None
+
+    def apply_columns(self, gdf: gpd.GeoDataFrame, lastupdate=None,
+                      computed: Optional[Dict[str, Callable]] = None) -> gpd.GeoDataFrame:
+        """
+        Returns gdf with only the output fields, in one projection, one rename and one assign.
+
+        computed is {field: function of the frame} of fields to assign as well, such as the area.
+        """
+        geometry_name = gdf.geometry.name
+        targets = self.targets()
+        keep = [c for c in gdf.columns
+                if c != geometry_name and (c in self.rename or (c in self.output_fields and c not in targets))]
+        assignments = dict(self.constants)
+        if lastupdate is not None:
+            assignments['LASTUPDATE'] = lastupdate
+        assignments.update(computed or {})
+        return gdf[keep + [geometry_name]].rename(columns=self.rename).assign(**assignments)
+
+    def check_fields(self, fields: List[str]) -> List[str]:
+        """Returns the problems with this source for a layer with fields, found without reading any rows."""
+        missing = [f for f in self.required_fields if f not in fields]
+        if missing:
+            return [f'{self.name}: the fields {missing} are not in the layer, it has {fields}']
+        return []
+
+
+def load_toml(path) -> dict:
+    """
+    Returns the TOML document at path.
+
+    tomllib (or tomli on Python 3.10 and older) is imported here, so that a run
+    without a registry does not need tomli.
+    """
+    try:
+        import tomllib
+    except ImportError:
+        # Python 3.10 and older
+        import tomli as tomllib
+    with open(path, 'rb') as f:
+        return tomllib.load(f)
+
+
+class SourceRegistry(object):
+    """The sources listed in a registry file, compiled, in the order they are combined."""
+    def __init__(self, path, schema_props: OrderedDict, computed_fields=()):
+        self.path = Path(path)
+        document = load_toml(self.path)
+        root = self.path.parent
+        self.sources = [CompiledSource(entry, root, schema_props, computed_fields) for entry in document.get('source', [])]
+        names = [source.name for source in self.sources]
+        duplicates = sorted({name for name in names if names.count(name) > 1})
+        if duplicates:
+            raise RegistryError(f'the sources {duplicates} are listed more than once in {self.path}')
+
+    def __iter__(self):
+        return iter(self.sources)
+
+    def __len__(self):
+        return len(self.sources)
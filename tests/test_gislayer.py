@@ -0,0 +1,46 @@
+from pathlib import Path
+
+import geopandas as gpd
+import pyproj
+import pytest
+from shapely.geometry import box
+
+import gislayer
+
+REPO = Path(__file__).resolve().parent.parent
+
+
+def test_concat_layers_with_equal_crs():
+    # the same CRS, as a shapefile .prj gives it and as an authority code, compare equal but hash differently
+    crs = pyproj.CRS('ESRI:102630')
+    prj_crs = pyproj.CRS.from_wkt(crs.to_wkt('WKT1_ESRI'))
+    assert crs == prj_crs and len({crs, prj_crs}) == 2
+
+    layers = []
+    for layer_crs in (crs, prj_crs):
+        layer = gislayer.GISLayer(gdf=gpd.GeoDataFrame({'NAME': ['a']}, geometry=[box(0, 0, 1, 1)], crs=layer_crs))
+        layer.to_crs('ESRI:102630')
+        layers.append(layer)
+
+    combined = gislayer.GISLayer().concat(layers)
+    assert len(combined.gdf) == 2
+    assert combined.gdf.crs == crs
+
+
+TOWNS_GDB = 'municipal_limits/MunicipalLimits.gdb'
+TOWNS_WHERE = "MUNITYP = 'Town' OR NAME = 'Ardmore'"
+
+
+@pytest.mark.parametrize('engine', ['fiona', 'pyogrio'])
+def test_iter_file_chunks_of_a_filtered_layer(engine):
+    if engine == 'pyogrio':
+        pytest.importorskip('pyogrio')
+    path = str(REPO / TOWNS_GDB)
+    whole = gislayer.read_file(path, layer='MunicipalBoundary', engine=engine, where=TOWNS_WHERE)
+    chunks = list(gislayer.iter_file_chunks(path, 2, layer='MunicipalBoundary', engine=engine,
+                                            columns=['NAME', 'MUNITYP'], where=TOWNS_WHERE))
+    assert len(whole) > 2
+    assert all(len(chunk) <= 2 for chunk in chunks)
+    assert sum(len(chunk) for chunk in chunks) == len(whole)
+    names = [name for chunk in chunks for name in chunk['NAME']]
+    assert sorted(names) == sorted(whole['NAME'])
@@ -0,0 +1,40 @@
+import concurrent.futures
+
+import geopandas as gpd
+import pandas as pd
+from shapely.geometry import box
+
+import layercache
+
+
+def sample_gdf():
+    return gpd.GeoDataFrame({'NAME': ['a', 'b']}, geometry=[box(0, 0, 1, 1), box(1, 0, 2, 1)], crs='ESRI:102630')
+
+
+def test_attributes_are_stored_as_json(tmp_path):
+    cache = layercache.LayerCache(tmp_path)
+    attributes = {'folder_date': pd.Timestamp('2019-06-10'), 'where_applied': True}
+    cache.put('k', sample_gdf(), attributes)
+
+    assert list(cache.get('k')['NAME']) == ['a', 'b']
+    assert cache.get_attributes('k') == attributes
+    assert [p.name for p in tmp_path.iterdir()] == ['k' + layercache.CACHE_SUFFIX]
+
+
+def test_truncated_entry_is_a_miss(tmp_path):
+    cache = layercache.LayerCache(tmp_path)
+    cache.put('k', sample_gdf())
+    path = cache.path('k')
+    path.write_bytes(path.read_bytes()[:100])
+
+    assert cache.get('k') is None
+    assert not path.exists()
+
+
+def test_threads_storing_the_same_key(tmp_path):
+    cache = layercache.LayerCache(tmp_path)
+    with concurrent.futures.ThreadPoolExecutor(8) as pool:
+        list(pool.map(lambda _: cache.put('k', sample_gdf(), {'where_applied': False}), range(32)))
+
+    assert len(cache.get('k')) == 2
+    assert [p.name for p in tmp_path.iterdir()] == ['k' + layercache.CACHE_SUFFIX]
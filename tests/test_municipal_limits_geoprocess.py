@@ -0,0 +1,31 @@
+import datetime
+from pathlib import Path
+
+import pytest
+
+import municipal_limits_geoprocess as mlg
+
+REPO = Path(__file__).resolve().parent.parent
+
+
+@pytest.mark.parametrize('engine', ['fiona', 'pyogrio'])
+def test_plan_lastupdate_is_the_built_lastupdate(engine, monkeypatch):
+    if engine == 'pyogrio':
+        pytest.importorskip('pyogrio')
+    # the default paths are relative to the repository
+    monkeypatch.chdir(REPO)
+    mlgp = mlg.MunicipalLimitsGeoProcess(mlg.CITIES_FOLDER, engine=engine)
+    plan = mlgp.plan()
+    for (name, layer_class, kwargs) in mlgp.layer_specs():
+        layer = mlg._build_layer(layer_class, kwargs)
+        built = datetime.date.fromisoformat(str(max(layer.gdf['LASTUPDATE']))[:10])
+        assert plan['layers'][name]['lastupdate'] == built.isoformat(), name
+
+
+@pytest.mark.parametrize(('layer', 'expected'), [
+    ('AthensMunicipalBoundary_2021_02_23', datetime.date(2021, 2, 23)),
+    ('AthensMunicipalBoundary_2020_10_31B', datetime.date(2020, 10, 31)),
+    ('MunicipalBoundary', None),
+])
+def test_snapshot_date_of_a_layer(layer, expected):
+    assert mlg.snapshot_date({'filename': 'municipal_limits/AthensMunicipalLimits.gdb', 'layer': layer}) == expected
@@ -0,0 +1,182 @@
+"""
+Topology checks of the combined municipal limits layer.
+
+  overlap  two municipalities cover the same area
+  invalid  a geometry is not valid (self intersections and the like)
+  gap      a small hole between municipalities, a sliver left by reprojecting
+           or by sources that do not quite line up
+
+The overlaps come from a spatial index self join, and the intersections of
+every candidate pair are computed in one vectorized shapely call.  A gap is
+a hole in the union of the layer smaller than the gap area threshold, larger
+holes are taken to be unincorporated land.
+
+run_qa() returns the issues as a layer with QA_SCHEMA_PROPS and summary metrics.
+"""
+
+from __future__ import annotations
+
+import logging
+import time
+from collections import OrderedDict
+from typing import Optional, Tuple
+
+import gislayer
+
+# imports from external libraries, that may have to be installed, loaded when first used
+gpd = gislayer.lazy_import('geopandas')
+np = gislayer.lazy_import('numpy')
+pd = gislayer.lazy_import('pandas')
+shapely = gislayer.lazy_import('shapely')
+
+# Holes in the union of the layer smaller than this, in square feet, are reported as gaps.  (one acre)
+GAP_MAX_AREA = 43560.0
+# Overlaps this small, in square feet, are not reported.
+OVERLAP_MIN_AREA = 0.0
+
+QA_SCHEMA_PROPS = OrderedDict([("ISSUE", "str:10"),
+                               ("NAME", "str:50"),
+                               ("GNIS", "int:10"),
+                               ("OTHERNAME", "str:50"),
+                               ("OTHERGNIS", "int:10"),
+                               ("AREA", "float:24.3"),
+                               ("DETAIL", "str:254")])
+
+
+def _polygonal(geoms: np.ndarray) -> np.ndarray:
+    """Returns geoms with everything but their polygons dropped, None where nothing is left."""
+    result = np.full(len(geoms), None, dtype=object)
+    for (i, geom) in enumerate(geoms):
+        # two levels, for a collection that holds a multipolygon
+        polygons = [g for g in shapely.get_parts(shapely.get_parts(geom)) if g.geom_type == 'Polygon']
+        if polygons:
+            result[i] = polygons[0] if len(polygons) == 1 else shapely.multipolygons(polygons)
+    return result
+
+
+def find_overlaps(gdf: gpd.GeoDataFrame, min_area: float = OVERLAP_MIN_AREA) -> gpd.GeoDataFrame:
+    """Returns the area shared by each pair of rows that overlap, with the positions of both rows."""
+    geoms = np.asarray(gdf.geometry.values)
+    sindex = gdf.sindex
+    if hasattr(sindex, 'query_bulk'):
+        (left, right) = sindex.query_bulk(gdf.geometry, predicate='intersects')
+    else:
+        (left, right) = sindex.query(gdf.geometry, predicate='intersects')
+    # each pair once, and not a row with itself
+    keep = left < right
+    (left, right) = (left[keep], right[keep])
+
+    # rows that only touch have no area in common
+    overlapping = shapely.overlaps(geoms[left], geoms[right]) | shapely.contains(geoms[left], geoms[right]) \
+        | shapely.within(geoms[left], geoms[right])
+    (left, right) = (left[overlapping], right[overlapping])
+    shared = _polygonal(shapely.intersection(geoms[left], geoms[right]))
+    area = shapely.area(shared)
+    keep = ~pd.isna(shared) & (np.nan_to_num(area) > min_area)
+    return gpd.GeoDataFrame({'left': left[keep], 'right': right[keep], 'area': area[keep]},
+                            geometry=list(shared[keep]), crs=gdf.crs)
+
+
+def find_invalid(gdf: gpd.GeoDataFrame) -> Tuple[np.ndarray, np.ndarray]:
+    """Returns (the positions of the rows with an invalid geometry, the reason each one is invalid)."""
+    geoms = np.asarray(gdf.geometry.values)
+    invalid = np.flatnonzero(~shapely.is_valid(geoms) & ~pd.isna(geoms))
+    return (invalid, shapely.is_valid_reason(geoms[invalid]))
+
+
+def repair(gdf: gpd.GeoDataFrame, rows: np.ndarray) -> gpd.GeoDataFrame:
+    """Returns a copy of gdf with the geometry of rows made valid, keeping only the polygons."""
+    repaired = gdf.copy()
+    geoms = np.asarray(gdf.geometry.values).copy()
+    geoms[rows] = _polygonal(shapely.make_valid(geoms[rows]))
+    repaired[gdf.geometry.name] = gpd.GeoSeries(geoms, index=gdf.index, crs=gdf.crs)
+    return repaired
+
+
+def find_gaps(gdf: gpd.GeoDataFrame, max_area: float = GAP_MAX_AREA,
+              workers: Optional[int] = None) -> gpd.GeoDataFrame:
+    """Returns the holes in the union of gdf smaller than max_area, with the positions of the rows around each."""
+    union = gislayer.partitioned_union(gdf.geometry, workers=workers)
+    polygons = shapely.get_parts(union)
+    rings = [shapely.get_interior_ring(p, i) for p in polygons for i in range(shapely.get_num_interior_rings(p))]
+    holes = shapely.polygons(np.asarray(rings, dtype=object)) if rings else np.array([], dtype=object)
+    area = shapely.area(holes)
+    holes = holes[area < max_area]
+    area = area[area < max_area]
+
+    # the rows around each hole
+    sindex = gdf.sindex
+    neighbours = [np.sort(sindex.query(hole, predicate='intersects')) for hole in holes]
+    return gpd.GeoDataFrame({'neighbours': neighbours, 'area': area}, geometry=list(holes), crs=gdf.crs)
+
+
+def run_qa(gdf: gpd.GeoDataFrame, gap_max_area: float = GAP_MAX_AREA,
+           overlap_min_area: float = OVERLAP_MIN_AREA, make_valid: bool = False,
+           workers: Optional[int] = None) -> Tuple[gpd.GeoDataFrame, dict, gpd.GeoDataFrame]:
+    """
+    Checks gdf for overlaps, invalid geometries and gaps.
+
+    When make_valid is True the invalid geometries are repaired (before looking for
+    overlaps and gaps), otherwise they are only reported.
+
+    returns (the issues as a layer with QA_SCHEMA_PROPS, summary metrics, gdf or the repaired gdf)
+    """
+    start = time.perf_counter()
+    gdf = gdf.reset_index(drop=True)
+    names = gdf['NAME'].to_numpy(dtype=object)
+    gnis = gdf['GNIS'].to_numpy()
+    frames = []
+
+    (invalid, reasons) = find_invalid(gdf)
+    if len(invalid):
+        logging.warning(f'{len(invalid)} invalid geometries: {list(reasons)}')
+        frames.append(gpd.GeoDataFrame({
+            'ISSUE': 'invalid', 'NAME': names[invalid], 'GNIS': gnis[invalid],
+            'OTHERNAME': None, 'OTHERGNIS': None, 'AREA': shapely.area(np.asarray(gdf.geometry.values)[invalid]),
+            'DETAIL': [('repaired: ' if make_valid else '') + reason for reason in reasons],
+        }, geometry=list(gdf.geometry.values[invalid]), crs=gdf.crs))
+        if make_valid:
+            gdf = repair(gdf, invalid)
+
+    overlaps = find_overlaps(gdf, overlap_min_area)
+    if len(overlaps):
+        (left, right) = (overlaps['left'].to_numpy(), overlaps['right'].to_numpy())
+        frames.append(gpd.GeoDataFrame({
+            'ISSUE': 'overlap', 'NAME': names[left], 'GNIS': gnis[left],
+            'OTHERNAME': names[right], 'OTHERGNIS': gnis[right], 'AREA': overlaps['area'].to_numpy(),
+            'DETAIL': [f'{a} overlaps {b}' for (a, b) in zip(names[left], names[right])],
+        }, geometry=list(overlaps.geometry.values), crs=gdf.crs))
+
+    gaps = find_gaps(gdf, gap_max_area, workers)
+    if len(gaps):
+        first = [n[0] if len(n) else None for n in gaps['neighbours']]
+        second = [n[1] if len(n) > 1 else None for n in gaps['neighbours']]
+        frames.append(gpd.GeoDataFrame({
+            'ISSUE': 'gap',
+            'NAME': [None if i is None else names[i] for i in first],
+            'GNIS': [None if i is None else gnis[i] for i in first],
+            'OTHERNAME': [None if i is None else names[i] for i in second],
+            'OTHERGNIS': [None if i is None else gnis[i] for i in second],
+            'AREA': gaps['area'].to_numpy(),
+            'DETAIL': ['gap between ' + ', '.join(sorted(set(str(names[i]) for i in n))) for n in gaps['neighbours']],
+        }, geometry=list(gaps.geometry.values), crs=gdf.crs))
+
+    if frames:
+        issues = gpd.GeoDataFrame(pd.concat(frames, ignore_index=True), crs=gdf.crs)
+    else:
+        issues = gpd.GeoDataFrame({field: [] for field in QA_SCHEMA_PROPS}, geometry=[], crs=gdf.crs)
+
+    metrics = OrderedDict([
+        ('rows', len(gdf)),
+        ('invalid', int(len(invalid))),
+        ('repaired', int(len(invalid)) if make_valid else 0),
+        ('overlaps', int(len(overlaps))),
+        ('overlap_area', float(overlaps['area'].sum())),
+        ('gaps', int(len(gaps))),
+        ('gap_area', float(gaps['area'].sum())),
+        ('gap_max_area', gap_max_area),
+        ('seconds', time.perf_counter() - start),
+    ])
+    logging.info(f'topology QA: {metrics["invalid"]} invalid, {metrics["overlaps"]} overlaps, '
+                 f'{metrics["gaps"]} gaps')
+    return (issues, metrics, gdf)
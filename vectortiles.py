@@ -0,0 +1,308 @@
+"""
+Builds a Web Mercator vector tile pyramid of the combined layer.
+
+For each zoom level the layer is generalized (see generalize.py) with a
+tolerance of about a pixel at that zoom, then every tile that the layer
+covers is clipped, encoded as a Mapbox Vector Tile and written to an
+MBTiles file (path ending in .mbtiles) or to a folder of z/x/y.pbf files.
+The zoom levels are generalized and the tiles encoded on one process pool,
+the tiles of a zoom level are encoded as soon as it is generalized.  The
+output is built under a temporary name and replaces the old one when it is
+done, so no tile of an earlier run is left behind.
+
+Encoding needs mapbox_vector_tile (pip install mapbox-vector-tile).
+
+    vectortiles.build_tiles(gdf, 'municipal_limits/limits.mbtiles', min_zoom=8, max_zoom=14)
+"""
+
+from __future__ import annotations
+
+import concurrent.futures
+import functools
+import gzip
+import inspect
+import json
+import logging
+import math
+import os
+import pickle
+import shutil
+import sqlite3
+import tempfile
+from pathlib import Path
+from typing import Iterable, List, Optional, Tuple
+
+import generalize
+import gislayer
+
+# imports from external libraries, that may have to be installed, loaded when first used
+gpd = gislayer.lazy_import('geopandas')
+np = gislayer.lazy_import('numpy')
+shapely = gislayer.lazy_import('shapely')
+
+WEB_MERCATOR_CRS = 'EPSG:3857'
+# half the width of the world in Web Mercator meters
+ORIGIN = 20037508.342789244
+
+TILE_EXTENT = 4096
+# extra tile units around each tile, so polygon edges are not drawn at tile borders
+TILE_BUFFER = 64
+TILE_LAYER_NAME = 'municipal_limits'
+TILE_FIELDS = ('NAME', 'GNIS', 'MUNITYP')
+
+MIN_ZOOM = 8
+MAX_ZOOM = 14
+# the simplification tolerance of a zoom level, in pixels of a 256 pixel tile
+SIMPLIFY_PIXELS = 0.5
+
+# Tiles sent to a worker at a time.
+TILES_PER_TASK = 64
+
+
+def tile_size(zoom: int) -> float:
+    """Returns the width of a tile at zoom in Web Mercator meters."""
+    return 2 * ORIGIN / 2 ** zoom
+
+
+def tile_bounds(zoom: int, x: int, y: int) -> Tuple[float, float, float, float]:
+    """Returns (minx, miny, maxx, maxy) of an XYZ tile (y counts down from the north)."""
+    size = tile_size(zoom)
+    minx = -ORIGIN + x * size
+    maxy = ORIGIN - y * size
+    return (minx, maxy - size, minx + size, maxy)
+
+
+def tiles_covering(bounds, zoom: int) -> List[Tuple[int, int, int]]:
+    """Returns the (zoom, x, y) of every tile that covers bounds, in Web Mercator meters."""
+    (minx, miny, maxx, maxy) = bounds
+    size = tile_size(zoom)
+    last = 2 ** zoom - 1
+
+    def clamp(value):
+        return min(max(int(math.floor(value)), 0), last)
+
+    (x0, x1) = (clamp((minx + ORIGIN) / size), clamp((maxx + ORIGIN) / size))
+    (y0, y1) = (clamp((ORIGIN - maxy) / size), clamp((ORIGIN - miny) / size))
+    return [(zoom, x, y) for x in range(x0, x1 + 1) for y in range(y0, y1 + 1)]
+
+
+def zoom_tolerance(zoom: int) -> float:
+    """Returns the simplification tolerance, in Web Mercator meters, for a zoom level."""
+    return tile_size(zoom) / 256 * SIMPLIFY_PIXELS
+
+
+@functools.lru_cache(maxsize=None)
+def _encoder():
+    if not gislayer.module_available('mapbox_vector_tile'):
+        raise ImportError('building vector tiles needs mapbox_vector_tile, pip install mapbox-vector-tile')
+    import mapbox_vector_tile
+    from mapbox_vector_tile.encoder import on_invalid_geometry_make_valid
+    options = {'extents': TILE_EXTENT, 'y_coord_down': True, 'on_invalid_geometry': on_invalid_geometry_make_valid}
+    if 'default_options' in inspect.signature(mapbox_vector_tile.encode).parameters:
+        # mapbox_vector_tile 2.0+
+        return lambda layers: mapbox_vector_tile.encode(layers, default_options=options)
+    return lambda layers: mapbox_vector_tile.encode(layers, **options)
+
+
+# The layer to tile in a worker, set by _init_worker(): 'source' the WKB of its geometries,
+# 'properties' the properties of each row and 'folder' where the generalized levels are.
+_worker = {}
+# The (geometries, STRtree) of each zoom level a worker has loaded, see _level().
+_worker_levels = {}
+
+
+def _init_worker(source_wkb, properties: list, level_folder: str):
+    _worker.clear()
+    _worker.update(source=source_wkb, properties=properties, folder=Path(level_folder))
+    _worker_levels.clear()
+
+
+def _level_path(folder: Path, zoom: int) -> Path:
+    return folder / f'{zoom}.wkb.pickle'
+
+
+def generalize_level(zoom: int) -> int:
+    """
+    Generalizes the layer for zoom and stores it in the level folder, for any worker to load.
+    Runs in a worker after _init_worker().
+
+    returns zoom
+    """
+    geoms = gpd.GeoDataFrame(geometry=shapely.from_wkb(_worker['source']))
+    simplified = generalize.generalize(geoms, zoom_tolerance(zoom))
+    path = _level_path(_worker['folder'], zoom)
+    tmp_path = path.with_name(path.name + '.tmp')
+    tmp_path.write_bytes(pickle.dumps(shapely.to_wkb(np.asarray(simplified.geometry.values))))
+    os.replace(tmp_path, path)
+    return zoom
+
+
+def _level(zoom: int):
+    """Returns the (geometries, STRtree) of zoom, loaded from what generalize_level() stored."""
+    if zoom not in _worker_levels:
+        geoms = shapely.from_wkb(pickle.loads(_level_path(_worker['folder'], zoom).read_bytes()))
+        _worker_levels[zoom] = (geoms, shapely.STRtree(geoms))
+    return _worker_levels[zoom]
+
+
+def encode_tile(zoom: int, x: int, y: int) -> Optional[bytes]:
+    """
+    Returns the encoded tile, None when no geometry is in it.
+    Runs in a worker after _init_worker(), once generalize_level(zoom) is done.
+    """
+    (geoms, tree) = _level(zoom)
+    properties = _worker['properties']
+    (minx, miny, maxx, maxy) = tile_bounds(zoom, x, y)
+    size = maxx - minx
+    buffer = size * TILE_BUFFER / TILE_EXTENT
+    rect = (minx - buffer, miny - buffer, maxx + buffer, maxy + buffer)
+    rows = np.sort(tree.query(shapely.box(*rect), predicate='intersects'))
+    if len(rows) == 0:
+        return None
+
+    clipped = shapely.clip_by_rect(geoms[rows], *rect)
+    # to tile units, y down from the top of the tile
+    scale = TILE_EXTENT / size
+    clipped = shapely.transform(clipped, lambda coords: np.column_stack(
+        ((coords[:, 0] - minx) * scale, (maxy - coords[:, 1]) * scale)))
+    features = [{'geometry': geom, 'properties': properties[row]}
+                for (geom, row) in zip(clipped, rows) if not geom.is_empty]
+    if not features:
+        return None
+    return _encoder()([{'name': TILE_LAYER_NAME, 'features': features}])
+
+
+def _encode_tiles(tiles: List[Tuple[int, int, int]]) -> List[Tuple[Tuple[int, int, int], Optional[bytes]]]:
+    return [(tile, encode_tile(*tile)) for tile in tiles]
+
+
+class MBTilesWriter(object):
+    """
+    Writes tiles to an MBTiles file, gzipped as the MBTiles spec asks for vector tiles.
+
+    The file is written under a temporary name, close() replaces path with it.
+    """
+    def __init__(self, path, min_zoom: int, max_zoom: int, bounds_lonlat, fields: Iterable[str]):
+        self.path = Path(path)
+        self.tmp_path = self.path.with_name(f'{self.path.name}.{os.getpid()}.tmp')
+        if self.tmp_path.exists():
+            self.tmp_path.unlink()
+        self.conn = sqlite3.connect(str(self.tmp_path))
+        self.conn.executescript("""
+            CREATE TABLE metadata (name TEXT, value TEXT);
+            CREATE TABLE tiles (zoom_level INTEGER, tile_column INTEGER, tile_row INTEGER, tile_data BLOB);
+            CREATE UNIQUE INDEX tile_index ON tiles (zoom_level, tile_column, tile_row);
+        """)
+        (west, south, east, north) = bounds_lonlat
+        metadata = {
+            'name': TILE_LAYER_NAME,
+            'format': 'pbf',
+            'minzoom': str(min_zoom),
+            'maxzoom': str(max_zoom),
+            'bounds': f'{west},{south},{east},{north}',
+            'center': f'{(west + east) / 2},{(south + north) / 2},{min_zoom}',
+            'json': json.dumps({'vector_layers': [{'id': TILE_LAYER_NAME, 'minzoom': min_zoom, 'maxzoom': max_zoom,
+                                                   'fields': {f: 'String' for f in fields}}]}),
+        }
+        self.conn.executemany('INSERT INTO metadata VALUES (?, ?)', metadata.items())
+
+    def write(self, zoom: int, x: int, y: int, data: bytes) -> None:
+        # MBTiles rows count up from the south (TMS)
+        self.conn.execute('INSERT INTO tiles VALUES (?, ?, ?, ?)',
+                          (zoom, x, 2 ** zoom - 1 - y, gzip.compress(data)))
+
+    def close(self) -> None:
+        self.conn.commit()
+        self.conn.close()
+        os.replace(self.tmp_path, self.path)
+
+    def abort(self) -> None:
+        """Drops what was written, the old file is kept."""
+        self.conn.close()
+        self.tmp_path.unlink()
+
+
+class FolderTileWriter(object):
+    """
+    Writes tiles to folder/z/x/y.pbf.
+
+    The tiles are written to a temporary folder next to it, close() puts it in place
+    of folder, so the tiles of an earlier run that are not made again do not stay.
+    """
+    def __init__(self, folder):
+        self.folder = Path(folder)
+        self.folder.parent.mkdir(parents=True, exist_ok=True)
+        self.tmp_folder = Path(tempfile.mkdtemp(prefix=f'.{self.folder.name}.', dir=self.folder.parent))
+
+    def write(self, zoom: int, x: int, y: int, data: bytes) -> None:
+        path = self.tmp_folder / str(zoom) / str(x) / f'{y}.pbf'
+        path.parent.mkdir(parents=True, exist_ok=True)
+        path.write_bytes(data)
+
+    def close(self) -> None:
+        old_folder = None
+        if self.folder.exists():
+            old_folder = self.folder.with_name(self.tmp_folder.name + '.old')
+            self.folder.rename(old_folder)
+        self.tmp_folder.rename(self.folder)
+        if old_folder is not None:
+            shutil.rmtree(old_folder)
+
+    def abort(self) -> None:
+        """Drops what was written, the old folder is kept."""
+        shutil.rmtree(self.tmp_folder)
+
+
+def build_tiles(gdf: gpd.GeoDataFrame, path, min_zoom: int = MIN_ZOOM, max_zoom: int = MAX_ZOOM,
+                workers: Optional[int] = None, fields: Iterable[str] = TILE_FIELDS) -> int:
+    """
+    Builds the tiles of gdf from min_zoom to max_zoom into path, an .mbtiles file or a folder.
+
+    workers is the number of processes that generalize the zoom levels and encode
+    the tiles, by default one per core.
+
+    returns the number of tiles written
+    """
+    _encoder()  # fail before doing any work when mapbox_vector_tile is missing
+    fields = [f for f in fields if f in gdf]
+    mercator = gislayer.reproject(gdf, WEB_MERCATOR_CRS)
+    properties = [{f: (None if v is None else str(v)) for (f, v) in row.items()}
+                  for row in mercator[fields].to_dict('records')]
+    source_wkb = shapely.to_wkb(np.asarray(mercator.geometry.values))
+    bounds = mercator.total_bounds
+    # the deepest zoom first, it has the most tiles to encode
+    zooms = list(range(max_zoom, min_zoom - 1, -1))
+    logging.info(f'encoding up to {sum(len(tiles_covering(bounds, z)) for z in zooms)} tiles '
+                 f'for zoom {min_zoom} to {max_zoom}')
+
+    if str(path).endswith('.mbtiles'):
+        writer = MBTilesWriter(path, min_zoom, max_zoom, gislayer.reproject(gdf, 'EPSG:4326').total_bounds, fields)
+    else:
+        writer = FolderTileWriter(path)
+
+    written = 0
+    try:
+        with tempfile.TemporaryDirectory(prefix='tile-levels-') as level_folder, \
+                gislayer.make_pool(workers or os.cpu_count() or 1, 'process', initializer=_init_worker,
+                                   initargs=(source_wkb, properties, level_folder)) as pool:
+            # {future: True for generalize_level(), False for _encode_tiles()}
+            pending = {pool.submit(generalize_level, zoom): True for zoom in zooms}
+            while pending:
+                (done, _) = concurrent.futures.wait(pending, return_when=concurrent.futures.FIRST_COMPLETED)
+                for future in done:
+                    if pending.pop(future):
+                        # the zoom level is generalized, its tiles can be encoded
+                        tiles = tiles_covering(bounds, future.result())
+                        for i in range(0, len(tiles), TILES_PER_TASK):
+                            pending[pool.submit(_encode_tiles, tiles[i:i + TILES_PER_TASK])] = False
+                        continue
+                    for (tile, data) in future.result():
+                        if data is not None:
+                            writer.write(*tile, data)
+                            written += 1
+    except BaseException:
+        writer.abort()
+        raise
+    writer.close()
+    logging.info(f'wrote {written} tiles to {path}')
+    return written
@@ -0,0 +1,348 @@
+"""
+Keeps the geoprocess loaded and runs it again when its sources change.
+
+A run started from cron pays for importing geopandas, fiona and GDAL every
+time.  WatchDaemon stays up with them imported and watches the snapshot
+folders and geodatabases.  A burst of file events, such as a city snapshot
+being copied in, is debounced: the run starts once nothing has changed for
+the debounce time.  The watching uses inotify on Linux (through ctypes) and
+falls back to polling the file times elsewhere.
+
+A small HTTP server on localhost gives the status and starts runs by hand:
+
+    curl http://127.0.0.1:8787/status
+    curl -X POST http://127.0.0.1:8787/run
+
+See --watch in municipal_limits_geoprocess.py.
+"""
+
+import ctypes
+import ctypes.util
+import errno
+import http.server
+import json
+import logging
+import os
+import select
+import struct
+import threading
+import time
+from pathlib import Path
+from typing import Callable, Iterable, List, Optional, Tuple
+
+# Seconds without any file event before a run starts.
+DEBOUNCE_SECONDS = 10.0
+# Seconds between scans when inotify is not available.
+POLL_SECONDS = 5.0
+WATCH_HOST = '127.0.0.1'
+WATCH_PORT = 8787
+
+# from <sys/inotify.h>
+IN_MODIFY = 0x00000002
+IN_ATTRIB = 0x00000004
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_FROM = 0x00000040
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_DELETE = 0x00000200
+IN_DELETE_SELF = 0x00000400
+IN_MOVE_SELF = 0x00000800
+IN_Q_OVERFLOW = 0x00004000
+IN_IGNORED = 0x00008000
+IN_ISDIR = 0x40000000
+IN_NONBLOCK = os.O_NONBLOCK
+IN_CLOEXEC = 0o2000000
+WATCH_MASK = (IN_MODIFY | IN_ATTRIB | IN_CLOSE_WRITE | IN_MOVED_FROM | IN_MOVED_TO | IN_CREATE
+              | IN_DELETE | IN_DELETE_SELF | IN_MOVE_SELF)
+_EVENT_HEADER = struct.Struct('iIII')
+
+
+def _libc():
+    """Returns libc when it has inotify, otherwise None."""
+    try:
+        libc = ctypes.CDLL(ctypes.util.find_library('c') or None, use_errno=True)
+    except OSError:
+        return None
+    if not hasattr(libc, 'inotify_init1'):
+        return None
+    return libc
+
+
+class InotifyWatcher(object):
+    """
+    Calls on_change(path) for each change under the watched paths, with inotify.
+
+    paths is a list of (path, recursive).  Folders created under a recursive
+    path are watched as they appear.
+    """
+    name = 'inotify'
+
+    def __init__(self, paths: List[Tuple[Path, bool]], on_change: Callable[[str], None]):
+        self.libc = _libc()
+        if self.libc is None:
+            raise OSError(errno.ENOSYS, 'inotify is not available')
+        self.fd = self.libc.inotify_init1(IN_NONBLOCK | IN_CLOEXEC)
+        if self.fd < 0:
+            raise OSError(ctypes.get_errno(), 'inotify_init1 failed')
+        self.on_change = on_change
+        # {watch descriptor: (folder, recursive)}
+        self.watches = {}
+        self.stopped = threading.Event()
+        for (path, recursive) in paths:
+            self.add_tree(path, recursive)
+
+    def add(self, folder: Path, recursive: bool) -> None:
+        wd = self.libc.inotify_add_watch(self.fd, os.fsencode(str(folder)), WATCH_MASK)
+        if wd < 0:
+            logging.warning(f'cannot watch {folder}: {os.strerror(ctypes.get_errno())}')
+            return
+        self.watches[wd] = (folder, recursive)
+
+    def add_tree(self, folder: Path, recursive: bool) -> None:
+        if not folder.is_dir():
+            logging.warning(f'cannot watch {folder}, it is not a folder')
+            return
+        self.add(folder, recursive)
+        if recursive:
+            for (root, dirs, _) in os.walk(folder):
+                for d in dirs:
+                    self.add(Path(root) / d, True)
+
+    def run(self) -> None:
+        while not self.stopped.is_set():
+            (readable, _, _) = select.select([self.fd], [], [], 1.0)
+            if not readable:
+                continue
+            try:
+                data = os.read(self.fd, 64 * 1024)
+            except BlockingIOError:
+                continue
+            offset = 0
+            while offset < len(data):
+                (wd, mask, _, length) = _EVENT_HEADER.unpack_from(data, offset)
+                name = data[offset + _EVENT_HEADER.size:offset + _EVENT_HEADER.size + length].rstrip(b'\0')
+                offset += _EVENT_HEADER.size + length
+                if mask & IN_Q_OVERFLOW:
+                    self.on_change('(inotify queue overflow)')
+                    continue
+                if mask & IN_IGNORED:
+                    self.watches.pop(wd, None)
+                    continue
+                (folder, recursive) = self.watches.get(wd, (None, False))
+                if folder is None:
+                    continue
+                path = folder / os.fsdecode(name) if name else folder
+                if recursive and mask & IN_ISDIR and mask & (IN_CREATE | IN_MOVED_TO):
+                    self.add_tree(path, True)
+                self.on_change(str(path))
+
+    def stop(self) -> None:
+        self.stopped.set()
+
+    def close(self) -> None:
+        os.close(self.fd)
+
+
+class PollingWatcher(object):
+    """Calls on_change(path) for each change under the watched paths, found by scanning every interval seconds."""
+    name = 'polling'
+
+    def __init__(self, paths: List[Tuple[Path, bool]], on_change: Callable[[str], None],
+                 interval: float = POLL_SECONDS):
+        self.paths = paths
+        self.on_change = on_change
+        self.interval = interval
+        self.stopped = threading.Event()
+        self.state = self.scan()
+
+    def scan(self) -> dict:
+        """Returns {path: (mtime, size)} of everything under the watched paths."""
+        state = {}
+        for (path, recursive) in self.paths:
+            for (root, dirs, files) in os.walk(path):
+                for name in dirs + files:
+                    try:
+                        st = os.stat(os.path.join(root, name))
+                    except FileNotFoundError:
+                        continue
+                    state[os.path.join(root, name)] = (st.st_mtime_ns, st.st_size)
+                if not recursive:
+                    break
+        return state
+
+    def run(self) -> None:
+        while not self.stopped.wait(self.interval):
+            state = self.scan()
+            changed = {p for p in state.keys() | self.state.keys() if state.get(p) != self.state.get(p)}
+            self.state = state
+            for path in sorted(changed):
+                self.on_change(path)
+
+    def stop(self) -> None:
+        self.stopped.set()
+
+    def close(self) -> None:
+        pass
+
+
+def make_watcher(paths: Iterable, on_change: Callable[[str], None], poll: bool = False,
+                 interval: float = POLL_SECONDS):
+    """
+    Returns an inotify watcher, or a polling one when poll is True or inotify is not available.
+
+    paths are files and folders.  Folders are watched with everything under them,
+    for a file the folder it is in is watched.
+    """
+    watched = []
+    for path in paths:
+        path = Path(path)
+        watched.append((path, True) if path.is_dir() else (path.parent, False))
+    if not poll:
+        try:
+            return InotifyWatcher(watched, on_change)
+        except OSError as err:
+            logging.info(f'watching by polling, {err}')
+    return PollingWatcher(watched, on_change, interval)
+
+
+class WatchDaemon(object):
+    """
+    Calls run() once the watched paths have been quiet for debounce seconds after a change,
+    or when a run is asked for over HTTP.  Only one run happens at a time, changes
+    during a run start another one after it.
+    """
+    def __init__(self, run: Callable[[], object], paths: Iterable, debounce: float = DEBOUNCE_SECONDS,
+                 host: str = WATCH_HOST, port: Optional[int] = WATCH_PORT, poll: bool = False):
+        self.run = run
+        self.paths = [str(p) for p in paths]
+        self.debounce = debounce
+        self.condition = threading.Condition()
+        # time of the last change not run yet, None when there is none
+        self.pending_since = None
+        self.last_change = None
+        self.last_change_path = None
+        self.forced = False
+        self.running = False
+        self.status = {'runs': 0, 'failures': 0, 'last_start': None, 'last_seconds': None,
+                       'last_ok': None, 'last_error': None, 'last_trigger': None}
+        self.watcher = make_watcher(self.paths, self.changed, poll)
+        self.server = None
+        if port is not None:
+            self.server = http.server.ThreadingHTTPServer((host, port), _make_handler(self))
+
+    def changed(self, path: str) -> None:
+        """Called by the watcher for every change."""
+        with self.condition:
+            now = time.monotonic()
+            if self.pending_since is None:
+                logging.info(f'change in {path}, waiting for it to settle')
+                self.pending_since = time.time()
+            self.last_change = now
+            self.last_change_path = path
+            self.condition.notify_all()
+
+    def trigger(self) -> None:
+        """Asks for a run now, without waiting for the debounce."""
+        with self.condition:
+            if self.pending_since is None:
+                self.pending_since = time.time()
+            self.last_change_path = 'manual trigger'
+            self.forced = True
+            self.condition.notify_all()
+
+    def state(self) -> dict:
+        with self.condition:
+            if self.running:
+                state = 'running'
+            elif self.pending_since is not None:
+                state = 'waiting'
+            else:
+                state = 'idle'
+            return dict(self.status, state=state, pending_since=self.pending_since, watcher=self.watcher.name,
+                        watching=self.paths, debounce=self.debounce)
+
+    def _wait_for_changes(self) -> str:
+        """Blocks until a change has settled (or a run is forced), returns what set it off."""
+        with self.condition:
+            while True:
+                if self.pending_since is not None:
+                    if self.forced:
+                        break
+                    quiet = time.monotonic() - self.last_change
+                    if quiet >= self.debounce:
+                        break
+                    self.condition.wait(self.debounce - quiet)
+                else:
+                    self.condition.wait()
+            reason = self.last_change_path
+            (self.pending_since, self.forced, self.running) = (None, False, True)
+            return reason
+
+    def run_once(self, reason: str) -> None:
+        logging.info(f'running, set off by {reason}')
+        start = time.perf_counter()
+        self.status.update(last_start=time.time(), last_trigger=reason)
+        try:
+            self.run()
+        except Exception as err:
+            logging.exception('the run failed')
+            self.status.update(last_ok=False, last_error=repr(err))
+            self.status['failures'] += 1
+        else:
+            self.status.update(last_ok=True, last_error=None)
+        finally:
+            self.status['runs'] += 1
+            self.status['last_seconds'] = time.perf_counter() - start
+            with self.condition:
+                self.running = False
+        logging.info(f'run done in {self.status["last_seconds"]:.1f} s')
+
+    def serve_forever(self, initial_run: bool = True) -> None:
+        """Watches and runs until interrupted."""
+        threading.Thread(target=self.watcher.run, name='watcher', daemon=True).start()
+        if self.server is not None:
+            threading.Thread(target=self.server.serve_forever, name='http', daemon=True).start()
+            (host, port) = self.server.server_address[:2]
+            logging.info(f'status on http://{host}:{port}/status')
+        logging.info(f'watching {len(self.paths)} paths with {self.watcher.name}')
+        if initial_run:
+            self.trigger()
+        try:
+            while True:
+                self.run_once(self._wait_for_changes())
+        except KeyboardInterrupt:
+            logging.info('stopping')
+        finally:
+            self.watcher.stop()
+            if self.server is not None:
+                self.server.shutdown()
+            self.watcher.close()
+
+
+def _make_handler(daemon: WatchDaemon):
+    class Handler(http.server.BaseHTTPRequestHandler):
+        def send_json(self, code: int, body: dict) -> None:
+            data = json.dumps(body, indent=2).encode()
+            self.send_response(code)
+            self.send_header('Content-Type', 'application/json')
+            self.send_header('Content-Length', str(len(data)))
+            self.end_headers()
+            self.wfile.write(data)
+
+        def do_GET(self):
+            if self.path in ('/', '/status'):
+                self.send_json(200, daemon.state())
+            else:
+                self.send_json(404, {'error': f'no {self.path}, try /status'})
+
+        def do_POST(self):
+            if self.path == '/run':
+                daemon.trigger()
+                self.send_json(202, daemon.state())
+            else:
+                self.send_json(404, {'error': f'no {self.path}, try POST /run'})
+
+        def log_message(self, format, *args):
+            logging.debug('http: ' + format % args)
+
+    return Handler
@@ -0,0 +1,217 @@
+"""
+Writers for the combined layer.
+
+Every format is written from the same schema, a fiona style OrderedDict of
+field name to type such as municipal_limits_geoprocess.OUTPUT_SCHEMA_PROPS.
+
+  shapefile   ESRI Shapefile, the original output
+  geoparquet  GeoParquet, sorted along a Hilbert curve with a bbox column per row,
+              so readers can skip row groups outside of the area they want
+  flatgeobuf  FlatGeobuf with its packed Hilbert R-tree spatial index
+  filegdb     ESRI File GeoDatabase (OpenFileGDB driver, needs GDAL 3.6+)
+
+StreamWriter appends a layer at a time instead of writing one GeoDataFrame.
+"""
+
+from __future__ import annotations
+
+import glob
+import inspect
+import logging
+import os
+from collections import OrderedDict
+from pathlib import Path
+from typing import Dict, Optional
+
+import gislayer
+
+# imports from external libraries, that may have to be installed, loaded when first used
+fiona = gislayer.lazy_import('fiona')
+gpd = gislayer.lazy_import('geopandas')
+pd = gislayer.lazy_import('pandas')
+shapely = gislayer.lazy_import('shapely')
+
+# rows in each row group of a GeoParquet file
+PARQUET_ROW_GROUP_SIZE = 10000
+
+
+def conform(gdf: gpd.GeoDataFrame, schema_props: OrderedDict) -> gpd.GeoDataFrame:
+    """
+    Returns gdf with exactly the fields in schema_props, in that order.
+
+    Missing fields are added as empty, 'date' fields are converted to datetimes
+    and 'int' fields to whole numbers.
+    """
+    columns = OrderedDict()
+    for (field, field_type) in schema_props.items():
+        if field not in gdf:
+            columns[field] = pd.Series([None] * len(gdf), index=gdf.index, dtype=object)
+        elif field_type == 'date' or field_type.startswith('datetime'):
+            columns[field] = pd.to_datetime(gdf[field])
+        elif field_type.startswith('int'):
+            values = gdf[field]
+            columns[field] = values.astype('int64') if values.notna().all() else values.astype('Int64')
+        else:
+            columns[field] = gdf[field]
+    return gpd.GeoDataFrame(columns, geometry=gdf.geometry, crs=gdf.crs)
+
+
+def to_multipolygons(gdf: gpd.GeoDataFrame) -> gpd.GeoDataFrame:
+    """Returns gdf with Polygons made into MultiPolygons, some formats want one geometry type."""
+    geoms = [shapely.MultiPolygon([g]) if g is not None and g.geom_type == 'Polygon' else g
+             for g in gdf.geometry]
+    multi = gdf.copy()
+    multi[gdf.geometry.name] = gpd.GeoSeries(geoms, index=gdf.index, crs=gdf.crs)
+    return multi
+
+
+def write_shapefile(gdf: gpd.GeoDataFrame, path, schema_props: OrderedDict, layer: Optional[str] = None):
+    # schema is given, because geopandas cannot tell that LASTUPDATE is a date
+    gdf.to_file(filename=str(path), driver='ESRI Shapefile',
+                schema={"geometry": "Polygon", "properties": schema_props})
+
+
+def write_ogr(gdf: gpd.GeoDataFrame, path, schema_props: OrderedDict, driver: str,
+              layer: Optional[str] = None, **options):
+    """Writes with GDAL, through pyogrio when it is installed, otherwise through fiona."""
+    gdf = to_multipolygons(conform(gdf, schema_props))
+    if gislayer.module_available('pyogrio'):
+        gdf.to_file(str(path), driver=driver, layer=layer, engine='pyogrio', **options)
+    else:
+        gdf.to_file(str(path), driver=driver, layer=layer,
+                    schema={"geometry": "MultiPolygon", "properties": schema_props}, **options)
+
+
+def write_flatgeobuf(gdf: gpd.GeoDataFrame, path, schema_props: OrderedDict, layer: Optional[str] = None):
+    write_ogr(gdf, path, schema_props, driver='FlatGeobuf', SPATIAL_INDEX='YES')
+
+
+def write_filegdb(gdf: gpd.GeoDataFrame, path, schema_props: OrderedDict, layer: Optional[str] = None):
+    write_ogr(gdf, path, schema_props, driver='OpenFileGDB', layer=layer)
+
+
+def write_geoparquet(gdf: gpd.GeoDataFrame, path, schema_props: OrderedDict, layer: Optional[str] = None):
+    gdf = conform(gdf, schema_props)
+
+    # rows close on the ground go in the same row group
+    if len(gdf) > 1 and hasattr(gdf.geometry, 'hilbert_distance'):
+        gdf = gdf.iloc[gdf.geometry.hilbert_distance().argsort()]
+
+    kwargs = {'row_group_size': PARQUET_ROW_GROUP_SIZE}
+    if 'write_covering_bbox' in inspect.signature(gpd.GeoDataFrame.to_parquet).parameters:
+        # geopandas 1.0+ writes the GeoParquet 1.1 bbox covering column
+        kwargs['write_covering_bbox'] = True
+    else:
+        # the same bbox struct column, the row group statistics of it let readers skip row groups
+        bounds = gdf.geometry.bounds
+        gdf = gdf.copy()
+        gdf['bbox'] = [{'xmin': r.minx, 'ymin': r.miny, 'xmax': r.maxx, 'ymax': r.maxy}
+                       for r in bounds.itertuples()]
+    gdf.to_parquet(str(path), **kwargs)
+
+
+# format name: (file extension, writer)
+FORMATS = OrderedDict([
+    ('shapefile', ('.shp', write_shapefile)),
+    ('geoparquet', ('.parquet', write_geoparquet)),
+    ('flatgeobuf', ('.fgb', write_flatgeobuf)),
+    ('filegdb', ('.gdb', write_filegdb)),
+])
+
+
+def write_formats(gdf: gpd.GeoDataFrame, paths: Dict[str, Path], schema_props: OrderedDict,
+                  layer: Optional[str] = None, workers: Optional[int] = None) -> Dict[str, Path]:
+    """
+    Writes gdf in every format in paths, a dict of format name to output path.
+
+    The formats are written at the same time on a thread pool, one thread for each
+    format unless workers is given.  layer is the layer name for formats that have layers.
+
+    returns paths
+    """
+    for name in paths:
+        if name not in FORMATS:
+            raise ValueError(f'unknown output format {name!r}, must be one of {list(FORMATS)}')
+
+    if len(paths) == 1:
+        ((name, path),) = paths.items()
+        logging.info(f'writing {name} {path}')
+        FORMATS[name][1](gdf, path, schema_props, layer)
+        return paths
+
+    with gislayer.make_pool(workers or len(paths)) as pool:
+        futures = {}
+        for (name, path) in paths.items():
+            logging.info(f'writing {name} {path}')
+            futures[name] = pool.submit(FORMATS[name][1], gdf, path, schema_props, layer)
+        for (name, future) in futures.items():
+            # raises the exception of a failed writer
+            future.result()
+    return paths
+
+
+# Formats that stream_writer() can append to a layer at a time, they are written with fiona.
+# (name: (driver, geometry type))
+STREAM_FORMATS = OrderedDict([
+    ('shapefile', ('ESRI Shapefile', 'Polygon')),
+    ('flatgeobuf', ('FlatGeobuf', 'MultiPolygon')),
+])
+
+# rows given to fiona at a time when streaming
+STREAM_BATCH_SIZE = 1000
+
+
+class StreamWriter(object):
+    """
+    Writes a layer in pieces, then gives it its final name.
+
+    The data is written to a temporary name in the same folder, and when
+    finish() is called the file is renamed to the final name, so a reader
+    never sees a half written file under the final name.
+    """
+    def __init__(self, format_name: str, folder, schema_props: OrderedDict, crs):
+        if format_name not in STREAM_FORMATS:
+            raise ValueError(f'the {format_name!r} format cannot be streamed, only {list(STREAM_FORMATS)}')
+        (self.driver, self.geometry_type) = STREAM_FORMATS[format_name]
+        self.extension = FORMATS[format_name][0]
+        self.schema_props = schema_props
+        self.folder = Path(folder)
+        self.tmp_stem = f'.partial-{os.getpid()}-{id(self)}'
+        self.tmp_path = self.folder / (self.tmp_stem + self.extension)
+        self.rows = 0
+        self.collection = fiona.open(str(self.tmp_path), 'w', driver=self.driver,
+                                     crs_wkt=gislayer.get_crs(crs).to_wkt(),
+                                     schema={'geometry': self.geometry_type, 'properties': schema_props})
+
+    def write(self, gdf: gpd.GeoDataFrame) -> None:
+        """Appends the rows of gdf, in batches of STREAM_BATCH_SIZE."""
+        gdf = conform(gdf, self.schema_props)
+        if self.geometry_type == 'MultiPolygon':
+            gdf = to_multipolygons(gdf)
+        for (field, field_type) in self.schema_props.items():
+            if field_type == 'date':
+                # fiona takes dates as ISO strings
+                gdf[field] = gdf[field].dt.strftime('%Y-%m-%d')
+        for start in range(0, len(gdf), STREAM_BATCH_SIZE):
+            self.collection.writerecords(gdf.iloc[start:start + STREAM_BATCH_SIZE].iterfeatures(na='null'))
+        self.rows += len(gdf)
+
+    def temporary_files(self):
+        return sorted(self.folder.glob(glob.escape(self.tmp_stem) + '.*'))
+
+    def finish(self, path) -> Path:
+        """Closes the file and renames it (and a shapefile's sidecar files) to path."""
+        self.collection.close()
+        path = Path(path)
+        for tmp_file in self.temporary_files():
+            # keeps a two part extension such as .shp.xml
+            suffix = tmp_file.name[len(self.tmp_stem):]
+            os.replace(tmp_file, path.with_name(path.stem + suffix))
+        logging.info(f'wrote {self.rows} rows to {path}')
+        return path
+
+    def abort(self) -> None:
+        """Closes and deletes the temporary files."""
+        self.collection.close()
+        for tmp_file in self.temporary_files():
+            tmp_file.unlink()